@@ -1,21 +1,161 @@
-#from prmx.api import get_characters, get_locations, get_script, get_music, get_shots, get_shot_images, get_shot_speeches
-from prmx import api
+import threading
+from typing import Any, Callable, Optional
+from prmx import api, web
+from prmx.pipeline import Pipeline, fan_out
 
-from prmx import api
 
-def make_movie(genre, attributes, audience, title, scenes):
-    try:
-        characters = api.get_characters(genre, attributes, audience, scenes)
-        locations = api.get_locations(title, scenes)
-        scripts = [api.get_script(genre, attributes, audience, scenes, locations, characters, scene_id) for scene_id, scene in enumerate(scenes)]
+# scripts are stored as a single list of strings: scenes not generated yet are empty strings
+def script_list(script: str, scene_id: int, num_scenes: int) -> list[str]:
+    scripts = [""] * num_scenes
+    scripts[scene_id] = script
+    return scripts
+
+
+# the app selects a voice per character: use the first suggestion for offline generation
+def with_selected_voice(characters: list[dict]) -> list[dict]:
+    for character in characters:
+        character["voice"] = character["voices"][character["selected_voice_index"]]
+    return characters
+
+
+def build_pipeline(
+    genre: int,
+    attributes: list,
+    audience: int,
+    title: str,
+    scenes: list[dict],
+    on_result: Optional[Callable[[str, Any], None]] = None,
+) -> Pipeline:
+    """declares the dependencies between the generation stages of a movie:
+    characters, locations and music only depend on scenes, then each scene fans out into
+    script -> shots -> (images, speeches), independently of the other scenes
+    """
+    num_scenes = len(scenes)
+    pipeline = Pipeline(on_result=on_result)
+    pipeline.add(
+        "characters",
+        lambda: with_selected_voice(
+            api.get_characters(genre, attributes, audience, scenes)
+        ),
+    )
+    pipeline.add("locations", lambda: api.get_locations(title, scenes))
+    pipeline.add("music", lambda: api.get_music(scenes))
+
+    for scene_id, (script, shots, images, speeches) in enumerate(
+        zip(
+            fan_out("script", num_scenes),
+            fan_out("shots", num_scenes),
+            fan_out("images", num_scenes),
+            fan_out("speeches", num_scenes),
+        )
+    ):
+        pipeline.add(
+            script,
+            lambda characters, locations, scene_id=scene_id: api.get_script(
+                genre, attributes, audience, scenes, locations, characters, scene_id
+            ),
+            deps=["characters", "locations"],
+        )
+        pipeline.add(
+            shots,
+            lambda script, characters, locations, scene_id=scene_id: api.get_shots(
+                script_list(script, scene_id, num_scenes),
+                locations,
+                characters,
+                scene_id,
+            ),
+            deps=[script, "characters", "locations"],
+        )
+        pipeline.add(
+            images,
+            api.get_shot_images,
+            deps=[shots, "characters", "locations"],
+        )
+        pipeline.add(
+            speeches,
+            api.get_shot_speeches,
+            deps=[shots, "characters", "locations"],
+        )
+    return pipeline
 
-        music = api.get_music(scenes)
-        shots = api.get_shots(scripts, locations, characters, scenes)
-        images = api.get_shot_images(shots, characters, locations)
-        speeches = api.get_shot_speeches(shots, characters)
 
+def stream_to_datastore(
+    uid: str, cid: str, num_scenes: int
+) -> Callable[[str, Any], None]:
+    """returns a pipeline callback persisting each stage result in the creation as it finishes
+
+    The callback runs in the threads of the stages, concurrently for independent stages.
+    """
+    scripts = [""] * num_scenes
+    # the scripts of all scenes are saved as a single list, in the order they are updated
+    scripts_lock = threading.Lock()
+    # shots of each scene, whose dialog lines get the URLs of their speeches
+    scene_shots = {}
+
+    def save(name: str, result: Any) -> None:
+        stage, _, index = name.partition(".")
+        if stage in ["characters", "locations"]:
+            web.ds().save(uid, cid, stage, result)
+        elif stage == "music":
+            for scene_id, music in enumerate(result):
+                url = music[0]["id"] if music else ""
+                web.ds().save(uid, cid, f"scenes.{scene_id}.music_url", url)
+                web.ds().save(uid, cid, f"scenes.{scene_id}.musics", music or [])
+        elif stage == "script":
+            with scripts_lock:
+                scripts[int(index)] = result
+                web.ds().save(uid, cid, "script", scripts)
+        elif stage == "shots":
+            # the speeches stage of a scene starts after this callback has returned
+            scene_shots[index] = result
+            web.ds().save(uid, cid, f"scenes.{index}.shots", result)
+        elif stage == "images":
+            for shot_id, image_meta in enumerate(web.upload_images(uid, cid, result)):
+                # shots whose generation failed keep no image
+                if image_meta is None:
+                    continue
+                path = f"scenes.{index}.shots.{shot_id}"
+                web.ds().save(uid, cid, f"{path}.image_url", image_meta["url"])
+                web.ds().save(
+                    uid, cid, f"{path}.bounding_boxes", image_meta["bounding_boxes"]
+                )
+        elif stage == "speeches":
+            shots_ref = (
+                web.ds()
+                .runtime_path(uid, cid, "creations")
+                .collection("scenes")
+                .document(index)
+                .collection("shots")
+            )
+            shots = scene_shots[index]
+            for shot_id, urls in enumerate(web.upload_dialog(uid, cid, result)):
+                if not urls:
+                    continue
+                # dialog lines are stored as an array in the shot document, not as a collection
+                dialog = [
+                    {**line, "line_url": url}
+                    for line, url in zip(shots[shot_id]["dialog"], urls)
+                ]
+                shots_ref.document(str(shot_id)).set({"dialog": dialog}, merge=True)
+
+    return save
+
+
+def make_movie(
+    genre: int,
+    attributes: list,
+    audience: int,
+    title: str,
+    scenes: list[dict],
+    uid: Optional[str] = None,
+    cid: Optional[str] = None,
+) -> dict:
+    """generates a full movie, persisting the results in the creation if uid and cid are given"""
+    try:
+        on_result = stream_to_datastore(uid, cid, len(scenes)) if uid and cid else None
+        build_pipeline(genre, attributes, audience, title, scenes, on_result).run()
         return {"success": True}
 
     except Exception as e:
         print(f"An error occurred: {e}")
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        return {"success": False, "error": str(e)}
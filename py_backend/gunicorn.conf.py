@@ -0,0 +1,25 @@
+"""gunicorn settings of the web service, see https://docs.gunicorn.org/en/stable/settings.html
+
+Most of a request is spent waiting on OpenAI, TTS and stable-diffusion: threads let one worker
+process serve many requests concurrently, while worker processes scale cpu-bound work like CLIP
+inference. Each worker process loads its own copy of the models and precomputed embeddings.
+
+Settings are read from environment variables to be tuned per deployment without a rebuild.
+"""
+
+import os
+
+bind = f":{os.environ.get('PORT', 8080)}"
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# gthread is the threaded worker of gunicorn: other classes like gevent require extra dependencies
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# disable worker timeouts and allow Cloud Run to handle instance scaling
+timeout = 0
+
+
+def post_worker_init(worker):
+    # load precomputed embeddings once per worker before serving, not in the first request threads
+    from prmx.web import preload
+
+    preload()
@@ -4,7 +4,7 @@ from prmx.errors import MockMismatchError
 import json
 import firebase_admin
 import traceback
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -30,6 +30,18 @@ def main():
     if uid is None:
         return "Unauthorized", 401
 
+    # opt-in streaming of partial LLM outputs as server-sent events
+    if request_json.pop("stream", False):
+        # the status is sent with the first event: unsupported calls are rejected beforehand
+        call = request_json.get("call")
+        if not web.supports_streaming(call):
+            return f"{call} does not support streaming", 400
+        return Response(
+            web.gen_events(uid, **request_json),
+            mimetype="text/event-stream",
+            headers={"Access-Control-Allow-Origin": "*", "Cache-Control": "no-cache"},
+        )
+
     try:
         # while py_cloud_fun is the entry point, web.gen is the second door leading to the api
         response_dict = web.gen(uid, **request_json)
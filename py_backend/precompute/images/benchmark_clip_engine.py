@@ -0,0 +1,85 @@
+# Benchmark of the CLIP text engine variants of prmx.clip_engine
+# Purpose:
+# - Compare the load time and latency of the fp32, int8 and onnx variants, one text per forward
+#   pass as before the engine, and all texts in batches
+# - Measure the embedding drift of each variant from fp32: cosine similarity of the embeddings,
+#   and agreement of the asset matches of prmx.assets.get_asset_url
+#
+# Usage, from py_backend, after download.py:
+# python -m precompute.images.benchmark_clip_engine --emb_type characters --variants fp32 int8
+
+import argparse
+import time
+import numpy as np
+from prmx.assets import load_embeddings
+from prmx.clip_engine import CLIP_VARIANTS, ClipTextEngine
+from prmx.util import load_json
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--emb_type", choices=["characters", "locations"], required=True)
+argParser.add_argument(
+    "--variants", nargs="+", choices=CLIP_VARIANTS, default=["fp32", "int8"]
+)
+argParser.add_argument("--texts", help="descriptions to encode", type=int, default=64)
+argParser.add_argument("--k", help="asset matches compared", type=int, default=5)
+
+args = argParser.parse_args()
+
+DEFAULT_PATHS = {
+    "characters": "assets/default/characters.json",
+    "locations": "assets/default/locations.json",
+}
+
+
+# descriptions of the default creation, repeated with variations up to n texts
+def descriptions(emb_type: str, n: int) -> list[str]:
+    texts = [f"{a['name']}. {a['desc']}" for a in load_json(DEFAULT_PATHS[emb_type])]
+    return [f"{texts[i % len(texts)]} ({i})" for i in range(n)]
+
+
+def main(emb_type: str, variants: list[str], n_texts: int, k: int):
+    texts = descriptions(emb_type, n_texts)
+    library, _ = load_embeddings(emb_type)
+
+    embeddings = {}
+    for variant in variants:
+        start = time.perf_counter()
+        engine = ClipTextEngine(variant).load()
+        load_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for text in texts:
+            engine.encode([text])
+        single_ms = (time.perf_counter() - start) * 1000 / len(texts)
+
+        start = time.perf_counter()
+        embeddings[variant] = engine.encode(texts)
+        batched_ms = (time.perf_counter() - start) * 1000 / len(texts)
+        print(
+            f"variant={variant:<5} load={load_s:.1f}s single={single_ms:.1f}ms/text "
+            f"batched={batched_ms:.1f}ms/text"
+        )
+
+    if "fp32" not in embeddings:
+        return
+    reference = embeddings["fp32"]
+    reference_matches = library.search(reference, k)
+    for variant, embeds in embeddings.items():
+        if variant == "fp32":
+            continue
+        cosine = np.sum(reference * embeds, axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(embeds, axis=1)
+        )
+        matches = library.search(embeds, k)
+        top1 = np.mean(matches[:, 0] == reference_matches[:, 0])
+        overlap = np.mean(
+            [len(set(a) & set(b)) / k for a, b in zip(matches, reference_matches)]
+        )
+        print(
+            f"variant={variant:<5} cosine to fp32: mean={cosine.mean():.4f} "
+            f"min={cosine.min():.4f} top-1 agreement={top1:.3f} top-{k} overlap={overlap:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main(args.emb_type, args.variants, args.texts, args.k)
@@ -0,0 +1,57 @@
+# This step is executed after gen_asset_clip.py
+# Purpose:
+# - Build an IVF index over the CLIP embeddings of the assets, loaded by prmx.assets if present
+# - Benchmark its recall and latency against brute-force search, to pick PRMX_ANN_NPROBE
+#
+# Usage, from py_backend: python -m precompute.images.gen_asset_index --emb_type characters
+# The Docker build runs it with --queries 0, skipping the benchmark, so that the index ships with
+# the image.
+
+import argparse
+import numpy as np
+from prmx.ann import IVFIndex, benchmark
+from prmx.assets import CLIP_PATHS, INDEX_PATHS
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--emb_type", choices=list(CLIP_PATHS), required=True)
+argParser.add_argument("--nlist", help="number of clusters", type=int, default=None)
+argParser.add_argument(
+    "--queries",
+    help="benchmark queries, 0 to skip the benchmark",
+    type=int,
+    default=200,
+)
+argParser.add_argument("--k", help="benchmark neighbours", type=int, default=10)
+
+args = argParser.parse_args()
+
+
+def main(emb_type: str, nlist: int, n_queries: int, k: int):
+    numpy_path, _ = CLIP_PATHS[emb_type]
+    vectors = np.load(numpy_path).astype(np.float32)
+    print("Loaded embeddings:", vectors.shape)
+
+    index = IVFIndex.build(vectors, nlist)
+    index.save(INDEX_PATHS[emb_type])
+    print(
+        "Saved index with", len(index.centroids), "clusters to", INDEX_PATHS[emb_type]
+    )
+
+    if not n_queries:
+        return
+
+    # library vectors with noise stand in for text queries
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)))]
+    queries = queries + rng.normal(scale=queries.std(), size=queries.shape)
+
+    for result in benchmark(IVFIndex.load(INDEX_PATHS[emb_type]), vectors, queries, k):
+        print(
+            f"nprobe={result['nprobe']:>3} recall@{k}={result['recall']:.3f} "
+            f"latency={result['latency_ms']:.3f}ms "
+            f"brute force={result['brute_force_ms']:.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main(args.emb_type, args.nlist, args.queries, args.k)
@@ -1,12 +1,14 @@
-import json, os, re
+import argparse, json, os, re
 from prmx.speech import (
     load_data,
+    save_data,
     infer,
     estimate_f0,
     VOICE_DATA_PATH,
     get_embed,
     EMOTION_EMBED_PATH,
     shift_pitch,
+    store_paths,
 )
 
 
@@ -40,6 +42,7 @@ def generate_text2voice_mapping(
     ):  # make sure that the original pitch of the speaker is included
         pitch_shift_ratios = [1.0] + pitch_shift_ratios
     emb_list = []
+    embeddings = []
     speaker_info = voice_metadata["speakers"]
     index = 1
     for speaker, info in speaker_info.items():
@@ -110,16 +113,16 @@ def generate_text2voice_mapping(
                     "f0": f0 * pitch_shift,
                     "pitch_ratio": pitch_shift,
                     "speaker_desc": speaker_desc_full,
-                    "text_embed": json.dumps(get_embed(speaker_desc_full)),
                 }
             )
+            embeddings.append(get_embed(speaker_desc_full))
             index += 1
 
-    with open(VOICE_DATA_PATH, "w") as file:
-        json.dump(emb_list, file, indent=2)
+    save_data(VOICE_DATA_PATH, emb_list, embeddings)
 
 
 def save_emotion_embeddings() -> None:
+    emotion_data = []
     emotion_embeddings = []
     emotion_desc = {
         "Angry_not_Screaming": "Angry, but not screaming.",
@@ -135,12 +138,15 @@ def save_emotion_embeddings() -> None:
     }
 
     for i, (emotion, desc) in enumerate(emotion_desc.items(), start=1):
-        embed = get_embed(desc)
-        emotion_embeddings.append(
-            {"emotion_index": i, "emotion": emotion, "text_embed": json.dumps(embed)}
-        )
-    with open(EMOTION_EMBED_PATH, "w") as file:
-        json.dump(emotion_embeddings, file, indent=2)
+        emotion_data.append({"emotion_index": i, "emotion": emotion})
+        emotion_embeddings.append(get_embed(desc))
+    save_data(EMOTION_EMBED_PATH, emotion_data, emotion_embeddings)
+
+
+def convert_to_binary(path: str) -> None:
+    """Converts a legacy json store, with embeddings serialized as text, to the binary store"""
+    mapping, embeddings = load_data.__wrapped__(path)
+    save_data(path, mapping, embeddings.vectors)
 
 
 def generate_voice_samples() -> None:
@@ -163,3 +169,17 @@ def generate_voice_samples() -> None:
         if pitch_ratio != 1.0:
             audio_segment = shift_pitch(audio_segment, pitch_ratio)
         audio_segment.export(voice_sample_path + f"{speaker_index}.mp3", format="mp3")
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument(
+        "--convert",
+        action="store_true",
+        help="convert the json voice and emotion stores to the binary stores, e.g. in the Docker build",
+    )
+    args = argParser.parse_args()
+    if args.convert:
+        for path in [VOICE_DATA_PATH, EMOTION_EMBED_PATH]:
+            convert_to_binary(path)
+            print("converted", path, "to", *store_paths(path))
@@ -0,0 +1,118 @@
+"""Asyncio client layer for the inference endpoints: TTS, stable diffusion and OpenAI
+
+Coroutines run on a single event loop owned by a background thread, so that sync code, e.g. a
+Flask request thread, calls them with aio.run(...) without managing a loop itself. The loop holds
+one pooled HTTP client shared by all endpoints, and a semaphore per endpoint bounds the number of
+in-flight requests: fan-out over shots and dialog lines is a cheap asyncio.gather instead of a
+thread per request.
+
+Example
+-------
+>>> async def ping(url):
+...     async with aio.limit("tts"):
+...         return await aio.http_client().get(url)
+>>> aio.run(ping("https://example.com")).status_code
+200
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+from functools import cached_property
+from typing import Any, Coroutine
+import httpx
+from openai import AsyncOpenAI
+
+# connections kept open to the inference services, shared by all endpoints
+HTTP_POOL_SIZE = int(os.environ.get("PRMX_HTTP_POOL_SIZE", 32))
+# image generation and TTS inference can take minutes on cold GPU instances
+HTTP_TIMEOUT = float(os.environ.get("PRMX_HTTP_TIMEOUT", 300))
+
+# maximum number of concurrent requests per endpoint
+CONCURRENCY = {
+    "tts": int(os.environ.get("PRMX_TTS_CONCURRENCY", 8)),
+    "image": int(os.environ.get("PRMX_IMAGE_CONCURRENCY", 4)),
+    "openai": int(os.environ.get("PRMX_OPENAI_CONCURRENCY", 8)),
+}
+
+
+class Runtime:
+    """event loop thread with the clients and semaphores bound to it"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="prmx-aio", daemon=True
+        )
+        self.thread.start()
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+            ),
+            timeout=HTTP_TIMEOUT,
+        )
+        self.semaphores = {
+            endpoint: asyncio.Semaphore(limit)
+            for endpoint, limit in CONCURRENCY.items()
+        }
+
+    # created on first use: the api key is only required by services calling OpenAI
+    @cached_property
+    def openai(self) -> AsyncOpenAI:
+        return AsyncOpenAI(max_retries=1, timeout=90, http_client=self.http)
+
+
+# one runtime per process: a loop thread does not survive a fork of the server workers
+runtimes: dict[int, Runtime] = {}
+runtimes_lock = threading.Lock()
+
+
+def runtime() -> Runtime:
+    with runtimes_lock:
+        pid = os.getpid()
+        if pid not in runtimes:
+            runtimes[pid] = Runtime()
+        return runtimes[pid]
+
+
+def run(coroutine: Coroutine) -> Any:
+    """runs a coroutine on the shared event loop and blocks until its result is available"""
+    # blocking the loop thread on its own coroutine would never return
+    assert (
+        threading.current_thread() is not runtime().thread
+    ), "aio.run cannot be called from a coroutine: await the coroutine instead"
+    # the coroutine runs in the caller's context, e.g. with its scoped configuration
+    context = contextvars.copy_context()
+    return asyncio.run_coroutine_threadsafe(
+        in_context(context, coroutine), runtime().loop
+    ).result()
+
+
+async def in_context(context: contextvars.Context, coroutine: Coroutine) -> Any:
+    # a task runs in a copy of the loop thread context: set the caller's variables in it
+    for variable, value in context.items():
+        variable.set(value)
+    return await coroutine
+
+
+def limit(endpoint: str) -> asyncio.Semaphore:
+    """semaphore bounding the concurrent requests to an endpoint, see CONCURRENCY"""
+    return runtime().semaphores[endpoint]
+
+
+def http_client() -> httpx.AsyncClient:
+    return runtime().http
+
+
+def openai_client() -> AsyncOpenAI:
+    return runtime().openai
+
+
+async def post_json(
+    endpoint: str, url: str, payload: dict, headers: dict
+) -> httpx.Response:
+    """posts a json payload through the shared connection pool, within the endpoint limit"""
+    async with limit(endpoint):
+        return await http_client().post(url, json=payload, headers=headers)
@@ -0,0 +1,175 @@
+"""Approximate nearest neighbour search over precomputed embeddings, in pure NumPy
+
+An inverted file index (IVF) partitions the library vectors into clusters around k-means centroids.
+A query is only compared to the vectors of the nprobe clusters whose centroids score best, instead
+of the full library. Scores are dot products, as in the brute-force lookups of prmx.assets.
+
+Vectors are stored sorted by cluster, so that each probed cluster is a contiguous slice of a
+memory-mapped file: only the probed pages are read from disk.
+
+Index folder layout, written by IVFIndex.save and built in precompute/images/gen_asset_index.py:
+- centroids.npy: (nlist, dim) float32 cluster centroids
+- vectors.npy: (N, dim) float32 library vectors, sorted by cluster
+- ids.npy: (N,) int64 library index of each row of vectors.npy
+- offsets.npy: (nlist + 1,) int64 first row of each cluster in vectors.npy
+"""
+
+import os
+import time
+from typing import Iterable, Optional
+import numpy as np
+from prmx.vector_search import normalize, top_k
+
+# clusters probed per query: higher is slower, with a better recall
+ANN_NPROBE = int(os.environ.get("PRMX_ANN_NPROBE", 8))
+
+INDEX_FILES = ["centroids", "vectors", "ids", "offsets"]
+
+
+def kmeans(
+    vectors: np.ndarray, nlist: int, iterations: int = 20, seed: int = 0
+) -> np.ndarray:
+    """spherical k-means: returns (nlist, dim) unit centroids of the normalized vectors"""
+    rng = np.random.default_rng(seed)
+    points = normalize(vectors.astype(np.float32))
+    centroids = points[rng.choice(len(points), nlist, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(points @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, points)
+        counts = np.bincount(assignments, minlength=nlist)
+        # empty clusters are restarted on random points
+        empty = counts == 0
+        sums[empty] = points[rng.choice(len(points), empty.sum())]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex:
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        vectors: np.ndarray,
+        ids: np.ndarray,
+        offsets: np.ndarray,
+    ):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        nlist: Optional[int] = None,
+        iterations: int = 20,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        """clusters the library vectors, by default into 4 * sqrt(N) clusters"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+
+        centroids = kmeans(vectors, nlist, iterations, seed)
+        assignments = np.argmax(normalize(vectors) @ centroids.T, axis=1)
+        # stable sort: rows of a cluster keep the library order
+        ids = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=nlist)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids, vectors[ids], ids.astype(np.int64), offsets)
+
+    def save(self, folder: str) -> None:
+        os.makedirs(folder, exist_ok=True)
+        for name in INDEX_FILES:
+            np.save(os.path.join(folder, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, folder: str, mmap: bool = True) -> "IVFIndex":
+        mmap_mode = "r" if mmap else None
+        arrays = [
+            np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in INDEX_FILES
+        ]
+        return cls(*arrays)
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        nprobe: int = ANN_NPROBE,
+        exclude: Iterable[int] = (),
+    ) -> np.ndarray:
+        """returns the library indices of the k best scoring vectors, best first
+
+        Excluded indices are skipped. When the probed clusters hold less than k candidates, more
+        clusters are probed, up to a full scan.
+        """
+        query = np.asarray(query, dtype=np.float32).flatten()
+        exclude = np.unique(np.fromiter(exclude, dtype=np.int64))
+        nlist = len(self.centroids)
+        k = min(k, len(self) - len(exclude))
+        if k <= 0:
+            return np.array([], dtype=np.int64)
+
+        cluster_order = np.argsort(-(self.centroids @ query))
+        nprobe = min(nprobe, nlist)
+        while True:
+            clusters = cluster_order[:nprobe]
+            rows = np.concatenate(
+                [np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters]
+            )
+            if len(exclude):
+                rows = rows[~np.isin(self.ids[rows], exclude)]
+            if len(rows) >= k or nprobe == nlist:
+                break
+            nprobe = min(2 * nprobe, nlist)
+
+        # sorted rows read the memory-mapped vectors sequentially
+        rows = np.sort(rows)
+        scores = np.asarray(self.vectors[rows] @ query)
+        ids = np.asarray(self.ids[rows])
+        best = np.argpartition(-scores, k - 1)[:k]
+        # ties are broken by library index for deterministic results
+        return ids[best[np.lexsort((ids[best], -scores[best]))]]
+
+
+def brute_force_search(
+    vectors: np.ndarray, query: np.ndarray, k: int, exclude: Iterable[int] = ()
+) -> np.ndarray:
+    """exact search, the reference of the recall benchmark"""
+    scores = np.asarray(vectors @ np.asarray(query, dtype=np.float32).flatten())
+    return top_k(scores, k, exclude)
+
+
+def benchmark(
+    index: IVFIndex,
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    nprobes: list[int] = [1, 4, 8, 16, 32],
+) -> list[dict]:
+    """measures the recall@k and the mean latency of the index against brute-force search"""
+    start = time.perf_counter()
+    exact = [set(brute_force_search(vectors, query, k)) for query in queries]
+    brute_force_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = [set(index.search(query, k, nprobe)) for query in queries]
+        latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+        results.append(
+            {
+                "nprobe": nprobe,
+                "recall": float(recall),
+                "latency_ms": latency_ms,
+                "brute_force_ms": brute_force_ms,
+            }
+        )
+    return results
@@ -1,14 +1,21 @@
 # functions exposed to the frontend and deployed serverless in a cloud environment
 
 from os import environ
-from typing import Tuple
+from contextvars import copy_context
+from functools import partial
+from typing import Callable, Iterator, Optional, Tuple
+import asyncio
 import concurrent
-from prmx import util, llm, music, speech, audio, assets
+import copy
+from prmx import aio, util, llm, music, speech, audio, assets
 from prmx.context import localContext
+from prmx.scheduler import JobScheduler
+from prmx.speech_cache import speech_cache
+from prmx.text_embeddings import cached_embeds
 from prmx.util import load_txt
 from prmx.promptparser import eval_prompt, prompt_preprocess
 from prmx.imagen import (
-    gen_image,
+    gen_image_async,
     shot_type_prompt,
     draw_dialog_on_image,
     shot_type_desc,
@@ -16,6 +23,7 @@ from prmx.imagen import (
 from prmx.decoration import timer
 from prmx.genres import genres
 from prmx.llm import remove_parenthesized_content
+from PIL import Image
 from pydub import AudioSegment
 import uuid
 
@@ -57,11 +65,18 @@ audience_prompts = [
 # How many preview images do we display per asset?
 ASSET_PREVIEW_IMAGES = 3
 
+# How many scene scripts are generated at the same time: bounded by the OpenAI rate limit of the finetuned model
+SCRIPT_CONCURRENCY = int(environ.get("PRMX_SCRIPT_CONCURRENCY", 4))
+
 # We generate a fallback character, that should not be editable and is used for unrecognized dialog lines
 # The fallback character is used during script->shots translation if the LLM hallucinates a new actor.
 FALLBACK_CHAR_NAME = "Fallback"
 NUM_VOICES_PER_CHARACTER = 3
 
+# How voices and preview images are assigned to all characters or locations without duplicates:
+# "greedy" in list order, or "hungarian" for the best total similarity, see vector_search.assign
+ASSIGNMENT_METHOD = environ.get("PRMX_ASSIGNMENT_METHOD", "greedy")
+
 
 def get_meta(genre_index: int, attributes: list, audience: int) -> str:
     assert genre_index < len(genres) and genre_index >= 0, "unknown genre"
@@ -117,7 +132,11 @@ def get_prompt_for_shot_image(
 
 @timer
 def get_title_plot(
-    genre: int, attributes: list, audience: int, userText: str = ""
+    genre: int,
+    attributes: list,
+    audience: int,
+    userText: str = "",
+    on_token: Optional[Callable[[str, str], None]] = None,
 ) -> dict:
     meta = get_meta(genre, attributes, audience)
     user_instruction = ""
@@ -143,6 +162,7 @@ def get_title_plot(
         load_txt("prmx/prompts/title_plot.txt"),
         {"META": meta, "USER_INSTRUCTION": user_instruction},
         additional_params={"temperature": 1},
+        on_token=on_token,
     )
     scenes = llm.parse_scenes(llm_res["SCENES"])
     return {"title": llm_res["TITLE"], "scenes": scenes}
@@ -226,21 +246,49 @@ def get_voices_urls(speaker_indices: list[int]) -> list[str]:
 def add_id_voice_image_info_to_character(
     characters: list[dict], num_voices_per_character: int
 ) -> list[dict]:
-    # The list of picked voices, used to avoid picking the same voice for multiple characters
-    taken_voice_indices = []
-    # The list of picked characters ids, used to avoid picking the same id for multiple characters
-    taken_character_indices = []
-
-    for character in characters:
-        # assign voices to each character
-        voice_data, new_taken_voice_indices = speech.attribute_voices(
-            name=character["name"],
-            desc=character["desc"],
-            voice_desc=character["voice_desc"],
-            taken_indices=taken_voice_indices,
+    # The set of picked voices, used to avoid picking the same voice for multiple characters
+    taken_voice_indices = set()
+    # The set of picked characters ids, used to avoid picking the same id for multiple characters
+    taken_character_indices = set()
+
+    mock = localContext().config.mock
+    if not mock:
+        # all characters are matched jointly: one embedding batch and one product per library
+        voices = speech.attribute_voices_batch(
+            characters,
             num_voices_per_character=num_voices_per_character,
+            method=ASSIGNMENT_METHOD,
         )
-        taken_voice_indices.extend(new_taken_voice_indices)
+        images = assets.match_assets(
+            "characters",
+            [character["name"] + ". " + character["desc"] for character in characters],
+            ASSET_PREVIEW_IMAGES,
+            method=ASSIGNMENT_METHOD,
+        )
+
+    for i, character in enumerate(characters):
+        if mock:
+            # mocked embeddings are routed by call stack: keep the per-character lookups
+            voice_data, new_taken_voice_indices = speech.attribute_voices(
+                name=character["name"],
+                desc=character["desc"],
+                voice_desc=character["voice_desc"],
+                taken_indices=taken_voice_indices,
+                num_voices_per_character=num_voices_per_character,
+            )
+            taken_voice_indices.update(new_taken_voice_indices)
+            asset_urls, new_taken_character_indices = assets.get_asset_url(
+                emb_type="characters",
+                desc=character["name"] + ". " + character["desc"],
+                n=ASSET_PREVIEW_IMAGES,
+                taken_indices=taken_character_indices,
+            )
+            taken_character_indices.update(new_taken_character_indices)
+        else:
+            voice_data, _ = voices[i]
+            asset_urls, _ = images[i]
+
+        # assign voices to each character
         character["voices"] = voice_data["speaker_indices"]
         character["pitch"] = voice_data["pitch_ratios"][0]
         character["voice_sample_urls"] = get_voices_urls(
@@ -249,19 +297,12 @@ def add_id_voice_image_info_to_character(
         character["selected_voice_index"] = 0
 
         # assign images to each character
-        asset_urls, new_taken_character_indices = assets.get_asset_url(
-            emb_type="characters",
-            desc=character["name"] + ". " + character["desc"],
-            n=ASSET_PREVIEW_IMAGES,
-            taken_indices=taken_character_indices,
-        )
-        taken_character_indices.extend(new_taken_character_indices)
         character["images"] = asset_urls["images_urls"]
         character["embedding_ids"] = asset_urls["ids"]
         character["selected_image_index"] = 0
 
         # assign a uuid to each character
-        if localContext().config.mock:
+        if mock:
             # the character id must be deterministic in mock mode
             mock_characters = util.load_json(f"assets/default/characters.json")
             for mock_character in mock_characters:
@@ -334,15 +375,27 @@ def get_locations(title: str, scenes: list) -> list[dict]:
             model=llm.Llm_model.LOC_FINETUNE,
         ),
     )
-    taken_indices = []
-    for location in locations:
-        asset_urls, new_taken_indices = assets.get_asset_url(
+    if localContext().config.mock:
+        # mocked embeddings are routed by call stack: keep the per-location lookups
+        taken_indices = []
+        matches = []
+        for location in locations:
+            asset_urls, new_taken_indices = assets.get_asset_url(
+                "locations",
+                location["name"] + ". " + location["desc"],
+                ASSET_PREVIEW_IMAGES,
+                taken_indices,
+            )
+            taken_indices.extend(new_taken_indices)
+            matches.append((asset_urls, new_taken_indices))
+    else:
+        matches = assets.match_assets(
             "locations",
-            location["name"] + ". " + location["desc"],
+            [location["name"] + ". " + location["desc"] for location in locations],
             ASSET_PREVIEW_IMAGES,
-            taken_indices,
+            method=ASSIGNMENT_METHOD,
         )
-        taken_indices.extend(new_taken_indices)
+    for location, (asset_urls, _) in zip(locations, matches):
         location["images"] = asset_urls["images_urls"]
         location["selected_image_index"] = 0
     return locations
@@ -357,6 +410,7 @@ def get_script(
     locations: str,
     characters: str,
     scene_id: int,
+    on_token: Optional[Callable[[str, str], None]] = None,
 ) -> list[dict]:
     return llm.llm_api_call(
         prompt_preprocess(
@@ -371,9 +425,39 @@ def get_script(
         ),
         parameters={"max_tokens": 1800},
         model=llm.Llm_model.SCRIPT_FINETUNE,
+        on_token=partial(on_token, "script") if on_token else None,
     )
 
 
+# generate the scripts of all scenes concurrently, yielding (scene_id, script) pairs in completion order
+def get_scripts(
+    genre: int,
+    attributes: list,
+    audience: int,
+    scenes: list,
+    locations: str,
+    characters: str,
+) -> Iterator[Tuple[int, str]]:
+    with concurrent.futures.ThreadPoolExecutor(SCRIPT_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(
+                copy_context().run,
+                llm.retry_on_rate_limit,
+                get_script,
+                genre,
+                attributes,
+                audience,
+                scenes,
+                locations,
+                characters,
+                scene_id,
+            ): scene_id
+            for scene_id in range(len(scenes))
+        }
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
 @timer
 def get_music(scenes: list[dict]) -> list[list[dict] | None]:
     NUMBER_OF_MUSIC = 3  # How many music pieces to return per scene.
@@ -444,6 +528,11 @@ def get_shots(
 
     shot_result = llm.generate_shots(prompt, characters, locations, char_id_mapping)
 
+    if not localContext().config.mock:
+        enrich_shots(shot_result, locations)
+        return shot_result
+
+    # mocked embeddings are recorded per text and routed by call stack: keep the per-shot calls
     # Go through all shots and fill in missing sound information
     for shot in shot_result:
         if shot["dialog"]:
@@ -465,6 +554,45 @@ def get_shots(
     return shot_result
 
 
+# Fills in the emotions of the dialog lines, the ambient sounds and the acoustic environment of all
+# shots at once: all texts are embedded in a single batched call, then each kind is matched against
+# its library in a single matrix product, whatever the number of shots
+def enrich_shots(shots: list[dict], locations: list[dict]) -> None:
+    if not shots:
+        return
+
+    lines = [dialog["line"] for shot in shots for dialog in shot["dialog"] or []]
+    sounds = [shot["sound"] for shot in shots]
+    acoustic_texts = [
+        audio.acoustic_env_text(
+            locations[shot["location"]]["name"],
+            locations[shot["location"]]["desc"],
+            shot["content"],
+        )
+        for shot in shots
+    ]
+
+    embeddings = cached_embeds(lines + sounds + acoustic_texts)
+    line_embeddings = embeddings[: len(lines)]
+    sound_embeddings = embeddings[len(lines) : len(lines) + len(sounds)]
+    acoustic_embeddings = embeddings[len(lines) + len(sounds) :]
+
+    emotions = (
+        speech.emotions_for_embeddings(line_embeddings)["emotions"] if lines else []
+    )
+    sound_urls = audio.ambient_sound_urls_for_embeddings(sound_embeddings, 3)
+    acoustic_envs = audio.acoustic_envs_for_embeddings(acoustic_embeddings)
+
+    # scatter the results back to the shots and their dialog lines, in collection order
+    emotions = iter(emotions)
+    for shot, urls, acoustic_env in zip(shots, sound_urls, acoustic_envs):
+        for dialog in shot["dialog"] or []:
+            dialog["emotion"] = next(emotions)
+        shot["sound_urls"] = urls
+        shot["selected_sound_index"] = 0
+        shot["acoustic_env"] = acoustic_env
+
+
 # This function gets the shot image for a given shot. It is different from get_shot_images function
 # which generates the shot images for all the shots. kwargs are included here to maintain compatibility with the
 # gen_media function in web.py. This gen_media function is common for both speech and image generation.
@@ -474,14 +602,13 @@ def get_shot_image(
     characters: list[dict],
     locations: list[dict],
     draw_dialog: bool = False,
+    on_result: Optional[Callable[[int, dict], None]] = None,
 ) -> list[dict]:
-    prompt_and_mapping = get_prompt_for_shot_image(shot, characters, locations)
-    image, hash_, bounding_boxes = gen_image(prompt_and_mapping)
-    if draw_dialog:
-        image = draw_dialog_on_image(
-            image, shot["dialog"], characters, locations, prompt_and_mapping["prompt"]
+    return aio.run(
+        get_shot_images_async(
+            [shot], characters, locations, draw_dialog, on_result=on_result
         )
-    return [{"image": image, "hash": hash_, "bounding_boxes": bounding_boxes}]
+    )
 
 
 @timer
@@ -490,49 +617,106 @@ def get_shot_images(
     characters: list[dict],
     locations: list[dict],
     draw_dialog: bool = False,
-) -> list[dict]:
-    results = []
+    priority_shots: Optional[list[int]] = None,
+    on_result: Optional[Callable[[int, dict], None]] = None,
+) -> list[Optional[dict]]:
+    return aio.run(
+        get_shot_images_async(
+            shots, characters, locations, draw_dialog, priority_shots, on_result
+        )
+    )
 
-    SINGLE_THREAD = False
 
+# shots are scheduled by priority: the shots in priority_shots first, e.g. the visible ones, then
+# the others in scene order. on_result is called with each shot index and result once it is ready,
+# e.g. to upload it. Shots whose generation or on_result failed are None, unless all failed.
+async def get_shot_images_async(
+    shots: list[dict],
+    characters: list[dict],
+    locations: list[dict],
+    draw_dialog: bool = False,
+    priority_shots: Optional[list[int]] = None,
+    on_result: Optional[Callable[[int, dict], None]] = None,
+) -> list[Optional[dict]]:
     prompt_and_mappings = [
         get_prompt_for_shot_image(shot, characters, locations) for shot in shots
     ]
 
-    if SINGLE_THREAD:
-        for prompt_and_mapping in prompt_and_mappings:
-            image, hash_, bounding_boxes = gen_image(prompt_and_mapping)
-            result = {"image": image, "hash": hash_, "bounding_boxes": bounding_boxes}
-            results.append(result)
-    else:  # one thread per shot, maintain order
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for image, hash_, bounding_boxes in executor.map(
-                gen_image, prompt_and_mappings
-            ):
-                result = {
-                    "image": image,
-                    "hash": hash_,
-                    "bounding_boxes": bounding_boxes,
-                }
-                results.append(result)
+    # shots with the same prompt after reference replacement share a single generation
+    shots_by_prompt = {}
+    for id, p in enumerate(prompt_and_mappings):
+        shots_by_prompt.setdefault(p["prompt"], []).append(id)
+    prompt_shots = list(shots_by_prompt.values())
+    rank = {id: r for r, id in enumerate(priority_shots or [])}
+    priorities = [
+        min((rank.get(id, len(rank)), id) for id in ids) for ids in prompt_shots
+    ]
 
-    if draw_dialog:
-        for id, shot in enumerate(shots):
-            results[id]["image"] = draw_dialog_on_image(
-                results[id]["image"],
-                shot["dialog"],
-                characters,
-                locations,
-                prompt_and_mappings[id]["prompt"],
-            )
+    results = [None] * len(shots)
+
+    async def deliver(job: int, generated: Tuple | Exception) -> None:
+        if isinstance(generated, Exception):
+            print(f"image generation of shots {prompt_shots[job]} failed: {generated}")
+            return
+        image, hash_, bounding_boxes = generated
+        failures = []
+        for id in prompt_shots[job]:
+            # each shot gets its own copies: dialog lines are drawn on the image in place
+            results[id] = {
+                "image": copy_image(image),
+                "hash": hash_,
+                "bounding_boxes": copy.deepcopy(bounding_boxes),
+            }
+            if draw_dialog:
+                results[id]["image"] = draw_dialog_on_image(
+                    results[id]["image"],
+                    shots[id]["dialog"],
+                    characters,
+                    locations,
+                    prompt_and_mappings[id]["prompt"],
+                )
+            if on_result is not None:
+                # callbacks upload files: keep them off the event loop
+                try:
+                    await asyncio.to_thread(on_result, id, results[id])
+                except Exception as e:
+                    # a shot that is not uploaded fails alone, like a failed generation
+                    print(f"delivery of shot {id} failed: {e}")
+                    results[id] = None
+                    failures.append(e)
+        if failures:
+            # the scheduler records the failure as the outcome of the job
+            raise failures[0]
+
+    outcomes = await JobScheduler(aio.CONCURRENCY["image"]).run(
+        [partial(gen_image_async, prompt_and_mappings[ids[0]]) for ids in prompt_shots],
+        priorities,
+        deliver,
+    )
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    if errors and len(errors) == len(outcomes):
+        raise errors[0]
     return results
 
 
+def copy_image(image: Image.Image) -> Image.Image:
+    image_copy = image.copy()
+    # the format is required to encode the image on upload, but not copied by PIL
+    image_copy.format = image.format
+    return image_copy
+
+
 # this function is needed for generating speeches for characters
 # also used in get_line_speech function
 # the hash here won't be used in get_line_speech. this hash is only used for character speeches
 def get_speech_line(
     quote: str, char_id: int, voice: int, emotion: str
+) -> Tuple[AudioSegment, str]:
+    return aio.run(get_speech_line_async(quote, char_id, voice, emotion))
+
+
+async def get_speech_line_async(
+    quote: str, char_id: int, voice: int, emotion: str
 ) -> Tuple[AudioSegment, str]:
     temp_dict = {
         "quote": quote,
@@ -546,16 +730,33 @@ def get_speech_line(
         line = ctx.get_line(hash)
     else:
         voice_data = speech.get_voice_for_speaker_index(voice)
-        speaker = voice_data["speaker"]
-        pitch_ratio = voice_data["pitch_ratio"]
-        line = speech.infer(quote, speaker, emotion)
-        if pitch_ratio != 1.0:
-            line = speech.shift_pitch(line, pitch_ratio)
-        line = speech.butter_lowpass_filter(line)
+        # lines synthesized before with the same inputs are reused, e.g. when re-editing a scene
+        key = speech_cache().key(
+            model=speech.MODEL,
+            quote=quote,
+            speaker=voice_data["speaker"],
+            emotion=emotion,
+            **speech.processing_inputs(voice_data["pitch_ratio"]),
+        )
+        line = await asyncio.to_thread(speech_cache().get, key)
+        if line is None:
+            # lines of concurrent coroutines, e.g. all lines of a scene, share TTS requests
+            line = await speech.tts_batcher().infer(
+                quote, voice_data["speaker"], emotion
+            )
+            # audio processing is cpu-bound: keep it off the event loop
+            line = await asyncio.to_thread(
+                post_process_speech_line, line, voice_data["pitch_ratio"]
+            )
+            await asyncio.to_thread(speech_cache().put, key, line)
 
     return line, hash
 
 
+def post_process_speech_line(line: AudioSegment, pitch_ratio: float) -> AudioSegment:
+    return speech.process_line(line, pitch_ratio)
+
+
 # returns speech line for a single dialog line
 # this gets both shot and line dict as arguments from the web module
 # thus the need for kwargs
@@ -565,12 +766,20 @@ def get_line_speech(
     characters: list[dict],
     locations: list[dict],
     **kwargs,
+) -> Tuple[AudioSegment, str]:
+    return aio.run(get_line_speech_async(line, characters, locations))
+
+
+async def get_line_speech_async(
+    line: dict,
+    characters: list[dict],
+    locations: list[dict],
 ) -> Tuple[AudioSegment, str]:
     ctx = localContext()
     quote = line["line"]
     char_id = line["character_id"]
     if "emotion" not in line:
-        emotion_data = speech.attribute_emotions([quote])
+        emotion_data = await speech.attribute_emotions_async([quote])
         emotion = emotion_data["emotions"][0]
     else:
         emotion = line["emotion"]
@@ -589,7 +798,7 @@ def get_line_speech(
                 character = char
 
         voice = character["voice"]
-        line, _ = get_speech_line(quote, char_id, voice, emotion)
+        line, _ = await get_speech_line_async(quote, char_id, voice, emotion)
 
     return line, hash
 
@@ -598,20 +807,20 @@ def get_line_speech(
 @timer
 def get_shot_speech(
     shot: dict, characters: list[dict], locations: list[dict]
+) -> Tuple[list[AudioSegment], list[str]]:
+    return aio.run(get_shot_speech_async(shot, characters, locations))
+
+
+async def get_shot_speech_async(
+    shot: dict, characters: list[dict], locations: list[dict]
 ) -> Tuple[list[AudioSegment], list[str]]:
     lines = []
-    dialog = shot["dialog"]
     hashes = []
-    if dialog:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for line, hash in executor.map(
-                get_line_speech,
-                dialog,
-                [characters] * len(dialog),
-                [locations] * len(dialog),
-            ):
-                lines.append(line)
-                hashes.append(hash)
+    for line, hash in await asyncio.gather(
+        *[get_line_speech_async(line, characters, locations) for line in shot["dialog"]]
+    ):
+        lines.append(line)
+        hashes.append(hash)
     return lines, hashes
 
 
@@ -620,12 +829,18 @@ def get_shot_speeches(
     shots: list[dict], characters: list[dict], locations: list[dict]
 ) -> Tuple[list[list[AudioSegment]], list[list[str]]]:
     """returns the speech lines per shot and the speech hashes, i.e. shots[lines[AudioSegment, hash]]"""
+    return aio.run(get_shot_speeches_async(shots, characters, locations))
+
+
+# all lines of all shots are requested at once: the aio module bounds the concurrent TTS requests
+async def get_shot_speeches_async(
+    shots: list[dict], characters: list[dict], locations: list[dict]
+) -> Tuple[list[list[AudioSegment]], list[list[str]]]:
     lines = []
     hashes = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for shot_speeches, shot_hashes in executor.map(
-            get_shot_speech, shots, [characters] * len(shots), [locations] * len(shots)
-        ):
-            lines.append(shot_speeches)
-            hashes.append(shot_hashes)
+    for shot_speeches, shot_hashes in await asyncio.gather(
+        *[get_shot_speech_async(shot, characters, locations) for shot in shots]
+    ):
+        lines.append(shot_speeches)
+        hashes.append(shot_hashes)
     return lines, hashes
@@ -1,12 +1,15 @@
 # We generate a list of asset descriptions with GPT and then use the a image model to generate jpg files.
-from functools import lru_cache
+import os
 from os import environ
+from typing import Iterable, Optional
 import numpy as np
-import torch
 from prmx.errors import MockMismatchError
-from prmx.util import get_best_dot_matches
+from prmx.ann import IVFIndex
+from prmx.util import locked_cache
+from prmx.vector_search import VectorIndex, assign
 from prmx.context import localContext
-from download import clip_text_model_paths
+from prmx.embedding_cache import embedding_cache
+from prmx.clip_engine import clip_engine
 
 location_prompt_path = "assets/images/location_prompts.json"
 character_prompt_path = "assets/images/character_prompts.json"
@@ -25,24 +28,45 @@ CLIP_PATHS = {
 }
 
 
-@lru_cache(maxsize=1)
-def load_embeddings(emb_type: str) -> np.ndarray:
+@locked_cache
+def load_embeddings(emb_type: str) -> tuple[VectorIndex, list[str]]:
     numpy_path, text_path = CLIP_PATHS[emb_type]
-    return np.load(numpy_path), open(text_path, "r").read().splitlines()
+    return VectorIndex(np.load(numpy_path)), open(text_path, "r").read().splitlines()
 
 
-assets_clip_tokenizer = None
-assets_clip_model = None
+# Optional IVF indices over the same embeddings, built with precompute/images/gen_asset_index.py
+INDEX_PATHS = {
+    "characters": "assets/images/chars_ivf",
+    "locations": "assets/images/loc_ivf",
+}
+
+
+# the index is memory-mapped: only the probed clusters are read from disk
+@locked_cache
+def load_index(emb_type: str) -> Optional[IVFIndex]:
+    folder = INDEX_PATHS[emb_type]
+    if not os.path.isdir(folder):
+        return None
+    return IVFIndex.load(folder)
 
 
-def initialize_clip() -> None:
-    """Initialize the CLIP model and clip_tokenizer"""
+def encode_clip_texts(texts: list[str]) -> list[np.ndarray]:
+    """Returns the (1, dim) CLIP embeddings of texts, encoding the uncached ones in batches"""
 
-    global assets_clip_tokenizer, assets_clip_model
-    if assets_clip_tokenizer is None:
-        assets_clip_tokenizer = torch.load(clip_text_model_paths["local_tokenizer"])
-    if assets_clip_model is None:
-        assets_clip_model = torch.load(clip_text_model_paths["local_model"])
+    engine = clip_engine()
+    cache = embedding_cache()
+    embeddings = [cache.get(engine.name, text) for text in texts]
+    missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    if missing:
+        encoded = engine.encode(missing)
+        computed = {
+            text: cache.put(engine.name, text, encoded[i : i + 1])
+            for i, text in enumerate(missing)
+        }
+        embeddings = [
+            computed[t] if e is None else e for t, e in zip(texts, embeddings)
+        ]
+    return embeddings
 
 
 def get_clip_text(text: str, emb_type: str) -> np.ndarray:
@@ -51,12 +75,7 @@ def get_clip_text(text: str, emb_type: str) -> np.ndarray:
     ctx = localContext()
 
     if not ctx.config.mock:
-        initialize_clip()
-        with torch.no_grad():
-            text_tokenized = assets_clip_tokenizer(
-                text, padding=True, return_tensors="pt", truncation=True
-            )
-            emb = assets_clip_model(**text_tokenized).text_embeds.numpy()
+        emb = encode_clip_texts([text])[0]
         ctx.save(emb.tolist(), text, prompt=text)
         return np.asarray(emb)
 
@@ -81,18 +100,78 @@ def get_asset_url(
     assert emb_type in ["characters", "locations"]
     clip_embeds, url_list = load_embeddings(emb_type)
     emb_res = get_clip_text(desc, emb_type)  # Takes ~100ms on a laptop CPU
-    # calculate the cosine similarity between the input text and all the embeddings
-    dot_prods = np.dot(clip_embeds, emb_res.T)
-    indices = get_best_dot_matches(dot_prods, n + len(taken_indices))
-
-    # remove indices that have already been taken
-    indices = [idx for idx in indices if idx not in taken_indices]
+    index = load_index(emb_type)
+    if index is not None:
+        # approximate search in the clusters closest to the input text, taken indices excluded
+        indices = [int(idx) for idx in index.search(emb_res, n, exclude=taken_indices)]
+    else:
+        # exact search over all the embeddings, taken indices excluded
+        indices = [
+            int(idx)
+            for idx in clip_embeds.search(emb_res, n, exclude=taken_indices).flatten()
+        ]
 
     assert len(indices) > 0, f"Could not find any {emb_type} for the given description."
 
     # use the first n indices
     indices = indices[:n]
+    return asset_urls(emb_type, indices, url_list), list(indices)
+
 
+def match_assets(
+    emb_type: str,
+    descs: list[str],
+    n: int = 1,
+    taken_indices: Iterable[int] = (),
+    method: str = "greedy",
+) -> list[tuple[dict[str, list[str or int]], list[int]]]:
+    """
+    Joint variant of get_asset_url for all descriptions of a creation, e.g. all its characters:
+    the descriptions are encoded in one batch and scored against the candidate images in one
+    product, then n images are assigned to each description without duplicates, see
+    vector_search.assign. Returns the result of get_asset_url for each description.
+
+    Candidates are retrieved through the IVF index when present: the n * len(descs) best images of
+    each description are enough for any of them to be assigned n images not taken by the others.
+    Otherwise, all the images of the library are candidates.
+    """
+
+    assert emb_type in ["characters", "locations"]
+    if not descs:
+        return []
+    clip_embeds, url_list = load_embeddings(emb_type)
+    queries = np.concatenate(encode_clip_texts(descs))
+    taken_indices = list(taken_indices)
+    index = load_index(emb_type)
+    if index is not None:
+        candidates = np.unique(
+            np.concatenate(
+                [
+                    index.search(query, n * len(descs), exclude=taken_indices)
+                    for query in queries
+                ]
+            )
+        )
+        scores = queries @ np.asarray(clip_embeds[candidates]).T
+        exclude = []
+    else:
+        candidates = np.arange(len(clip_embeds))
+        scores = clip_embeds.scores(queries)
+        exclude = taken_indices
+
+    results = []
+    for assigned in assign(scores, n, exclude=exclude, method=method):
+        indices = [int(candidates[idx]) for idx in assigned]
+        assert (
+            len(indices) > 0
+        ), f"Could not find any {emb_type} for the given description."
+        results.append((asset_urls(emb_type, indices, url_list), indices))
+    return results
+
+
+def asset_urls(
+    emb_type: str, indices: list[int], url_list: list[str]
+) -> dict[str, list[str or int]]:
     urls = [
         f"{environ['PRECOMPUTE_ASSET_VER']}/{emb_type}/{url_list[idx][:-4]}.jpg"
         for idx in indices
@@ -105,4 +184,4 @@ def get_asset_url(
     if emb_type == "characters":
         data_to_return["ids"] = [int(url_list[idx][:-4]) for idx in indices]
 
-    return data_to_return, list(indices)
+    return data_to_return
@@ -1,11 +1,11 @@
 import json
-from functools import lru_cache
 from os import environ
 import numpy as np
 from prmx.genres import genres
 from prmx.llm import generate_descriptions
-from prmx.util import get_best_dot_matches
+from prmx.util import locked_cache
 from prmx.text_embeddings import text_embed_api_call
+from prmx.vector_search import VectorIndex
 
 acoustic_env_embeddings_path = "assets/audio/acoustic_env_embeddings.npy"
 acoustic_environments = {
@@ -67,37 +67,47 @@ def calculate_acoustic_env_embeddings():
     np.save(acoustic_env_embeddings_path, np.array(emb_list))
 
 
-@lru_cache(maxsize=1)
-def load_audio_embeddings():
-    return np.load("assets/audio/audio_embeddings.npy")
+# embeddings are normalized once at load time for cosine similarity lookups
+@locked_cache
+def load_audio_embeddings() -> VectorIndex:
+    return VectorIndex(np.load("assets/audio/audio_embeddings.npy"), cosine=True)
 
 
-@lru_cache(maxsize=1)
-def load_acoustic_env_embeddings():
-    return np.load(acoustic_env_embeddings_path)
+@locked_cache
+def load_acoustic_env_embeddings() -> VectorIndex:
+    return VectorIndex(np.load(acoustic_env_embeddings_path), cosine=True)
 
 
 def get_ambient_sound_url(sound_desc: str, n: int = 1) -> list[str]:
-    audio_embeds = load_audio_embeddings()
     # calculate the embedding of the input text
     emb_res = text_embed_api_call(sound_desc).data[0].embedding
-    # calculate the cosine similarity between the input text and all the audio embeddings
-    dot_prods = np.dot(audio_embeds, emb_res) / (
-        np.linalg.norm(audio_embeds, axis=1) * np.linalg.norm(emb_res)
-    )
+    return ambient_sound_urls_for_embeddings([emb_res], n)[0]
+
+
+# find the n audio embeddings with the best cosine similarity to each input text embedding
+def ambient_sound_urls_for_embeddings(
+    embeddings: list[np.ndarray], n: int = 1
+) -> list[list[str]]:
+    indices = load_audio_embeddings().search(embeddings, n)
+    return [
+        [f"{environ['PRECOMPUTE_SOUND_VER']}/{idx}.ogg" for idx in row]
+        for row in indices
+    ]
+
 
-    indices = get_best_dot_matches(dot_prods, n)
-    return [f"{environ['PRECOMPUTE_SOUND_VER']}/{idx}.ogg" for idx in indices]
+def acoustic_env_text(location_name: str, location_desc: str, shot_content: str) -> str:
+    return f"{location_name}: {location_desc}, {shot_content}"
 
 
 def get_acoustic_env(location_name: str, location_desc: str, shot_content: str) -> str:
-    acoustic_embeds = load_acoustic_env_embeddings()
     # calculate the embedding of the input text
-    input_text = f"{location_name}: {location_desc}, {shot_content}"
+    input_text = acoustic_env_text(location_name, location_desc, shot_content)
     emb_res = text_embed_api_call(input_text).data[0].embedding
-    # calculate the cosine similarity between the input text and all the audio embeddings
-    dot_prods = np.dot(acoustic_embeds, emb_res) / (
-        np.linalg.norm(acoustic_embeds, axis=1) * np.linalg.norm(emb_res)
-    )
-    index = np.argmax(dot_prods)
-    return list(acoustic_environments.keys())[index]
+    return acoustic_envs_for_embeddings([emb_res])[0]
+
+
+# find the acoustic environment with the best cosine similarity to each input text embedding
+def acoustic_envs_for_embeddings(embeddings: list[np.ndarray]) -> list[str]:
+    indices = load_acoustic_env_embeddings().search(embeddings, 1)[:, 0]
+    names = list(acoustic_environments.keys())
+    return [names[index] for index in indices]
@@ -0,0 +1,154 @@
+"""CLIP text encoder of the asset descriptions, loaded once per worker and run on batches of texts
+
+The tokenizer and text tower are the pickled artifacts of download.py. The engine runs one of the
+PRMX_CLIP_VARIANT variants on CPU:
+- "fp32": the original model
+- "int8": the linear layers dynamically quantized to int8, about twice faster and four times smaller
+- "onnx": the fp32 model exported once to ONNX and run by onnxruntime, which is an optional
+  dependency of this variant only
+
+Quantized variants drift slightly from the fp32 embeddings the asset library was matched with:
+compare them with precompute/images/benchmark_clip_engine.py before switching. Their embeddings are
+cached under their own model name, see ClipTextEngine.name.
+
+Torch intra-op threads are set with PRMX_CLIP_THREADS, e.g. to the vCPUs of a worker divided by the
+gunicorn workers per instance, and default to the torch setting.
+"""
+
+import os
+import threading
+from functools import cache
+from typing import Sequence
+import numpy as np
+import torch
+from download import CACHE_DIR, CLIP_TEXT_MODEL, clip_text_model_paths
+
+CLIP_VARIANTS = ["fp32", "int8", "onnx"]
+CLIP_VARIANT = os.environ.get("PRMX_CLIP_VARIANT", "fp32")
+CLIP_THREADS = os.environ.get("PRMX_CLIP_THREADS")
+# descriptions per forward pass: all characters or locations of a creation fit in one batch
+CLIP_BATCH_SIZE = int(os.environ.get("PRMX_CLIP_BATCH_SIZE", 32))
+CLIP_ONNX_PATH = f"{CACHE_DIR}/{CLIP_TEXT_MODEL}_CLIPTextModelWithProjection.onnx"
+
+
+# text embeddings of the text tower, as the only output of the ONNX graph
+class TextEmbeds(torch.nn.Module):
+    def __init__(self, model: torch.nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+
+class ClipTextEngine:
+    def __init__(
+        self,
+        variant: str = CLIP_VARIANT,
+        batch_size: int = CLIP_BATCH_SIZE,
+        paths: dict[str, str] = clip_text_model_paths,
+        onnx_path: str = CLIP_ONNX_PATH,
+    ):
+        assert variant in CLIP_VARIANTS, f"unknown CLIP variant {variant}"
+        self.variant = variant
+        self.batch_size = batch_size
+        self.paths = paths
+        self.onnx_path = onnx_path
+        self.tokenizer = None
+        self.model = None
+        self.session = None
+        # concurrent request threads must not load the model twice, nor use it half-initialized
+        self.lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        """model name of the embeddings, the fp32 embeddings keep the name of the CLIP model"""
+        if self.variant == "fp32":
+            return CLIP_TEXT_MODEL
+        return f"{CLIP_TEXT_MODEL}:{self.variant}"
+
+    def load(self) -> "ClipTextEngine":
+        with self.lock:
+            if self.tokenizer is not None:
+                return self
+            if CLIP_THREADS:
+                torch.set_num_threads(int(CLIP_THREADS))
+
+            model = torch.load(self.paths["local_model"], weights_only=False)
+            model.eval()
+            if self.variant == "int8":
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+            tokenizer = torch.load(self.paths["local_tokenizer"], weights_only=False)
+            if self.variant == "onnx":
+                self.session = self.onnx_session(model, tokenizer)
+            else:
+                self.model = model
+            # set last: it marks the engine as loaded
+            self.tokenizer = tokenizer
+        return self
+
+    def onnx_session(self, model: torch.nn.Module, tokenizer):
+        # optional dependency: only required by the onnx variant
+        import onnxruntime
+
+        if not os.path.exists(self.onnx_path):
+            export_onnx(model, tokenizer, self.onnx_path)
+        options = onnxruntime.SessionOptions()
+        if CLIP_THREADS:
+            options.intra_op_num_threads = int(CLIP_THREADS)
+        return onnxruntime.InferenceSession(
+            self.onnx_path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        """returns the (len(texts), dim) float32 embeddings of texts, batch by batch"""
+        self.load()
+        batches = [
+            self.encode_batch(texts[i : i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.concatenate(batches) if batches else np.zeros((0, 0), np.float32)
+
+    def encode_batch(self, texts: Sequence[str]) -> np.ndarray:
+        # the text tower pools the end token, unaffected by the padding after it
+        tokens = self.tokenizer(
+            list(texts), padding=True, return_tensors="pt", truncation=True
+        )
+        if self.session is not None:
+            (embeds,) = self.session.run(
+                None,
+                {
+                    "input_ids": tokens["input_ids"].numpy(),
+                    "attention_mask": tokens["attention_mask"].numpy(),
+                },
+            )
+            return embeds.astype(np.float32, copy=False)
+        with torch.no_grad():
+            return self.model(**tokens).text_embeds.numpy().astype(np.float32)
+
+
+def export_onnx(model: torch.nn.Module, tokenizer, path: str) -> None:
+    """exports the fp32 text tower with dynamic batch and sequence axes"""
+    tokens = tokenizer(["a photo of a cat"], padding=True, return_tensors="pt")
+    dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}}
+    dynamic_axes["attention_mask"] = dynamic_axes["input_ids"]
+    # export to a temporary file first: concurrent workers never load a partial graph
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        TextEmbeds(model),
+        (tokens["input_ids"], tokens["attention_mask"]),
+        tmp_path,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["text_embeds"],
+        dynamic_axes={**dynamic_axes, "text_embeds": {0: "batch"}},
+        opset_version=14,
+    )
+    os.replace(tmp_path, path)
+
+
+# process-wide engine, loaded by web.preload before a worker serves requests
+@cache
+def clip_engine(variant: str = CLIP_VARIANT) -> ClipTextEngine:
+    return ClipTextEngine(variant)
@@ -9,7 +9,9 @@ import yaml
 import sys
 from PIL import Image
 from pydub import AudioSegment
-from typing import Any
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
 from prmx.datastore_local import DatastoreLocal
 import pickle
 
@@ -21,6 +23,14 @@ MOCK_CONFIG = {
 }
 
 
+# overrides of PRMX_PROFILE and PRMX_CID for the current request: unlike environment variables, they
+# are isolated between requests served concurrently by the threads of a process
+scoped_variables = {
+    "PRMX_PROFILE": ContextVar("PRMX_PROFILE", default=None),
+    "PRMX_CID": ContextVar("PRMX_CID", default=None),
+}
+
+
 # runtime configuration managing environment variables for loose function coupling
 class Config:
     """Entrypoint to runtime configuration.
@@ -32,6 +42,8 @@ class Config:
        it doesn't override the environment variable.
 
     The same applies to PRMX_CID.
+    Within a scoped_config block, e.g. while serving a request, its profile and cid take precedence
+    over the environment, which is never written: requests served concurrently are isolated.
     """
 
     def __init__(self, profile: str = None, cid: str = None, force: bool = False):
@@ -63,14 +75,40 @@ class Config:
         self, value: str, variable: str, default: str = "default", force: bool = False
     ) -> str:
         if value:
-            if variable not in os.environ or force:
+            if scoped_variables[variable].get():
+                # isolated mode within a scope, whose value is only overridden in this object
+                pass
+            elif variable not in os.environ or force:
                 # do not override runtime config but share it when not set, unless force is True
                 os.environ[variable] = value
+        elif variable in scoped_variables and scoped_variables[variable].get():
+            value = scoped_variables[variable].get()
         else:
             value = os.environ.get(variable, default).lower()
         return value
 
 
+@contextmanager
+def scoped_config(profile: str = None, cid: str = None) -> Iterator[None]:
+    """overrides the environment configuration in the current thread or task, e.g.
+
+    >>> with scoped_config(profile="mock", cid="default"):
+    ...     assert Config().mock
+
+    Threads started in the scope do not inherit it: submit work with contextvars.copy_context().run
+    """
+    tokens = [
+        (scoped_variables[variable], scoped_variables[variable].set(value))
+        for variable, value in [("PRMX_PROFILE", profile), ("PRMX_CID", cid)]
+        if value
+    ]
+    try:
+        yield
+    finally:
+        for variable, token in reversed(tokens):
+            variable.reset(token)
+
+
 # wrapper over Config & Tracker to resolve logged output path & mock input routing of API calls
 class Context:
     ASSETS_DIR = "assets"
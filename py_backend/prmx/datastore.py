@@ -1,16 +1,18 @@
 """Data interface abstracting filmmaking from reads & writes in the production, cloud setting"""
 
-import io
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
 from typing import Union, Optional
 from PIL.Image import Image
 from firebase_admin import firestore, storage
-from google.cloud.firestore_v1.batch import WriteBatch
 from google.cloud.firestore_v1.collection import CollectionReference
 from google.cloud.firestore_v1.document import DocumentReference
 from google.cloud.storage import Bucket
-from google.cloud.storage.blob import Blob
 from pydub import AudioSegment
+from prmx.media_uploader import MediaUpload, MediaUploader
 from prmx.util import gcp_project_id
 
 
@@ -20,6 +22,20 @@ def client(bucket_prefix: str) -> Bucket:
     return storage.bucket(name=f"{bucket_prefix}-{gcp_project_id()}")
 
 
+# shared by all media uploads of a process, through the client of the media bucket
+@cache
+def media_uploader() -> MediaUploader:
+    return MediaUploader(lambda: client("media"))
+
+
+# Firestore rejects batches of more than 500 writes
+MAX_BATCH_WRITES = 500
+# batches of a single save write distinct documents: they are committed concurrently
+COMMIT_WORKERS = int(os.environ.get("PRMX_FIRESTORE_COMMIT_WORKERS", 8))
+# fields and subcollections of a document are loaded concurrently
+LOAD_WORKERS = int(os.environ.get("PRMX_FIRESTORE_LOAD_WORKERS", 8))
+
+
 def build_saving_ref(
     name: str, path: DocumentReference, is_collection: bool
 ) -> tuple[str, Union[DocumentReference, CollectionReference]]:
@@ -43,6 +59,107 @@ def build_saving_ref(
     return name, path
 
 
+# dialogs, dicts with keys 'emotion', 'id' and 'line', should not be stored as a collection
+# dict with name voices should also not be stored as a collection
+def is_collection(name: str, result: Union[str, int, float, dict, list]) -> bool:
+    return (
+        type(result) is list
+        and len(result) > 0
+        and "voices" not in name
+        and type(result[0]) is dict
+        and sorted(list(result[0])) != ["character_id", "emotion", "line"]
+    )
+
+
+def plan_writes(
+    name: str,
+    result: Union[str, int, float, dict, list],
+    path: DocumentReference,
+    writes: Optional[dict[str, tuple[DocumentReference, dict]]] = None,
+) -> dict[str, tuple[DocumentReference, dict]]:
+    """recursively flattens a data structure into the fields to merge in each document
+
+    Returns
+    -------
+    dict
+        (document reference, fields) by document path, in the order documents are first written.
+        Fields written several times to the same document keep their last value.
+    """
+    result_type = type(result)
+    assert result_type in [
+        str,
+        int,
+        float,
+        dict,
+        list,
+    ], f"unsupported type {result_type} for {result}"
+    assert (
+        name != "" or result_type is dict
+    ), f"empty name for {result_type} {result}: can only be empty with a dict."
+
+    if writes is None:
+        writes = {}
+
+    collection = is_collection(name, result)
+    name, path = build_saving_ref(name, path, collection)
+
+    if collection:
+        for i, item in enumerate(result):
+            # saving list items as ordered and indexed documents in the last collection
+            plan_writes("", item, path.document(str(i)), writes)
+
+    elif result_type is dict:
+        for key, value in result.items():
+            plan_writes(key, value, path, writes)
+
+    else:
+        _, fields = writes.setdefault(path.path, (path, {}))
+        fields[name] = result
+
+    return writes
+
+
+# documents of a collection sorted by their integer ids, i.e. by list index
+def load_collection(
+    collection: CollectionReference, fields: Optional[list[str]] = None
+) -> list[dict]:
+    query = collection.select(fields) if fields else collection
+    docs = sorted(query.get(), key=lambda doc: int(doc.id))
+    return [doc.to_dict() for doc in docs]
+
+
+def fetch_references(
+    path: DocumentReference,
+    keys: list[str],
+    collections: Optional[list[str]],
+    field_masks: dict[str, list[str]],
+) -> tuple[dict, dict]:
+    """fetches the fields of a document and its subcollections named in keys, all concurrently,
+    and returns them apart
+    """
+    with ThreadPoolExecutor(LOAD_WORKERS) as executor:
+        # only fields in keys are retrieved, subcollections are not
+        doc = executor.submit(path.get, keys)
+        if collections is None:
+            collections = [collection.id for collection in path.collections()]
+        docs = {
+            key: executor.submit(
+                load_collection, path.collection(key), field_masks.get(key)
+            )
+            for key in keys
+            if key in collections
+        }
+
+        subcollections = {}
+        for key, future in docs.items():
+            # a collection without documents does not exist in Firestore: key may be a field
+            if loaded := future.result():
+                subcollections[key] = loaded
+        fields = doc.result().to_dict() if doc.result().exists else {}
+
+    return fields, subcollections
+
+
 class DataStore:
     def __init__(self) -> None:
         # Folder where we store temporary files about the creation
@@ -54,25 +171,59 @@ class DataStore:
         return f"{uid}/{cid}/{path}"
 
     def put_image(self, uid: str, cid: str, image: Image, hash: str) -> str:
-        mem_file = io.BytesIO()
-        image.save(mem_file, format=image.format)
-        mem_file.seek(0)  # upload stream must be at the beginning
-        bucket = client("media")
-        key = self.media_path(uid, cid, f"{hash}.png")
-        print(f"uploading {key} to {bucket.name}")
-        blob = Blob(key, bucket)
-        blob.upload_from_file(mem_file, content_type="image/png")
-        return key
+        return self.put_images(uid, cid, [(image, hash)])[0]
+
+    def put_images(
+        self, uid: str, cid: str, images: list[tuple[Image, str]]
+    ) -> list[str]:
+        """uploads images concurrently, see MediaUploader, and returns their keys"""
+        return media_uploader().upload_all(
+            [self.image_upload(uid, cid, image, hash) for image, hash in images]
+        )
+
+    def image_upload(self, uid: str, cid: str, image: Image, hash: str) -> MediaUpload:
+        # the media key only depends on the prompt: an existing file is only kept if its pixels
+        # are the same, e.g. an image served by the image cache, and the encoding is skipped too
+        pixels_hash = hashlib.sha256(
+            f"{image.mode}{image.size}".encode() + image.tobytes()
+        ).hexdigest()
+        return MediaUpload(
+            key=self.media_path(uid, cid, f"{hash}.png"),
+            content_type="image/png",
+            fingerprint={"pixels_hash": pixels_hash},
+            encode=lambda file: image.save(file, format=image.format),
+        )
 
     def put_speech(self, uid: str, cid: str, speech: AudioSegment, hash: str) -> str:
-        mem_file = io.BytesIO()
-        speech.export(mem_file, format="mp3")
-        mem_file.seek(0)
-        bucket = client("media")
-        key = self.media_path(uid, cid, f"{hash}.mp3")
-        print(f"uploading {key} to {bucket.name}")
-        Blob(key, bucket).upload_from_file(mem_file, content_type="audio/mpeg")
-        return key
+        return self.put_speeches(uid, cid, [(speech, hash)])[0]
+
+    def put_speeches(
+        self, uid: str, cid: str, speeches: list[tuple[AudioSegment, str]]
+    ) -> list[str]:
+        """uploads speech lines concurrently, see MediaUploader, and returns their keys"""
+        return media_uploader().upload_all(
+            [self.speech_upload(uid, cid, speech, hash) for speech, hash in speeches]
+        )
+
+    def speech_upload(
+        self, uid: str, cid: str, speech: AudioSegment, hash: str
+    ) -> MediaUpload:
+        # the media key does not depend on the voice: an existing file is only kept if its samples
+        # are the same, e.g. a line served by the speech cache, and the export is skipped too
+        samples_hash = hashlib.sha256(speech.raw_data).hexdigest()
+
+        # pydub encodes with ffmpeg into a temporary file and seeks the output stream: the mp3 data
+        # is copied from the temporary file instead
+        def encode(file):
+            with speech.export(format="mp3") as mp3:
+                shutil.copyfileobj(mp3, file)
+
+        return MediaUpload(
+            key=self.media_path(uid, cid, f"{hash}.mp3"),
+            content_type="audio/mpeg",
+            fingerprint={"samples_hash": samples_hash},
+            encode=encode,
+        )
 
     def runtime_path(self, uid: str, cid: str, name: str) -> DocumentReference:
         return (
@@ -83,60 +234,35 @@ class DataStore:
             .document(cid)
         )
 
-    # recursively map a data structure to Firestore documents and save in a single batch
+    # map a data structure to Firestore documents and save them in as few batched commits as possible
     def save(
         self,
         uid: str,
         cid: str,
         name: str,
         result: Union[str, int, float, dict, list],
-        batch: Optional[WriteBatch] = None,
         path: Optional[DocumentReference] = None,
-    ) -> None:
-        result_type = type(result)
-        assert result_type in [
-            str,
-            int,
-            float,
-            dict,
-            list,
-        ], f"unsupported type {result_type} for {result}"
-        assert (
-            name != "" or result_type is dict
-        ), f"empty name for {result_type} {result}: can only be empty with a dict."
-
-        # dialogs, dicts with keys 'emotion', 'id' and 'line', should not be stored as a collection
-        # dict with name voices should also not be stored as a collection
-        is_collection = (
-            result_type is list
-            and len(result) > 0
-            and "voices" not in name
-            and type(result[0]) is dict
-            and sorted(list(result[0])) != ["character_id", "emotion", "line"]
-        )
-
-        if batch is None:
-            batch = firestore.client().batch()
+    ) -> dict:
+        """returns the number of document writes and of committed batches"""
         if path is None:
             path = self.runtime_path(uid, cid, "creations")
 
-        name, path = build_saving_ref(name, path, is_collection)
-
-        if is_collection:
-            for i, item in enumerate(result):
-                # saving list items as ordered and indexed documents in the last collection
-                self.save(uid, cid, "", item, batch=batch, path=path.document(str(i)))
-
-        elif result_type is dict:
-            for key, value in result.items():
-                self.save(uid, cid, key, value, batch=batch, path=path)
+        writes = list(plan_writes(name, result, path).values())
+        batches = []
+        for start in range(0, len(writes), MAX_BATCH_WRITES):
+            batch = firestore.client().batch()
+            for ref, fields in writes[start : start + MAX_BATCH_WRITES]:
+                batch.set(ref, fields, merge=True)
+            batches.append(batch)
 
-        else:
-            if name:
-                result = {name: result}
-            batch.set(path, result, merge=True)
+        if len(batches) > 1:
+            # each document is written once, in a single batch: commit order does not matter
+            with ThreadPoolExecutor(min(COMMIT_WORKERS, len(batches))) as executor:
+                list(executor.map(lambda batch: batch.commit(), batches))
+        elif batches:
+            batches[0].commit()
 
-        batch.commit()
+        return {"writes": len(writes), "batches": len(batches)}
 
     def load(
         self,
@@ -144,8 +270,10 @@ class DataStore:
         cid: str,
         name: Union[str, list[str]],
         path: Optional[DocumentReference] = None,
+        collections: Optional[list[str]] = None,
+        field_masks: dict[str, list[str]] = {},
     ) -> dict:
-        """load references from Firestore
+        """load references from Firestore: fields and subcollections are fetched concurrently
 
         Parameters
         ----------
@@ -160,6 +288,13 @@ class DataStore:
             - a list of strings combining the two aforementioned cases
             - a dot-separated string to load a nested field or collection like 'scenes.0.shots':
             this notation is targeted, it is not supported in a list
+        collections : list[str], optional
+            names of the subcollections of the loaded document when the layout is known, which
+            saves listing them: names found neither as fields nor as known collections are looked
+            up again after listing the subcollections
+        field_masks : dict[str, list[str]], optional
+            fields to retrieve in the documents of a subcollection, e.g. {"shots": ["dialog"]}:
+            all fields are retrieved for subcollections without a mask
         """
         if path is None:
             path = self.runtime_path(uid, cid, "creations")
@@ -174,30 +309,22 @@ class DataStore:
                     path = path.document(names.pop(0))
             name = names[0]
 
-        subcollections = [collection.id for collection in path.collections()]
         keys = name if name_type is list else [name]
-        doc = path.get(
-            keys
-        )  # only fields in keys are retrieved, subcollections are not
-
-        data = {}
-        for key in keys:
-            if key in subcollections:
-                docs = path.collection(key).get()
-                docs_dict = [
-                    (doc.id, doc.to_dict()) for doc in docs
-                ]  # Creating a list of tuples
-                # Sort the documents based on document id/path
-                sorted_docs_dict = sorted(docs_dict, key=lambda x: int(x[0]))
-
-                # Get the sorted list of documents
-                sorted_docs = [doc[1] for doc in sorted_docs_dict]
-
-                data[key] = sorted_docs
-
-        if doc.exists:
-            data.update(doc.to_dict())
-        elif not data:
+        fields, subcollections = fetch_references(path, keys, collections, field_masks)
+
+        not_found = [
+            key for key in keys if key not in fields and key not in subcollections
+        ]
+        if collections is not None and not_found:
+            # the layout given by the caller may be outdated for this document
+            more_fields, more_subcollections = fetch_references(
+                path, not_found, None, field_masks
+            )
+            fields.update(more_fields)
+            subcollections.update(more_subcollections)
+        data = {**subcollections, **fields}
+
+        if not data:
             print(
                 f"reference 'creators/{uid}/creations/{cid}/<path>/{name}' not found in database"
             )
@@ -0,0 +1,99 @@
+"""Size-bounded folder of cache files, used by the disk tiers of the embedding, speech and image caches
+
+On Cloud Run the filesystem is held in memory, so an unbounded cache folder grows until the
+instance runs out of memory. Once a write takes the folder over max_bytes, the least recently used
+entries are deleted until it is back under LOW_WATERMARK of the bound, so that evictions are not
+repeated on every write. An entry is all the files sharing a name without extension, e.g. the PNG
+and json files of an image, and is evicted as a whole.
+
+Several workers may share a folder: reads touch the files of an entry, so that recency is shared,
+and the size tracked by a process is replaced by a scan of the folder on eviction, so that the
+writes of the other workers are accounted for. Readers of an evicted entry get a FileNotFoundError,
+to be handled as a miss.
+"""
+
+import os
+import threading
+from typing import Optional
+
+LOW_WATERMARK = 0.8
+
+
+class DiskTier:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # scanned on the first write: the folder may be filled by previous processes
+        self.size: Optional[int] = None
+        self.evictions = 0
+
+    # write to a unique temporary file first: readers never see a partial file
+    def write(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self.scan().values())
+            else:
+                self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def touch(self, *paths: str) -> None:
+        """marks the entry of paths as recently used"""
+        for path in paths:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # evicted by another worker in the meantime
+                pass
+
+    # returns the last use time, total size and paths of each entry, keyed by path without extension
+    def scan(self) -> dict[str, tuple[float, int, list[str]]]:
+        entries = {}
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".tmp"):
+                    # being written
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entry = os.path.splitext(path)[0]
+                used, size, paths = entries.get(entry, (0, 0, []))
+                entries[entry] = (
+                    max(used, stat.st_mtime),
+                    size + stat.st_size,
+                    paths + [path],
+                )
+        return entries
+
+    # must be called with the lock held
+    def evict(self) -> None:
+        entries = sorted(self.scan().values())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, paths in entries:
+            if self.size <= self.max_bytes * LOW_WATERMARK:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "disk_size": self.size or 0,
+                "disk_max_size": self.max_bytes,
+                "disk_evictions": self.evictions,
+            }
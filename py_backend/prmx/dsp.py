@@ -0,0 +1,71 @@
+"""Post-processing chain of the TTS output on NumPy sample buffers
+
+Samples are read from an AudioSegment without a copy, converted once to float32, processed by
+each step of the chain, see speech.process_line, and only converted back into an AudioSegment at
+the end. Filter coefficients are designed once per sample rate, cutoff and order, as second-order
+sections which are numerically stable at high orders.
+"""
+
+from functools import cache
+import numpy as np
+from pydub import AudioSegment
+from scipy.signal import butter, sosfilt
+
+# numpy types of the signed integer samples of an AudioSegment, by sample width in bytes
+SAMPLE_TYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def segment_samples(segment: AudioSegment) -> np.ndarray:
+    """read-only (n_samples, n_channels) integer view of the samples of a segment"""
+    samples = np.frombuffer(segment.raw_data, dtype=SAMPLE_TYPES[segment.sample_width])
+    return samples.reshape(-1, segment.channels)
+
+
+def full_scale(sample_width: int) -> float:
+    # e.g. 32768 for 16-bit samples, i.e. 2^15
+    return float(2 ** (8 * sample_width - 1))
+
+
+def to_float(samples: np.ndarray, sample_width: int = 2) -> np.ndarray:
+    """integer samples to float32 samples in [-1, 1), in a single new buffer"""
+    floats = samples.astype(np.float32)
+    floats *= 1 / full_scale(sample_width)
+    return floats
+
+
+def to_segment(
+    samples: np.ndarray, sample_rate: int, sample_width: int = 2
+) -> AudioSegment:
+    """(n_samples, n_channels) float samples to an AudioSegment, the samples are overwritten"""
+    scale = full_scale(sample_width)
+    samples *= scale
+    np.clip(samples, -scale, scale - 1, out=samples)
+    return AudioSegment(
+        samples.astype(SAMPLE_TYPES[sample_width]).tobytes(),
+        frame_rate=sample_rate,
+        sample_width=sample_width,
+        channels=samples.shape[1],
+    )
+
+
+@cache
+def lowpass_sos(sample_rate: int, cutoff_freq: float, order: int) -> np.ndarray:
+    # the cutoff frequency is normalized to the Nyquist frequency, half of the sampling rate
+    nyquist = 0.5 * sample_rate
+    return butter(order, cutoff_freq / nyquist, btype="low", output="sos")
+
+
+def lowpass(
+    samples: np.ndarray, sample_rate: int, cutoff_freq: float = 6000, order: int = 5
+) -> np.ndarray:
+    """Butterworth low-pass filter of (n_samples, n_channels) float samples"""
+    sos = lowpass_sos(sample_rate, float(cutoff_freq), order)
+    return sosfilt(sos, samples, axis=0).astype(np.float32, copy=False)
+
+
+def normalize_peak(samples: np.ndarray, peak_dbfs: float) -> np.ndarray:
+    """scales float samples in place so that their peak is at peak_dbfs, e.g. -1.0"""
+    peak = np.max(np.abs(samples), initial=0.0)
+    if peak > 0:
+        samples *= 10 ** (peak_dbfs / 20) / peak
+    return samples
@@ -0,0 +1,117 @@
+"""Content-addressed cache of embedding vectors, shared by text and image embedding lookups
+
+Vectors are keyed by the embedding model name and a hash of the embedded text, in two tiers:
+- an in-process LRU tier, bounded to PRMX_EMBED_CACHE_SIZE vectors
+- an on-disk tier under PRMX_EMBED_CACHE_DIR with one float32 .npy file per vector, memory-mapped
+  when read. Files are written atomically, so that several workers can share the same folder, and
+  the least recently used ones are evicted beyond PRMX_EMBED_CACHE_MAX_BYTES.
+"""
+
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import cache
+from typing import Optional
+import numpy as np
+from prmx import util
+from prmx.disk_cache import DiskTier
+
+EMBED_CACHE_DIR = os.environ.get("PRMX_EMBED_CACHE_DIR", "runtime/embedding_cache")
+EMBED_CACHE_SIZE = int(os.environ.get("PRMX_EMBED_CACHE_SIZE", 4096))
+EMBED_CACHE_MAX_BYTES = int(os.environ.get("PRMX_EMBED_CACHE_MAX_BYTES", 64 * 2**20))
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        root: str = EMBED_CACHE_DIR,
+        max_entries: int = EMBED_CACHE_SIZE,
+        max_bytes: int = EMBED_CACHE_MAX_BYTES,
+    ):
+        self.root = root
+        self.max_entries = max_entries
+        self.disk = DiskTier(root, max_bytes)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # hits: served from memory, disk_hits: served from disk, misses: to be computed by the caller
+        self.counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "evictions": 0,
+        }
+
+    def key(self, model: str, text: str) -> str:
+        return util.hash({"model": model, "text": text}, num_digits=32)
+
+    def path(self, model: str, key: str) -> str:
+        # model names like "laion/CLIP-ViT-H-14" or "ft:gpt-3.5:..." are not valid folder names
+        folder = re.sub(r"[^A-Za-z0-9_.-]", "_", model)
+        return os.path.join(self.root, folder, key[:2], f"{key}.npy")
+
+    def get(self, model: str, text: str) -> Optional[np.ndarray]:
+        """returns the cached embedding of text, or None if it has never been computed"""
+        key = self.key(model, text)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return self.entries[key]
+
+        path = self.path(model, key)
+        try:
+            vector = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            with self.lock:
+                self.counters["misses"] += 1
+            return None
+
+        self.disk.touch(path)
+        with self.lock:
+            self.counters["disk_hits"] += 1
+            self.remember(key, vector)
+        return vector
+
+    def put(self, model: str, text: str, vector: np.ndarray) -> np.ndarray:
+        """stores the embedding of text in both tiers and returns it as a float32 array"""
+        vector = np.ascontiguousarray(vector, dtype=np.float32)
+        key = self.key(model, text)
+        path = self.path(model, key)
+
+        if os.path.exists(path):
+            self.disk.touch(path)
+        else:
+            mem_file = io.BytesIO()
+            np.save(mem_file, vector)
+            self.disk.write(path, mem_file.getvalue())
+
+        with self.lock:
+            self.counters["writes"] += 1
+            self.remember(key, vector)
+        return vector
+
+    # must be called with the lock held
+    def remember(self, key: str, vector: np.ndarray) -> None:
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self) -> dict[str, int]:
+        """returns the hit, miss and eviction counters along with the memory and disk sizes"""
+        with self.lock:
+            counters = self.counters | {
+                "size": len(self.entries),
+                "max_size": self.max_entries,
+            }
+        return counters | self.disk.stats()
+
+
+# process-wide cache instance shared by all embedding lookups
+@cache
+def embedding_cache() -> EmbeddingCache:
+    return EmbeddingCache()
@@ -0,0 +1,120 @@
+"""Cache of generated shot images, so that unchanged prompts skip stable-diffusion inference
+
+Images are keyed by a hash of the model inputs, i.e. the prompt, and of IMAGE_MODEL_VERSION, to be
+bumped when the stable-diffusion host is redeployed with other weights. Each entry is the PNG file
+returned by the model and its bounding boxes, with character names not yet translated into the
+character ids of a creation. Entries are stored in two tiers:
+- an on-disk tier under PRMX_IMAGE_CACHE_DIR: a json file of the bounding boxes next to the PNG
+  file, both written atomically, the PNG file last so that it marks a complete entry. The tier is
+  bounded to PRMX_IMAGE_CACHE_MAX_BYTES by evicting the least recently used entries.
+- an optional GCS tier in the bucket prefixed by PRMX_IMAGE_CACHE_BUCKET, e.g. "media", shared by
+  all server instances: the bounding boxes are stored in the metadata of the PNG object
+
+Uploads of unchanged images are skipped by DataStore.put_images, which compares a hash of the
+image pixels to the one stored with the existing media file.
+"""
+
+import json
+import os
+import threading
+from functools import cache
+from typing import Optional
+from google.cloud.storage.blob import Blob
+from google.cloud.storage.bucket import Bucket
+from prmx import util
+from prmx.disk_cache import DiskTier
+
+IMAGE_CACHE_DIR = os.environ.get("PRMX_IMAGE_CACHE_DIR", "runtime/image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get("PRMX_IMAGE_CACHE_MAX_BYTES", 128 * 2**20))
+IMAGE_CACHE_BUCKET = os.environ.get("PRMX_IMAGE_CACHE_BUCKET")
+IMAGE_CACHE_PREFIX = "image_cache"
+IMAGE_MODEL = "stable-diffusion-host"
+IMAGE_MODEL_VERSION = os.environ.get("PRMX_IMAGE_MODEL_VERSION", "1")
+
+
+class ImageCache:
+    def __init__(
+        self,
+        root: str = IMAGE_CACHE_DIR,
+        bucket_prefix: Optional[str] = None,
+        max_bytes: int = IMAGE_CACHE_MAX_BYTES,
+    ):
+        self.root = root
+        self.bucket_prefix = bucket_prefix
+        self.disk = DiskTier(root, max_bytes)
+        self.lock = threading.Lock()
+        # disk_hits and gcs_hits are served images, misses are to be generated by the caller
+        self.counters = {"disk_hits": 0, "gcs_hits": 0, "misses": 0, "writes": 0}
+
+    def key(self, model_inputs: dict) -> str:
+        inputs = {"model": IMAGE_MODEL, "version": IMAGE_MODEL_VERSION, **model_inputs}
+        return util.hash(inputs, num_digits=32)
+
+    def path(self, key: str, extension: str = "png") -> str:
+        return os.path.join(self.root, key[:2], f"{key}.{extension}")
+
+    def bucket(self) -> Bucket:
+        # imported here: the datastore module requires firebase, which the disk tier does not
+        from prmx.datastore import client
+
+        return client(self.bucket_prefix)
+
+    def blob_name(self, key: str) -> str:
+        return f"{IMAGE_CACHE_PREFIX}/{key}.png"
+
+    def get(self, key: str) -> Optional[tuple[bytes, list]]:
+        """returns the PNG data and bounding boxes, or None if never generated"""
+        path = self.path(key)
+        try:
+            # the PNG file first: it is written last, so the json file exists unless evicted since
+            with open(path, "rb") as file:
+                data = file.read()
+            with open(self.path(key, "json"), "r") as file:
+                bounding_boxes = json.load(file)
+        except FileNotFoundError:
+            pass
+        else:
+            self.disk.touch(path, self.path(key, "json"))
+            self.count("disk_hits")
+            return data, bounding_boxes
+
+        if self.bucket_prefix:
+            # fetched with its metadata, None if missing
+            blob = self.bucket().get_blob(self.blob_name(key))
+            if blob is not None:
+                data = blob.download_as_bytes()
+                bounding_boxes = json.loads(blob.metadata["bounding_boxes"])
+                self.write_entry(key, data, bounding_boxes)
+                self.count("gcs_hits")
+                return data, bounding_boxes
+
+        self.count("misses")
+        return None
+
+    def put(self, key: str, data: bytes, bounding_boxes: list) -> None:
+        """stores the PNG data and bounding boxes in all tiers"""
+        self.write_entry(key, data, bounding_boxes)
+        if self.bucket_prefix:
+            blob = Blob(self.blob_name(key), self.bucket())
+            blob.metadata = {"bounding_boxes": json.dumps(bounding_boxes)}
+            blob.upload_from_string(data, content_type="image/png")
+        self.count("writes")
+
+    def write_entry(self, key: str, data: bytes, bounding_boxes: list) -> None:
+        self.disk.write(self.path(key, "json"), json.dumps(bounding_boxes).encode())
+        self.disk.write(self.path(key), data)
+
+    def count(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            counters = dict(self.counters)
+        return counters | self.disk.stats()
+
+
+# process-wide cache instance shared by all image requests
+@cache
+def image_cache() -> ImageCache:
+    return ImageCache(bucket_prefix=IMAGE_CACHE_BUCKET)
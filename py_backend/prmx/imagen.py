@@ -1,8 +1,11 @@
 # image generation
 
 from prmx.context import localContext
-from prmx import util
-from prmx.util import oidc_token, inference_url, parse_mlflow_response
+from prmx import aio, util
+from prmx.image_cache import image_cache
+from prmx.util import inference_headers, inference_url, parse_mlflow_response
+import asyncio
+import copy
 import requests
 import io
 from PIL import ImageDraw, ImageFont, Image
@@ -94,32 +97,71 @@ def gen_image(
     str
         the hash of the shot
     """
-    prompt = prompt_and_mappings["prompt"]
-    mappings = prompt_and_mappings["char_id_mapping"]
     model_inputs = {
-        "prompt": prompt,
+        "prompt": prompt_and_mappings["prompt"],
     }
     ctx = localContext()
     hash = util.hash(model_inputs)
     if ctx.config.mock:
         image, bounding_boxes = ctx.get_image(hash)
     else:
-        model_input = {"dataframe_records": [model_inputs]}
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer {}".format(oidc_token()),
-        }
+        # images generated before from the same prompt are reused, e.g. when re-rendering a scene
+        key = image_cache().key(model_inputs)
+        entry = image_cache().get(key)
+        if entry is None:
+            model_input = {"dataframe_records": [model_inputs]}
+            response = requests.post(url, json=model_input, headers=inference_headers())
+            entry = parse_image_entry(response)
+            image_cache().put(key, *entry)
+        image, bounding_boxes = image_from_entry(
+            *entry, prompt_and_mappings["char_id_mapping"]
+        )
+    return image, hash, bounding_boxes
 
-        response = requests.post(url, json=model_input, headers=headers)
 
-        image_base64, bounding_boxes = parse_mlflow_response(
-            response, ["image_base64", "bounding_boxes"]
+async def gen_image_async(
+    prompt_and_mappings: dict,
+    url: str = inference_url("stable-diffusion-host", path="invocations"),
+) -> Tuple[Image.Image, str, list]:
+    """async variant of gen_image sending the request through the shared aio connection pool"""
+    model_inputs = {
+        "prompt": prompt_and_mappings["prompt"],
+    }
+    ctx = localContext()
+    hash = util.hash(model_inputs)
+    if ctx.config.mock:
+        image, bounding_boxes = ctx.get_image(hash)
+    else:
+        key = image_cache().key(model_inputs)
+        entry = await asyncio.to_thread(image_cache().get, key)
+        if entry is None:
+            model_input = {"dataframe_records": [model_inputs]}
+            headers = await asyncio.to_thread(inference_headers)
+            response = await aio.post_json("image", url, model_input, headers)
+            entry = parse_image_entry(response)
+            await asyncio.to_thread(image_cache().put, key, *entry)
+        image, bounding_boxes = image_from_entry(
+            *entry, prompt_and_mappings["char_id_mapping"]
         )
-        image = Image.open(io.BytesIO(base64.b64decode(image_base64)))
-        bounding_boxes = translate_bounding_box_ids(bounding_boxes, mappings)
     return image, hash, bounding_boxes
 
 
+# PNG data and bounding boxes of a model response, as stored in the image cache
+def parse_image_entry(response) -> Tuple[bytes, list]:
+    image_base64, bounding_boxes = parse_mlflow_response(
+        response, ["image_base64", "bounding_boxes"]
+    )
+    return base64.b64decode(image_base64), bounding_boxes
+
+
+def image_from_entry(
+    data: bytes, bounding_boxes: list, mappings: dict
+) -> Tuple[Image.Image, list]:
+    image = Image.open(io.BytesIO(data))
+    # the cached boxes are shared by all creations: translate a copy
+    return image, translate_bounding_box_ids(copy.deepcopy(bounding_boxes), mappings)
+
+
 def draw_dialog_on_image(
     image: Image,
     dialog_lines: list[dict],
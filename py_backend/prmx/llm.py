@@ -5,6 +5,7 @@ from prmx import datastore_local, util
 from prmx.context import localContext
 from prmx.errors import MockMismatchError
 import os, time
+import random
 import re
 import tiktoken
 from functools import lru_cache
@@ -15,6 +16,7 @@ from enum import Enum
 from openai import APIConnectionError, RateLimitError, APIStatusError, APIError, OpenAI
 from fuzzywuzzy import fuzz
 from functools import cache
+from typing import Callable, Optional
 
 
 @cache
@@ -100,9 +102,37 @@ def get_llm_role(model: Llm_model):
     assert False, "Invalid LLM model"
 
 
+# concatenate the text deltas of a streamed completion, forwarding each one to on_token
+def read_stream(stream, chat_model: bool, on_token: Callable[[str], None]) -> str:
+    llm_out = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        if chat_model:
+            delta = chunk.choices[0].delta.content
+        else:
+            delta = chunk.choices[0].text
+        if delta:
+            llm_out += delta
+            on_token(delta)
+    return llm_out
+
+
 def llm_api_call(
-    prompt: str, parameters: dict = {}, model: Llm_model = Llm_model.GPT_3_5_INSTRUCT
+    prompt: str,
+    parameters: dict = {},
+    model: Llm_model = Llm_model.GPT_3_5_INSTRUCT,
+    on_token: Optional[Callable[[str], None]] = None,
 ) -> str:
+    """calls the LLM and returns its sanitized output
+
+    Parameters
+    ----------
+    on_token : callable, optional
+        opt-in streaming: called with each text delta as soon as the LLM produces it.
+        Cached and mocked outputs are forwarded at once. The returned value is still the full
+        sanitized text, and the cache is written once the completion is done.
+    """
     ctx = localContext()
     model_dict = {
         Llm_model.GPT_3_5_INSTRUCT: "gpt-3.5-turbo-instruct",
@@ -142,6 +172,22 @@ def llm_api_call(
 
         while True:
             try:
+                if on_token is not None:
+                    # token usage is not reported by streamed responses: the prompt length
+                    # is checked by the API itself
+                    if chat_model:
+                        stream = openai_client().chat.completions.create(
+                            model=model_name,
+                            messages=messages,
+                            stream=True,
+                            **parameters,
+                        )
+                    else:
+                        stream = openai_client().completions.create(
+                            model=model_name, prompt=prompt, stream=True, **parameters
+                        )
+                    llm_out = read_stream(stream, chat_model, on_token)
+                    break
                 if chat_model:
                     response = openai_client().chat.completions.create(
                         model=model_name, messages=messages, **parameters
@@ -186,6 +232,9 @@ def llm_api_call(
 
         ctx.save(llm_out, hash_list, prompt=prompt)
 
+    elif on_token is not None:
+        on_token(llm_out)
+
     llm_out = sanitize_prompt(llm_out)
 
     # if the option is enabled, save prompt and output to a local file
@@ -206,6 +255,31 @@ def llm_api_call(
     return llm_out
 
 
+# number of retries of an LLM call hitting the OpenAI rate limit before giving up
+RATE_LIMIT_RETRIES = int(os.environ.get("PRMX_RATE_LIMIT_RETRIES", 4))
+
+
+def retry_on_rate_limit(
+    fun: callable, *args, retries: int = RATE_LIMIT_RETRIES, **kwargs
+):
+    """calls fun and retries with a jittered exponential backoff on 429 errors:
+    the delay follows the retry-after header when OpenAI provides one"""
+    for attempt in range(retries + 1):
+        try:
+            return fun(*args, **kwargs)
+        except RateLimitError as e:
+            if attempt == retries:
+                raise e
+            retry_after = e.response.headers.get("retry-after")
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = 2**attempt
+            delay += random.uniform(0, 1)
+            print(f"OpenAI: rate limited, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
 def parse_dialog_line(dialog_line: str, fallback_character: int = -1) -> (int, str):
     # Catch "no dialog" or "none"
     if dialog_line.lower()[0:2] == "no":
@@ -0,0 +1,105 @@
+"""Concurrent uploads of generated media files, e.g. all shot images or dialog lines of a scene
+
+Uploads of a batch run on a pool of PRMX_UPLOAD_WORKERS threads sharing the media bucket, i.e. one
+authenticated storage client and its connection pool. Each file is encoded directly into a
+resumable upload stream, sent in chunks of PRMX_UPLOAD_CHUNK_SIZE bytes, instead of being encoded
+into memory first.
+
+A file is identified by a fingerprint of its content computed before encoding, e.g. a hash of the
+image pixels, stored in the metadata of the uploaded object: a file whose key already exists with
+the same fingerprint is neither encoded nor uploaded again.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, NamedTuple
+from google.cloud.storage import Bucket
+from google.cloud.storage.blob import Blob
+
+UPLOAD_WORKERS = int(os.environ.get("PRMX_UPLOAD_WORKERS", 8))
+# resumable uploads are sent in chunks of a multiple of 256KB
+UPLOAD_CHUNK_SIZE = int(os.environ.get("PRMX_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+
+
+class MediaUpload(NamedTuple):
+    key: str
+    content_type: str
+    # metadata identifying the content, compared with the existing object
+    fingerprint: dict[str, str]
+    # writes the encoded file into a binary stream
+    encode: Callable[[IO[bytes]], None]
+
+
+class MediaUploader:
+    def __init__(
+        self,
+        bucket: Callable[[], Bucket],
+        workers: int = UPLOAD_WORKERS,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ):
+        self.bucket = bucket
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        # totals of all batches: skipped files are unchanged files already uploaded
+        self.counters = {"uploads": 0, "skipped": 0, "bytes": 0}
+
+    def upload_all(self, uploads: list[MediaUpload]) -> list[str]:
+        """uploads all files concurrently, returns their keys in input order"""
+        start = time.perf_counter()
+        if len(uploads) == 1:
+            sizes = [self.upload(uploads[0])]
+        else:
+            with ThreadPoolExecutor(
+                max(min(self.workers, len(uploads)), 1)
+            ) as executor:
+                sizes = list(executor.map(self.upload, uploads))
+
+        # per-batch throughput of the uploaded files, skipped files excluded
+        uploaded = [size for size in sizes if size is not None]
+        if uploaded:
+            duration = time.perf_counter() - start
+            megabytes = sum(uploaded) / 1e6
+            print(
+                f"uploaded {len(uploaded)}/{len(uploads)} media files to "
+                f"{self.bucket().name}: {megabytes:.2f}MB in {duration:.2f}s "
+                f"({megabytes / max(duration, 1e-6):.2f}MB/s)"
+            )
+        return [upload.key for upload in uploads]
+
+    def upload(self, upload: MediaUpload) -> int | None:
+        """uploads a file unless unchanged, returns the uploaded size or None if skipped"""
+        bucket = self.bucket()
+        existing = bucket.get_blob(upload.key)
+        if existing is not None and all(
+            (existing.metadata or {}).get(name) == value
+            for name, value in upload.fingerprint.items()
+        ):
+            self.count("skipped")
+            return None
+
+        blob = Blob(upload.key, bucket)
+        blob.metadata = upload.fingerprint
+        # encoders may flush the stream: only closing it finalizes the upload, and a failing
+        # encoder terminates the upload, leaving no partial object
+        with blob.open(
+            "wb",
+            chunk_size=self.chunk_size,
+            ignore_flush=True,
+            content_type=upload.content_type,
+        ) as file:
+            upload.encode(file)
+            size = file.tell()
+        self.count("uploads", size)
+        return size
+
+    def count(self, counter: str, size: int = 0) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+            self.counters["bytes"] += size
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
@@ -9,42 +9,21 @@ A KNN lookup returns the music which is most similar to the music description st
 import numpy as np
 
 from prmx import util
-from prmx.text_embeddings import text_embed_api_call
-from functools import lru_cache
+from prmx.text_embeddings import k_nearest_vectors, text_embed_api_call
+from prmx.vector_search import VectorIndex
 import random
 
 
-@lru_cache(maxsize=None)
-def get_precomputed_embeds_ids_attrib() -> tuple[np.array, list[int]]:
+@util.locked_cache
+def get_precomputed_embeds_ids_attrib() -> tuple[list[str], VectorIndex]:
     music_names = util.load_json("assets/music/music_names.json")
-    embeds = np.load("assets/music/music_embeds.npy")
+    embeds = VectorIndex(np.load("assets/music/music_embeds.npy"))
     return music_names, embeds
 
 
-def k_nearest_vectors(input_vec: np.array, candidates: np.array, k) -> list[int]:
-    """finds the closest matches to a vector
-
-    Parameters
-    -----------
-    input_vec : 1 X N vector
-        the vector to find the k nearest vectors for
-    candidates: list of 1 X N vectors
-        the set of vectors to compare to.
-    k: integer
-        the number of most similar vectors to find.
-
-    Returns
-    --------
-    k_nearest: list of indices
-        list of indices for the k closest vectors. Ordered by closeness.
-    """
-    np_list = np.argsort(-np.dot(candidates, input_vec))[:k]
-    return [int(i) for i in np_list]
-
-
 def get_music_id_knn(
     music_string: str,
-    embeds: np.array,
+    embeds: VectorIndex,
     k: int = 1,
     prev_music_ids: list[int] | None = [],
     shuffle_buffer: int = 0,
@@ -0,0 +1,112 @@
+"""Dependency-graph executor for multi-stage generation workflows
+
+A pipeline is a set of named stages, each declaring the stages it depends on. Stages run in a
+bounded thread pool as soon as their dependencies are done, so that the total execution time
+tends towards the critical path of the graph instead of the sum of all stages.
+
+Per-scene fan-out is expressed with indexed stage names, e.g. "script.0", "script.1", ...
+
+Example
+-------
+>>> pipeline = Pipeline(max_workers=4)
+>>> pipeline.add("scenes", lambda: ["a", "b"])
+>>> pipeline.add("count", len, deps=["scenes"])
+>>> pipeline.run()
+{'scenes': ['a', 'b'], 'count': 2}
+"""
+
+import os
+from contextvars import copy_context
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Optional
+
+PIPELINE_WORKERS = int(os.environ.get("PRMX_PIPELINE_WORKERS", 8))
+
+
+def fan_out(name: str, count: int) -> list[str]:
+    """returns the indexed stage names of a per-item stage, e.g. script.0 to script.{count-1}"""
+    return [f"{name}.{i}" for i in range(count)]
+
+
+class Pipeline:
+    def __init__(
+        self,
+        max_workers: int = PIPELINE_WORKERS,
+        on_result: Optional[Callable[[str, Any], None]] = None,
+    ):
+        """
+        Parameters
+        ----------
+        max_workers : int
+            maximum number of stages running at the same time
+        on_result : callable, optional
+            called with (stage name, result) in the thread of the stage as soon as it finishes, e.g.
+            to persist results: dependent stages start once it returns, independent stages are
+            dispatched meanwhile
+        """
+        self.max_workers = max_workers
+        self.on_result = on_result
+        # stage name -> (callable, dependency names)
+        self.stages: dict[str, tuple[Callable, list[str]]] = {}
+
+    def add(self, name: str, fun: Callable, deps: list[str] = []) -> None:
+        """adds a stage called with the results of its dependencies as positional arguments"""
+        if name in self.stages:
+            raise ValueError(f"stage {name} is already defined")
+        self.stages[name] = (fun, list(deps))
+
+    def validate(self) -> None:
+        for name, (_, deps) in self.stages.items():
+            unknown = [dep for dep in deps if dep not in self.stages]
+            if unknown:
+                raise ValueError(f"stage {name} depends on unknown stages {unknown}")
+
+    def run_stage(self, name: str, fun: Callable, *args) -> Any:
+        result = fun(*args)
+        if self.on_result is not None:
+            self.on_result(name, result)
+        return result
+
+    def run(self) -> dict[str, Any]:
+        """executes all stages and returns their results by stage name
+
+        The first failing stage cancels the stages which have not started yet and its exception
+        is raised once the running stages are done.
+        """
+        self.validate()
+        results = {}
+        pending = dict(self.stages)
+        running: dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while pending or running:
+                    ready = [
+                        name
+                        for name, (_, deps) in pending.items()
+                        if all(dep in results for dep in deps)
+                    ]
+                    for name in ready:
+                        fun, deps = pending.pop(name)
+                        args = [results[dep] for dep in deps]
+                        # stages run with the configuration scoped to the caller
+                        future = executor.submit(
+                            copy_context().run, self.run_stage, name, fun, *args
+                        )
+                        running[future] = name
+
+                    # pending stages that can never be ready: their dependencies form a cycle
+                    if not running:
+                        raise ValueError(
+                            f"dependency cycle between stages {list(pending)}"
+                        )
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        results[name] = future.result()
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        return results
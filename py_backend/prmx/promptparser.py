@@ -20,6 +20,7 @@ Optional
 """
 
 from prmx.llm import llm_api_call
+from typing import Callable, Optional
 import re
 
 
@@ -52,9 +53,14 @@ def parse_parameter_list(test_str: str):
 
 
 def eval_prompt(
-    prompt_text, replacement_dict, llm_fun=llm_api_call, additional_params={}
+    prompt_text,
+    replacement_dict,
+    llm_fun=llm_api_call,
+    additional_params={},
+    on_token: Optional[Callable[[str, str], None]] = None,
 ):
     # Evaluates the prompt text and returns a dict with all LLM return values.
+    # If on_token is given, partial LLM outputs are streamed to it as (query name, text delta).
     prompt_text = prompt_preprocess(prompt_text, replacement_dict)
 
     # find all <<...>> queries in prompt_text
@@ -73,9 +79,12 @@ def eval_prompt(
         parameters = parse_parameter_list(parameter_part)
         # add "additional_params" to parameters
         parameters.update(additional_params)
-        llm_return_values[name] = llm_fun(prompt_status.strip(), parameters).strip(
-            " \n\r"
-        )
+        stream_kwargs = {}
+        if on_token is not None:
+            stream_kwargs["on_token"] = lambda delta, name=name: on_token(name, delta)
+        llm_return_values[name] = llm_fun(
+            prompt_status.strip(), parameters, **stream_kwargs
+        ).strip(" \n\r")
 
         # concat the llm result to the prompt_status
         prompt_status += llm_return_values[name]
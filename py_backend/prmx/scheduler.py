@@ -0,0 +1,97 @@
+"""Prioritized execution of independent inference jobs on the aio loop, e.g. the images of a scene
+
+Jobs are started in priority order, at most `concurrency` at a time, so that the first or visible
+shots of a scene are generated before the others even when the host is saturated. The endpoint
+semaphores of the aio module still bound the requests of all concurrent jobs of a process.
+
+A failing job is retried with an exponential backoff, jittered so that the jobs failing together,
+e.g. on a host restart, do not retry together. A job failing after all its retries does not fail
+the others: its exception is returned in place of its result. Each outcome is passed to an
+optional on_done callback as soon as it is known, e.g. to upload partial results. Callbacks run
+in their own tasks, so that a slow upload does not delay the next job, and a failing callback
+turns the outcome of its job into its exception.
+
+Example
+-------
+>>> from functools import partial
+>>> async def square(x):
+...     return x * x
+>>> scheduler = JobScheduler(concurrency=2)
+>>> aio.run(scheduler.run([partial(square, x) for x in range(4)], priorities=[3, 2, 1, 0]))
+[0, 1, 4, 9]
+"""
+
+import asyncio
+import heapq
+import os
+import random
+from typing import Any, Awaitable, Callable, Optional, Sequence
+
+# attempts after the first one, and delay before the first retry in seconds, doubled at each retry
+JOB_RETRIES = int(os.environ.get("PRMX_JOB_RETRIES", 2))
+JOB_BACKOFF = float(os.environ.get("PRMX_JOB_BACKOFF", 2.0))
+
+
+class JobScheduler:
+    def __init__(
+        self, concurrency: int, retries: int = JOB_RETRIES, backoff: float = JOB_BACKOFF
+    ):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+
+    async def run(
+        self,
+        jobs: Sequence[Callable[[], Awaitable]],
+        priorities: Optional[Sequence] = None,
+        on_done: Optional[Callable[[int, Any], Awaitable]] = None,
+    ) -> list:
+        """runs all jobs, lowest priority first, and returns their results or exceptions in order
+
+        Jobs are coroutine functions without arguments. Priorities default to the job order.
+        """
+        if priorities is None:
+            priorities = range(len(jobs))
+        # the job index breaks priority ties, jobs are never compared
+        pending = [(priority, i) for i, priority in enumerate(priorities)]
+        heapq.heapify(pending)
+        outcomes = [None] * len(jobs)
+        callbacks = []
+
+        async def done(i: int):
+            try:
+                await on_done(i, outcomes[i])
+            except Exception as e:
+                print(f"callback of job {i} failed: {e}")
+                outcomes[i] = e
+
+        async def worker():
+            # popping is not interrupted by other workers: the loop only switches tasks on await
+            while pending:
+                _, i = heapq.heappop(pending)
+                outcomes[i] = await self.attempt(jobs[i])
+                if on_done is not None:
+                    callbacks.append(asyncio.create_task(done(i)))
+
+        try:
+            await asyncio.gather(
+                *[worker() for _ in range(min(self.concurrency, len(jobs)))]
+            )
+        finally:
+            # callbacks still running when the jobs are cancelled are awaited, not left behind
+            await asyncio.gather(*callbacks, return_exceptions=True)
+        return outcomes
+
+    async def attempt(self, job: Callable[[], Awaitable]) -> Any:
+        for retry in range(self.retries + 1):
+            try:
+                return await job()
+            except Exception as e:
+                if retry == self.retries:
+                    return e
+                delay = self.retry_delay(retry)
+                print(f"job failed: {e}, retrying in {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+
+    def retry_delay(self, retry: int) -> float:
+        return self.backoff * 2**retry * random.uniform(0.5, 1.5)
@@ -1,22 +1,29 @@
-from functools import lru_cache
+import asyncio
 import json
+import os
 from pprint import pprint
 import requests
 import subprocess
 import tempfile
 import time
-from typing import Sequence, Union
+from typing import Iterable, Optional, Sequence, Union
 import wave
 
 import librosa
 import numpy as np
 from pydub import AudioSegment
 from scipy.io.wavfile import write as write_wav
-from scipy.signal import butter, lfilter
 
+from prmx import aio, dsp
+from prmx.context import localContext
 from prmx.decoration import timer
-from prmx.text_embeddings import text_embed_api_call
-from prmx.util import inference_url, get_best_dot_matches, oidc_token
+from prmx.text_embeddings import (
+    cached_embeds,
+    cached_embeds_async,
+    text_embed_api_call,
+)
+from prmx.util import inference_headers, inference_url, locked_cache
+from prmx.vector_search import VectorIndex, assign
 
 MODEL = "unit-speech-host"
 
@@ -24,6 +31,17 @@ VOICE_DATA_PATH = "assets/speech/voice_data.json"
 EMOTION_EMBED_PATH = "assets/speech/emotion_embeddings.json"
 
 BINS_PER_OCTAVE = 12
+
+# peak level of the processed speech lines in dBFS, e.g. -1.0: lines are not normalized if unset
+SPEECH_PEAK_DBFS = os.environ.get("PRMX_SPEECH_PEAK_DBFS")
+SPEECH_PEAK_DBFS = float(SPEECH_PEAK_DBFS) if SPEECH_PEAK_DBFS else None
+# version of the process_line chain, to be bumped when its output changes, e.g. the lowpass filter
+SPEECH_PROCESSING_VERSION = "1"
+# concurrent lines are synthesized in requests of at most TTS_BATCH_SIZE records and
+# TTS_BATCH_CHARS characters of prompts, waiting up to TTS_BATCH_WINDOW seconds for lines to join
+TTS_BATCH_SIZE = int(os.environ.get("PRMX_TTS_BATCH_SIZE", 8))
+TTS_BATCH_CHARS = int(os.environ.get("PRMX_TTS_BATCH_CHARS", 2000))
+TTS_BATCH_WINDOW = float(os.environ.get("PRMX_TTS_BATCH_WINDOW", 0.02))
 MAX_INT16 = 2**15
 
 
@@ -32,18 +50,74 @@ def get_embed(text: str) -> np.ndarray:
 
 
 def get_voice_for_speaker_index(speaker_index: int) -> dict:
-    voice_data, _ = load_data(VOICE_DATA_PATH)
-    return [v for v in voice_data if v["speaker_index"] == speaker_index][0]
+    return voice_catalogue().voice(speaker_index)
+
+
+class VoiceCatalogue:
+    """voice table indexed by speaker index, shared by voice attribution and speech synthesis
+
+    Rows follow the order of the voice embeddings. Columns used in lookups are stored as arrays.
+    """
+
+    def __init__(self, voice_data: list[dict], embeddings: VectorIndex):
+        self.voices = voice_data
+        self.embeddings = embeddings
+        self.rows = {
+            voice["speaker_index"]: row for row, voice in enumerate(voice_data)
+        }
+        self.speaker_indices = np.array([v["speaker_index"] for v in voice_data])
+        self.speakers = np.array([v["speaker"] for v in voice_data])
+        self.pitch_ratios = np.array([v["pitch_ratio"] for v in voice_data])
+        self.f0 = np.array([v.get("f0", np.nan) for v in voice_data], dtype=float)
+
+    def __len__(self) -> int:
+        return len(self.voices)
+
+    def voice(self, speaker_index: int) -> dict:
+        return self.voices[self.rows[speaker_index]]
+
+    # rows of the given speaker indices, unknown indices are skipped
+    def rows_of(self, speaker_indices: Iterable[int]) -> list[int]:
+        return [self.rows[i] for i in speaker_indices if i in self.rows]
+
 
+@locked_cache
+def voice_catalogue() -> VoiceCatalogue:
+    return VoiceCatalogue(*load_data(VOICE_DATA_PATH))
+
+
+# Binary store of a voice or emotion library, next to its legacy json file: the entries without
+# their embeddings in a metadata table, and the embeddings as one float32 matrix in a .npy file
+def store_paths(path: str) -> tuple[str, str]:
+    base = path.removesuffix(".json")
+    return f"{base}.meta.json", f"{base}.npy"
+
+
+def save_data(path: str, mapping: list[dict], embeddings: np.ndarray) -> None:
+    meta_path, npy_path = store_paths(path)
+    assert len(mapping) == len(embeddings), f"{len(mapping)} != {len(embeddings)}"
+    with open(meta_path, "w") as file:
+        json.dump(mapping, file, indent=2)
+    np.save(npy_path, np.asarray(embeddings, dtype=np.float32))
+
+
+@locked_cache
+def load_data(path: str) -> tuple[list[dict], VectorIndex]:
+    meta_path, npy_path = store_paths(path)
+
+    if os.path.exists(npy_path):
+        with open(meta_path) as file:
+            mapping = json.load(file)
+        # the matrix is memory-mapped: pages are read on first use and shared by the workers
+        embeddings = VectorIndex(np.load(npy_path, mmap_mode="r"))
+        return mapping, embeddings
 
-@lru_cache(maxsize=None)
-def load_data(path: str) -> tuple[dict[str, int], list[np.ndarray]]:
     with open(path) as file:
         mapping = json.load(file)
 
-    # mapping is a list of dicts, each dict contains a key "text_embed" with a serialized np.ndarray
-    # extract them into one np.array
-    embeddings = np.array([json.loads(entry["text_embed"]) for entry in mapping])
+    # legacy json: each dict contains a key "text_embed" with a serialized np.ndarray
+    # extract them into one library index, and drop them from the entries
+    embeddings = VectorIndex([json.loads(entry.pop("text_embed")) for entry in mapping])
     return mapping, embeddings
 
 
@@ -52,11 +126,11 @@ def attribute_voices(
     name: str,
     desc: str,
     voice_desc: str = None,
-    taken_indices: list[int] = [],
+    taken_indices: Iterable[int] = (),
     num_voices_per_character: int = 3,
 ) -> dict:
     # load precomputed embeddings
-    voice_data, voice_text_emb = load_data(VOICE_DATA_PATH)
+    catalogue = voice_catalogue()
 
     if voice_desc:
         text = voice_desc
@@ -64,40 +138,67 @@ def attribute_voices(
         text = name + ". " + desc
 
     query_embedding = get_embed(text)
-    best_ids = get_best_dot_matches(
-        np.dot(voice_text_emb, query_embedding), len(query_embedding)
+    # skip voices that are already assigned to a character
+    best_ids = catalogue.embeddings.search(
+        query_embedding,
+        num_voices_per_character,
+        exclude=catalogue.rows_of(taken_indices),
+    )
+
+    return selected_voices(catalogue, best_ids, num_voices_per_character)
+
+
+def attribute_voices_batch(
+    characters: list[dict],
+    taken_indices: Iterable[int] = (),
+    num_voices_per_character: int = 3,
+    method: str = "greedy",
+) -> list[tuple[dict, list[int]]]:
+    """Joint variant of attribute_voices for all characters of a creation
+
+    Voice descriptions are embedded in one request and scored against the catalogue in one product,
+    then voices are assigned without duplicates, see vector_search.assign. Returns the result of
+    attribute_voices for each character.
+    """
+    if not characters:
+        return []
+    catalogue = voice_catalogue()
+    texts = [c.get("voice_desc") or c["name"] + ". " + c["desc"] for c in characters]
+    scores = catalogue.embeddings.scores(np.stack(cached_embeds(texts)))
+    assigned = assign(
+        scores,
+        num_voices_per_character,
+        exclude=catalogue.rows_of(taken_indices),
+        method=method,
     )
 
-    # remove ids that are already assigned to a character
-    best_ids = [
-        best_id
-        for best_id in best_ids
-        if voice_data[best_id]["speaker_index"] not in taken_indices
+    return [
+        selected_voices(catalogue, best_ids, num_voices_per_character)
+        for best_ids in assigned
     ]
 
-    # if best_ids contains less than num_voices_per_character, fill with random speaker_index from voice_data
+
+def selected_voices(
+    catalogue: VoiceCatalogue, best_ids: np.ndarray, num_voices_per_character: int
+) -> tuple[dict, list[int]]:
+    # if best_ids contains less than num_voices_per_character, fill with random voices of the catalogue
     if len(best_ids) < num_voices_per_character:
-        best_ids.extend(
-            np.random.choice(
-                [i for i in range(len(voice_data))],
-                num_voices_per_character - len(best_ids),
-            )
+        best_ids = np.concatenate(
+            [
+                best_ids,
+                np.random.choice(
+                    len(catalogue), num_voices_per_character - len(best_ids)
+                ),
+            ]
         )
 
     indices = best_ids[:num_voices_per_character]
-
-    selected_speaker_indices = []
-    speakers = []
-    pitch_ratios = []
-    for best_id in indices:
-        selected_speaker_indices.append(voice_data[best_id]["speaker_index"])
-        speakers.append(voice_data[best_id]["speaker"])
-        pitch_ratios.append(voice_data[best_id]["pitch_ratio"])
+    selected_speaker_indices = catalogue.speaker_indices[indices].tolist()
 
     data_to_return = {
         "speaker_indices": selected_speaker_indices,
-        "speakers": speakers,
-        "pitch_ratios": pitch_ratios,
+        "speakers": catalogue.speakers[indices].tolist(),
+        "pitch_ratios": catalogue.pitch_ratios[indices].tolist(),
         # api.get_shot_speeches() applies the target pitch when it is specified in a character dict
     }
 
@@ -105,11 +206,22 @@ def attribute_voices(
 
 
 def attribute_emotions(lines: list[str]):
+    line_embeddings = [get_embed(line) for line in lines]
+    return emotions_for_embeddings(line_embeddings)
+
+
+async def attribute_emotions_async(lines: list[str]):
+    if localContext().config.mock:
+        # mocked embeddings are routed by call stack: keep the sync call path
+        return await asyncio.to_thread(attribute_emotions, lines)
+    return emotions_for_embeddings(await cached_embeds_async(lines))
+
+
+def emotions_for_embeddings(line_embeddings: list[np.ndarray]) -> dict:
     # load precomputed embeddings
     emotion_data, emotion_text_emb = load_data(EMOTION_EMBED_PATH)
-    line_embeddings = [get_embed(line) for line in lines]
-    dot_products = np.dot(line_embeddings, emotion_text_emb.T)
-    best_indices = np.argmax(dot_products, axis=1)
+    # all lines are matched in a single batched lookup
+    best_indices = emotion_text_emb.search(line_embeddings, 1)[:, 0]
 
     emotion_indices = []
     emotions = []
@@ -134,13 +246,8 @@ def infer(
     retry: bool = True,
 ) -> AudioSegment:
     """Text-To-Speech inference: returns mp3 AudioSegment"""
-    model_input = {
-        "dataframe_records": [{"prompt": text, "speaker": speaker, "emotion": emotion}]
-    }
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(oidc_token()),
-    }
+    model_input = tts_input(text, speaker, emotion)
+    headers = inference_headers()
 
     response = requests.post(url, json=model_input, headers=headers)
     try:
@@ -161,6 +268,192 @@ def infer(
         else:
             raise e
 
+    return tts_audio(response)
+
+
+async def infer_async(
+    text: str,
+    speaker: str,
+    emotion: str,
+    url: str = inference_url(MODEL, path="invocations"),
+    retry: bool = True,
+) -> AudioSegment:
+    """async variant of infer sending the request through the shared aio connection pool"""
+    model_input = tts_input(text, speaker, emotion)
+    headers = await asyncio.to_thread(inference_headers)
+
+    # same backoff as infer: 3 seconds, then 10 seconds before the last retry
+    backoffs = [3, 10] if retry else []
+    while True:
+        response = await aio.post_json("tts", url, model_input, headers)
+        try:
+            response = response.json()
+            break
+        except ValueError as e:
+            print(response.text)
+            if not backoffs:
+                raise e
+            backoff = backoffs.pop(0)
+            print(f"retrying in {backoff} seconds...")
+            await asyncio.sleep(backoff)
+
+    return tts_audio(response)
+
+
+# (text, speaker, emotion) of a line to synthesize
+TTSRecord = tuple[str, str, str]
+
+
+def chunk_records(
+    records: Sequence[TTSRecord],
+    max_records: int = TTS_BATCH_SIZE,
+    max_chars: int = TTS_BATCH_CHARS,
+) -> list[list[TTSRecord]]:
+    """splits records in order into request-sized chunks, a longer prompt gets its own chunk"""
+    chunks = []
+    chunk_chars = 0
+    for record in records:
+        if (
+            not chunks
+            or len(chunks[-1]) >= max_records
+            or chunk_chars + len(record[0]) > max_chars
+        ):
+            chunks.append([])
+            chunk_chars = 0
+        chunks[-1].append(record)
+        chunk_chars += len(record[0])
+    return chunks
+
+
+async def infer_batch_async(
+    records: Sequence[TTSRecord],
+    url: str = inference_url(MODEL, path="invocations"),
+) -> list[AudioSegment]:
+    """Text-To-Speech inference of many lines: returns their AudioSegments in input order
+
+    Lines are packed into as few requests as the batch limits allow, sent concurrently. Lines of a
+    failed request, or missing from its predictions, are synthesized again one by one.
+    """
+    chunks = chunk_records(records)
+    results = await asyncio.gather(*[infer_chunk_async(c, url) for c in chunks])
+    return [line for chunk_lines in results for line in chunk_lines]
+
+
+async def infer_chunk_async(records: list[TTSRecord], url: str) -> list[AudioSegment]:
+    if len(records) == 1:
+        return [await infer_async(*records[0], url=url)]
+
+    headers = await asyncio.to_thread(inference_headers)
+    try:
+        response = await aio.post_json("tts", url, tts_batch_input(records), headers)
+        lines = tts_audios(response.json(), len(records))
+    except Exception as e:
+        print(f"batched TTS request of {len(records)} lines failed: {e}")
+        lines = [None] * len(records)
+
+    missing = [i for i, line in enumerate(lines) if line is None]
+    if missing:
+        print(f"synthesizing {len(missing)} lines of the batch one by one")
+        retried = await asyncio.gather(
+            *[infer_async(*records[i], url=url) for i in missing]
+        )
+        for i, line in zip(missing, retried):
+            lines[i] = line
+    return lines
+
+
+class TTSBatcher:
+    """Merges concurrent single-line synthesis requests into batched TTS requests.
+
+    Coroutines on the aio loop queue their line and await its audio. The first queued line opens a
+    time window of max_wait seconds: lines arriving before it closes, or before max_batch_size
+    lines are queued, are sent together by infer_batch_async.
+    """
+
+    def __init__(
+        self, max_batch_size: int = TTS_BATCH_SIZE, max_wait: float = TTS_BATCH_WINDOW
+    ):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: list[tuple[TTSRecord, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # batches being sent: the loop only keeps weak references to its tasks
+        self.tasks: set[asyncio.Task] = set()
+        # counters to monitor the batching efficiency: lines / batches is the mean batch size
+        self.stats = {"lines": 0, "batches": 0}
+
+    async def infer(self, text: str, speaker: str, emotion: str) -> AudioSegment:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((text, speaker, emotion), future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(lambda task: self.sent(task, batch))
+
+    # an unexpected failure of a batch, e.g. its cancellation, is passed to its lines instead of
+    # leaving them pending forever
+    def sent(self, task: asyncio.Task, batch: list[tuple[TTSRecord, asyncio.Future]]):
+        self.tasks.discard(task)
+        if task.cancelled():
+            for _, future in batch:
+                future.cancel()
+        elif (error := task.exception()) is not None:
+            print(f"TTS batch failed: {error!r}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+
+    async def send(self, batch: list[tuple[TTSRecord, asyncio.Future]]) -> None:
+        self.stats["lines"] += len(batch)
+        self.stats["batches"] += 1
+        try:
+            lines = await infer_batch_async([record for record, _ in batch])
+        except Exception as e:
+            # every line of the batch fails with the inference error in its own coroutine
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), line in zip(batch, lines):
+            if not future.done():
+                future.set_result(line)
+
+
+# one batcher per process, it only holds lines of the aio loop of that process
+batchers: dict[int, TTSBatcher] = {}
+
+
+def tts_batcher() -> TTSBatcher:
+    return batchers.setdefault(os.getpid(), TTSBatcher())
+
+
+def tts_input(text: str, speaker: str, emotion: str) -> dict:
+    return tts_batch_input([(text, speaker, emotion)])
+
+
+def tts_batch_input(records: Sequence[TTSRecord]) -> dict:
+    return {
+        "dataframe_records": [
+            {"prompt": text, "speaker": speaker, "emotion": emotion}
+            for text, speaker, emotion in records
+        ]
+    }
+
+
+def tts_audio(response: dict) -> AudioSegment:
     try:
         response = response["predictions"][0]["0"]
     except Exception as e:
@@ -168,20 +461,45 @@ def infer(
         pprint(response)
         raise e
 
-    audio_float = response["audio_generated"]
-    audio_int = (np.array(audio_float) * MAX_INT16).astype(np.int16)
-    audio_sr = response["sampling_rate"]
+    return prediction_audio(response)
+
+
+def tts_audios(response: dict, count: int) -> list[Optional[AudioSegment]]:
+    """splits the predictions of a batched request per record, None for failed records"""
+    try:
+        predictions = response["predictions"]
+    except Exception as e:
+        pprint(response)
+        raise e
+
+    # records are returned as rows, each with the "0" column of a single record request
+    if len(predictions) != count:
+        raise ValueError(f"{len(predictions)} predictions for {count} records")
+
+    lines = []
+    for i, prediction in enumerate(predictions):
+        try:
+            lines.append(prediction_audio(prediction["0"]))
+        except Exception as e:
+            print(f"no audio in the prediction of record {i}: {e}")
+            lines.append(None)
+    return lines
+
+
+def prediction_audio(prediction: dict) -> AudioSegment:
+    audio_float = np.asarray(prediction["audio_generated"], dtype=np.float32)
+    audio_sr = prediction["sampling_rate"]
 
     # return AudioSegment object from the generated data
     # note that sample width of 2 corresponds to 16 bit audio data, and we typically deal with
     # mono channel audios in TTS
-    return AudioSegment(audio_int, frame_rate=audio_sr, sample_width=2, channels=1)
+    return dsp.to_segment(audio_float.reshape(-1, 1), audio_sr, sample_width=2)
 
 
 # turn int sound into a float array
 def int_sound_to_float(int_array: np.ndarray) -> np.ndarray:
     # divide by the maximum value of a 16-bit signed integer: 32768, i.e. 2^15
-    return np.array([np.float32(x / 32768.0) for x in int_array])
+    return dsp.to_float(np.asarray(int_array), sample_width=2)
 
 
 # f0 is a voice's fundamental frequency, i.e. the pitch
@@ -271,32 +589,41 @@ def butter_lowpass_filter(
     Returns:
     - AudioSegment: Audio output of the filtered input signal.
     """
-    audio_data = np.array(audio_segment.get_array_of_samples()) / MAX_INT16
-    sample_rate = audio_segment.frame_rate
+    sample_width = audio_segment.sample_width
+    samples = dsp.to_float(dsp.segment_samples(audio_segment), sample_width)
+    # the filter is designed once per sample rate, cutoff and order, see dsp.lowpass_sos
+    filtered = dsp.lowpass(samples, audio_segment.frame_rate, cutoff_freq, order)
+    return dsp.to_segment(filtered, audio_segment.frame_rate, sample_width)
+
+
+# every setting changing the output of process_line, e.g. to key cached lines
+def processing_inputs(pitch_ratio: float) -> dict:
+    return {
+        "pitch_ratio": pitch_ratio,
+        "peak_dbfs": SPEECH_PEAK_DBFS,
+        "processing": SPEECH_PROCESSING_VERSION,
+    }
 
-    # Calculate the Nyquist frequency (half of the sampling rate)
-    # see https://en.wikipedia.org/wiki/Nyquist_frequency
-    # see also https://en.wikipedia.org/wiki/Nyquist%E2%80%93Shannon_sampling_theorem
-    nyquist = 0.5 * sample_rate
-    cutoff_freq = np.array(cutoff_freq)
-
-    # Normalize the cutoff frequency to the Nyquist frequency
-    # This is a common practice in filter design so that the cutoff frequency is
-    # specified independently of the signal sampling rate, making the filters portable
-    normal_cutoff = cutoff_freq / nyquist
-
-    # Calculate the Infinite Impulse Response (IIR) coefficients. Normally denoted as (b, a)
-    # https://eeweb.engineering.nyu.edu/iselesni/EL713/iir/iir.pdf
-    # https://docs.scipy.org/doc/scipy/reference/generated/scipy.signal.butter.html
-    filter_coeff_num, filter_coeff_denum = butter(
-        order, normal_cutoff, btype="low", analog=False
-    )
-    # Apply the low-pass filter
-    audio_data_filtered = lfilter(filter_coeff_num, filter_coeff_denum, audio_data)
-    audio_data_filtered = (audio_data_filtered * MAX_INT16).astype(np.int16)
-    return AudioSegment(
-        audio_data_filtered, frame_rate=sample_rate, sample_width=2, channels=1
-    )
+
+@timer
+def process_line(
+    line: AudioSegment,
+    pitch_ratio: float = 1.0,
+    peak_dbfs: Optional[float] = SPEECH_PEAK_DBFS,
+) -> AudioSegment:
+    """TTS post-processing chain: pitch shift -> lowpass -> optional peak normalization
+
+    The samples are converted once to float32, and back into an AudioSegment at the end.
+    """
+    if pitch_ratio != 1.0:
+        line = shift_pitch(line, pitch_ratio)
+
+    sample_rate = line.frame_rate
+    samples = dsp.to_float(dsp.segment_samples(line), line.sample_width)
+    samples = dsp.lowpass(samples, sample_rate)
+    if peak_dbfs is not None:
+        dsp.normalize_peak(samples, peak_dbfs)
+    return dsp.to_segment(samples, sample_rate, line.sample_width)
 
 
 def debug_character_pitch_distribution(characters):
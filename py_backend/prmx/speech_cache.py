@@ -0,0 +1,109 @@
+"""Cache of synthesized speech lines, so that unchanged dialog lines skip TTS inference
+
+Lines are keyed by a hash of every input of the synthesis: the TTS model, the quote, the speaker,
+the emotion and the post-processing settings, see prmx.speech.processing_inputs, e.g. the pitch
+ratio. Processed lines are stored as wav files, in two tiers:
+- an on-disk tier under PRMX_SPEECH_CACHE_DIR, one file per line written atomically, so that
+  several workers can share the same folder, bounded to PRMX_SPEECH_CACHE_MAX_BYTES by evicting
+  the least recently used lines
+- an optional GCS tier in the bucket prefixed by PRMX_SPEECH_CACHE_BUCKET, e.g. "media", shared by
+  all server instances: lines found there are copied to the disk tier
+
+Uploads of unchanged lines are skipped by DataStore.put_speech, which compares a hash of the line
+samples to the one stored with the existing media file.
+"""
+
+import io
+import os
+import threading
+from functools import cache
+from typing import Optional
+from google.cloud.storage.blob import Blob
+from pydub import AudioSegment
+from prmx import util
+from prmx.disk_cache import DiskTier
+
+SPEECH_CACHE_DIR = os.environ.get("PRMX_SPEECH_CACHE_DIR", "runtime/speech_cache")
+SPEECH_CACHE_MAX_BYTES = int(
+    os.environ.get("PRMX_SPEECH_CACHE_MAX_BYTES", 128 * 2**20)
+)
+SPEECH_CACHE_BUCKET = os.environ.get("PRMX_SPEECH_CACHE_BUCKET")
+SPEECH_CACHE_PREFIX = "speech_cache"
+
+
+class SpeechCache:
+    def __init__(
+        self,
+        root: str = SPEECH_CACHE_DIR,
+        bucket_prefix: Optional[str] = None,
+        max_bytes: int = SPEECH_CACHE_MAX_BYTES,
+    ):
+        self.root = root
+        self.bucket_prefix = bucket_prefix
+        self.disk = DiskTier(root, max_bytes)
+        self.lock = threading.Lock()
+        # disk_hits and gcs_hits are served lines, misses are to be synthesized by the caller
+        self.counters = {"disk_hits": 0, "gcs_hits": 0, "misses": 0, "writes": 0}
+
+    def key(self, **inputs) -> str:
+        return util.hash(inputs, num_digits=32)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.wav")
+
+    def blob(self, key: str) -> Blob:
+        # imported here: the datastore module requires firebase, which the disk tier does not
+        from prmx.datastore import client
+
+        return Blob(f"{SPEECH_CACHE_PREFIX}/{key}.wav", client(self.bucket_prefix))
+
+    def get(self, key: str) -> Optional[AudioSegment]:
+        """returns the cached line, or None if it has never been synthesized"""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            pass
+        else:
+            self.disk.touch(path)
+            self.count("disk_hits")
+            return AudioSegment.from_wav(io.BytesIO(data))
+
+        if self.bucket_prefix:
+            blob = self.blob(key)
+            if blob.exists():
+                data = blob.download_as_bytes()
+                self.disk.write(path, data)
+                self.count("gcs_hits")
+                return AudioSegment.from_wav(io.BytesIO(data))
+
+        self.count("misses")
+        return None
+
+    def put(self, key: str, line: AudioSegment) -> AudioSegment:
+        """stores the line in all tiers and returns it"""
+        mem_file = io.BytesIO()
+        line.export(mem_file, format="wav")
+        data = mem_file.getvalue()
+
+        self.disk.write(self.path(key), data)
+        if self.bucket_prefix:
+            self.blob(key).upload_from_string(data, content_type="audio/wav")
+        self.count("writes")
+        return line
+
+    def count(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            counters = dict(self.counters)
+        return counters | self.disk.stats()
+
+
+# process-wide cache instance shared by all speech requests
+@cache
+def speech_cache() -> SpeechCache:
+    return SpeechCache(bucket_prefix=SPEECH_CACHE_BUCKET)
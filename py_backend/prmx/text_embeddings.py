@@ -1,14 +1,31 @@
+import asyncio
 import json
 import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from typing import Callable
 from prmx.errors import MockMismatchError
-from prmx import util
+from prmx import aio, util
 import numpy as np
 from openai import OpenAI
+from openai.types import CreateEmbeddingResponse, Embedding
+from openai.types.create_embedding_response import Usage
 
 from prmx.context import localContext
+from prmx.embedding_cache import embedding_cache
+from prmx.vector_search import VectorIndex
 from functools import cache
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# concurrent single-text requests are merged into one api call of at most EMBED_BATCH_SIZE texts,
+# waiting up to EMBED_BATCH_WINDOW seconds after the first request for others to join the batch
+EMBED_BATCH_SIZE = int(os.environ.get("PRMX_EMBED_BATCH_SIZE", 64))
+EMBED_BATCH_WINDOW = float(os.environ.get("PRMX_EMBED_BATCH_WINDOW", 0.01))
+
 
 @cache
 def openai_client() -> OpenAI:
@@ -18,6 +35,112 @@ def openai_client() -> OpenAI:
     )
 
 
+def embed_texts(texts: list[str]) -> list[list[float]]:
+    """sends all texts to the embedding api in a single request, returns embeddings in input order"""
+    response = openai_client().embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [entry.embedding for entry in sorted(response.data, key=lambda e: e.index)]
+
+
+async def embed_texts_async(texts: list[str]) -> list[list[float]]:
+    """async variant of embed_texts through the shared aio connection pool"""
+    async with aio.limit("openai"):
+        response = await aio.openai_client().embeddings.create(
+            input=texts, model=EMBEDDING_MODEL
+        )
+    return [entry.embedding for entry in sorted(response.data, key=lambda e: e.index)]
+
+
+class EmbeddingBatcher:
+    """Merges concurrent single-text embedding requests into batched api calls.
+
+    The first queued request opens a time window of max_wait seconds: requests arriving before
+    it closes join the same batch, up to max_batch_size requests. Duplicate texts within a batch
+    are only sent once and their embedding is shared by all requesting threads.
+    """
+
+    def __init__(
+        self,
+        embed_fun: Callable[[list[str]], list[list[float]]] = embed_texts,
+        max_batch_size: int = EMBED_BATCH_SIZE,
+        max_wait: float = EMBED_BATCH_WINDOW,
+    ):
+        self.embed_fun = embed_fun
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+        # counters to monitor the batching efficiency: texts_sent / requests is the dedup ratio
+        self.stats = {"requests": 0, "batches": 0, "texts_sent": 0}
+
+    def embed(self, text: str) -> list[float]:
+        """blocks until the batch containing text has been embedded"""
+        future = Future()
+        self.requests.put((text, future))
+        self.start_worker()
+        return future.result()
+
+    # the worker thread is started lazily, i.e. after a fork in a multi-process server
+    def start_worker(self) -> None:
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+
+    def next_batch(self) -> list[tuple[str, Future]]:
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self) -> None:
+        while True:
+            self.flush(self.next_batch())
+
+    def flush(self, batch: list[tuple[str, Future]]) -> None:
+        # deduplicate texts while preserving their order
+        unique_texts = list(dict.fromkeys(text for text, _ in batch))
+        self.stats["requests"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["texts_sent"] += len(unique_texts)
+        try:
+            embeddings = self.embed_fun(unique_texts)
+        except Exception as e:
+            # every request of the batch fails with the api error in its own thread
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        embedding_by_text = dict(zip(unique_texts, embeddings))
+        for text, future in batch:
+            future.set_result(embedding_by_text[text])
+
+
+@cache
+def embedding_batcher() -> EmbeddingBatcher:
+    return EmbeddingBatcher()
+
+
+# wrap embeddings in the api response type so that callers can keep reading response.data[i].embedding
+def embedding_response(embeddings: list[list[float]]) -> CreateEmbeddingResponse:
+    return CreateEmbeddingResponse(
+        data=[
+            Embedding(embedding=embedding, index=i, object="embedding")
+            for i, embedding in enumerate(embeddings)
+        ],
+        model=EMBEDDING_MODEL,
+        object="list",
+        usage=Usage(prompt_tokens=0, total_tokens=0),
+    )
+
+
 def generate_embeds(
     input_json_file: str,
     output_json_file: str,
@@ -96,15 +219,71 @@ def embed_already_computed(entry, optput_data, keys_to_match_for_overwrite) -> b
     return False
 
 
+def cached_embeds(texts: list[str]) -> list[np.ndarray]:
+    """returns the embeddings of texts, only calling the api for texts missing from the cache"""
+    embeddings, missing = lookup_embeds(texts)
+
+    if len(missing) == 1:
+        # single texts are merged with concurrent requests from other threads
+        computed = [embedding_batcher().embed(missing[0])]
+    elif missing:
+        computed = embed_texts(missing)
+    else:
+        computed = []
+
+    return store_embeds(texts, embeddings, missing, computed)
+
+
+async def cached_embeds_async(texts: list[str]) -> list[np.ndarray]:
+    """async variant of cached_embeds"""
+    embeddings, missing = lookup_embeds(texts)
+
+    if len(missing) == 1:
+        # concurrent coroutines embedding single lines share the batches of the sync callers
+        computed = [await asyncio.to_thread(embedding_batcher().embed, missing[0])]
+    elif missing:
+        computed = await embed_texts_async(missing)
+    else:
+        computed = []
+
+    return store_embeds(texts, embeddings, missing, computed)
+
+
+# returns the cached embeddings of texts, None if missing, and the unique missing texts
+def lookup_embeds(texts: list[str]) -> tuple[list[np.ndarray | None], list[str]]:
+    cache = embedding_cache()
+    embeddings = [cache.get(EMBEDDING_MODEL, text) for text in texts]
+    missing = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    return embeddings, missing
+
+
+# caches the computed embeddings of the missing texts and returns all embeddings in input order
+def store_embeds(
+    texts: list[str],
+    embeddings: list[np.ndarray | None],
+    missing: list[str],
+    computed: list[list[float]],
+) -> list[np.ndarray]:
+    cache = embedding_cache()
+    computed_by_text = {
+        text: cache.put(EMBEDDING_MODEL, text, embedding)
+        for text, embedding in zip(missing, computed)
+    }
+    return [
+        computed_by_text[text] if embedding is None else embedding
+        for text, embedding in zip(texts, embeddings)
+    ]
+
+
 def text_embed_api_call(text: str | list[str]) -> dict:
     """calls the openai text embedding api and returns the result as a dictionary"""
 
     ctx = localContext()
 
     if not ctx.config.mock:
-        embedding_data = openai_client().embeddings.create(
-            input=text, model="text-embedding-ada-002"
-        )
+        texts = [text] if isinstance(text, str) else text
+        embeddings = [embedding.tolist() for embedding in cached_embeds(texts)]
+        embedding_data = embedding_response(embeddings)
         ctx.save(embedding_data, text, binary=True)
 
         return embedding_data
@@ -140,14 +319,16 @@ def get_text_embed(text: str) -> np.ndarray:
     return np.array(embed_data.data[0].embedding)
 
 
-def k_nearest_vectors(input_vec: np.ndarray, candidates: np.ndarray, k) -> list[int]:
+def k_nearest_vectors(
+    input_vec: np.ndarray, candidates: np.ndarray | VectorIndex, k
+) -> list[int]:
     """finds the closest matches to a vector
 
     Parameters
     -----------
     input_vec : 1 X N vector
         the vector to find the k nearest vectors for
-    candidates: list of 1 X N vectors
+    candidates: list of 1 X N vectors, or a VectorIndex
         the set of vectors to compare to.
     k: integer
         the number of most similar vectors to find.
@@ -161,8 +342,10 @@ def k_nearest_vectors(input_vec: np.ndarray, candidates: np.ndarray, k) -> list[
     if len(candidates) == 0 or len(input_vec) == 0:
         return []
 
-    np_list = np.argsort(-np.dot(candidates, input_vec))[:k]
-    return [int(i) for i in np_list]
+    # candidates are usually a library index built at load time, arrays are converted per call
+    if not isinstance(candidates, VectorIndex):
+        candidates = VectorIndex(candidates)
+    return [int(i) for i in candidates.search(input_vec, k)]
 
 
 def get_precomputed_embeds_ids(
@@ -0,0 +1,122 @@
+"""ID token of the inference service account, shared by the TTS and image generation clients
+
+Google ID tokens are valid for an hour: the token is cached and only refreshed when it gets within
+PRMX_TOKEN_REFRESH_MARGIN seconds of its expiry. Within that margin, callers keep receiving the
+still valid token while a background thread fetches the next one, so that inference requests never
+wait for the token endpoint, except for the very first one and after an expiry.
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import timezone
+from functools import cache
+from typing import Callable, Optional
+import google.auth.transport.requests
+import requests
+from google import oauth2
+from google.auth.credentials import Credentials
+
+TOKEN_REFRESH_MARGIN = float(os.environ.get("PRMX_TOKEN_REFRESH_MARGIN", 300))
+
+
+def inference_credentials() -> Credentials:
+    return oauth2.service_account.IDTokenCredentials.from_service_account_info(
+        info=json.loads(os.environ["INFERENCE_KEY"]),  # inference service account key
+        target_audience=os.environ["INFERENCE_CLIENT_ID"],  # OAuth client ID
+    )
+
+
+class TokenProvider:
+    def __init__(
+        self,
+        credentials_factory: Callable[[], Credentials] = inference_credentials,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.credentials_factory = credentials_factory
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self.credentials: Optional[Credentials] = None
+        self.lock = threading.Lock()
+        self.refreshing: Optional[threading.Thread] = None
+        # the token endpoint is called on refreshes, hits are tokens served from the cache
+        self.counters = {
+            "hits": 0,
+            "refreshes": 0,
+            "background_refreshes": 0,
+            "failures": 0,
+        }
+
+    def token(self) -> str:
+        """returns a valid ID token, refreshing it first if it is missing or expired"""
+        with self.lock:
+            remaining = self.remaining()
+            if remaining <= 0:
+                # no valid token to serve meanwhile: callers wait for the refresh
+                self.refresh()
+                self.counters["refreshes"] += 1
+            else:
+                self.counters["hits"] += 1
+                if remaining <= self.refresh_margin:
+                    self.start_background_refresh()
+            return self.credentials.token
+
+    # seconds until the cached token expires, 0 if there is none
+    def remaining(self) -> float:
+        if self.credentials is None or not self.credentials.token:
+            return 0
+        if self.credentials.expiry is None:
+            return float("inf")
+        # google-auth stores the expiry as a naive UTC datetime
+        expiry = self.credentials.expiry.replace(tzinfo=timezone.utc).timestamp()
+        return max(expiry - self.clock(), 0)
+
+    def refresh(self) -> None:
+        if self.credentials is None:
+            self.credentials = self.credentials_factory()
+        try:
+            self.credentials.refresh(transport())
+        except Exception:
+            self.counters["failures"] += 1
+            raise
+
+    def start_background_refresh(self) -> None:
+        if self.refreshing is None or not self.refreshing.is_alive():
+            self.refreshing = threading.Thread(
+                target=self.background_refresh, daemon=True
+            )
+            self.refreshing.start()
+
+    def background_refresh(self) -> None:
+        # refreshed on a copy: callers keep reading the current token meanwhile
+        credentials = self.credentials_factory()
+        try:
+            credentials.refresh(transport())
+        except Exception as e:
+            # the current token is still valid, the next call within the margin retries
+            print(f"background refresh of the inference token failed: {e}")
+            with self.lock:
+                self.counters["failures"] += 1
+            return
+
+        with self.lock:
+            self.credentials = credentials
+            self.counters["background_refreshes"] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+
+# token endpoint requests reuse the connections of one session
+@cache
+def transport() -> google.auth.transport.requests.Request:
+    return google.auth.transport.requests.Request(requests.Session())
+
+
+# process-wide provider shared by all inference clients
+@cache
+def token_provider() -> TokenProvider:
+    return TokenProvider()
@@ -4,15 +4,16 @@ import hashlib
 import json
 import os
 import re
-from functools import cache
+import threading
+from functools import cache, wraps
 from typing import Any
 import firebase_admin
-import google.auth.transport.requests
 import numpy as np
 import requests
 from pprint import pprint
-from google import oauth2
 from google.cloud import secretmanager
+from prmx import vector_search
+from prmx.token_provider import token_provider
 
 
 def save_to_txt(string: str, filename: str) -> None:
@@ -63,6 +64,22 @@ def gcp_project_id() -> str:
     return proj
 
 
+def locked_cache(fun: callable) -> callable:
+    """functools.cache computing each value once, even when first called from concurrent threads:
+    annotate loaders of large assets to avoid loading them once per request thread on cold starts
+    """
+    cached_fun = cache(fun)
+    lock = threading.Lock()
+
+    @wraps(fun)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return cached_fun(*args, **kwargs)
+
+    wrapper.cache_clear = cached_fun.cache_clear
+    return wrapper
+
+
 # get the url of a self-hosted model's inference service
 def inference_url(model: str, path: str = "") -> str:
     domain = os.environ["INFERENCE_DOMAIN"]
@@ -71,20 +88,24 @@ def inference_url(model: str, path: str = "") -> str:
 
 def oidc_token() -> str:
     """Get an authorized token to pass in inference request headers"""
+    # the token is cached until shortly before its expiry, see prmx.token_provider
+    return token_provider().token()
 
-    credentials = oauth2.service_account.IDTokenCredentials.from_service_account_info(
-        info=json.loads(os.environ["INFERENCE_KEY"]),  # inference service account key
-        target_audience=os.environ["INFERENCE_CLIENT_ID"],  # OAuth client ID
-    )
-    credentials.refresh(google.auth.transport.requests.Request())
-    return credentials.token
+
+# headers of a request to a self-hosted model's inference service
+def inference_headers() -> dict:
+    return {
+        "Content-Type": "application/json",
+        "Authorization": "Bearer {}".format(oidc_token()),
+    }
 
 
 # parse the json response from a self-hosted model's inference service running on mlflow (default)
+# the response is a requests.Response, or a httpx.Response when sent through the aio module
 def parse_mlflow_response(response: requests.Response, keys: list) -> list:
     try:
         parsed_response = response.json()
-    except requests.exceptions.JSONDecodeError:
+    except ValueError:  # JSONDecodeError of either client
         raise ValueError(
             f"could not parse the json inference response: '{response.text}'"
         )
@@ -209,19 +230,9 @@ def hash(data: dict | list | str, num_digits: int = 8) -> str:
     return hash_value[:num_digits]
 
 
-# Given a list of dot products, return the indices of the 'n' best matches
+# Given a list of dot products, return the indices of the 'n' best matches, best first
 def get_best_dot_matches(dot_prods: np.array, n: int = 1):
-    # flatten dot_prods if it is not already a 1D array
-    dot_prods = dot_prods.flatten()
-
-    # Check if n is larger than the size of dot_prods
-    n = min(n, len(dot_prods))
-
-    # Get 'n' best matches
-    indices = np.argpartition(dot_prods, -n)[-n:]
-    # Sort these indices by their corresponding scores in descending order
-    indices = indices[np.argsort(-dot_prods[indices])]
-    return indices
+    return vector_search.top_k(np.asarray(dot_prods).flatten(), n)
 
 
 @cache
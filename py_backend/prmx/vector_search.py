@@ -0,0 +1,129 @@
+"""Exact nearest neighbour search over the precomputed embedding libraries
+
+A VectorIndex holds a library as one contiguous float32 matrix, built once when the library is
+loaded. Cosine similarity libraries, e.g. sounds, are normalized at that point, so that a lookup is
+a single matrix product with the normalized queries instead of recomputing the library norms.
+
+Queries are a single (dim,) vector or a batch of (n_queries, dim) vectors scored in one product.
+Results are ordered by decreasing score, ties broken by increasing library index, so that lookups
+are deterministic across runs and platforms.
+
+Several queries that must not share results, e.g. the images of the characters of a movie, are
+matched jointly by assign on their (n_queries, len) score matrix.
+
+Example
+-------
+>>> index = VectorIndex([[1, 0], [0, 1], [1, 1]], cosine=True)
+>>> index.search([1, 0.1], k=2)
+array([0, 2])
+>>> index.search([[1, 0.1], [0, 1]], k=1, exclude=[0])
+array([[2],
+       [1]])
+"""
+
+from typing import Iterable
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+ASSIGNMENT_METHODS = ["greedy", "hungarian"]
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int, exclude: Iterable[int] = ()) -> np.ndarray:
+    """indices of the k best scores along the last axis, best first
+
+    Excluded indices are never returned. k is clipped to the number of remaining candidates.
+    """
+    scores = np.asarray(scores)
+    exclude = np.unique(np.fromiter(exclude, dtype=np.int64))
+    if len(exclude):
+        scores = scores.copy()
+        scores[..., exclude] = -np.inf
+    k = min(k, scores.shape[-1] - len(exclude))
+    if k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+
+    rows = scores.reshape(-1, scores.shape[-1])
+    best = np.stack([top_k_row(row, k) for row in rows])
+    return best.reshape(scores.shape[:-1] + (k,))
+
+
+def top_k_row(scores: np.ndarray, k: int) -> np.ndarray:
+    # partial selection of the k-th best score, then an exact ordering of the scores above it:
+    # all ties of the k-th score are kept, so that the lowest indices win regardless of the partition
+    kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    candidates = np.flatnonzero(scores >= kth)
+    # lexsort sorts by the last key first: decreasing score, then increasing index
+    return candidates[np.lexsort((candidates, -scores[candidates]))[:k]]
+
+
+def assign(
+    scores: np.ndarray, k: int, exclude: Iterable[int] = (), method: str = "greedy"
+) -> list[np.ndarray]:
+    """k distinct candidates for each row of a (n_rows, n_candidates) score matrix, best first
+
+    No candidate is assigned twice, nor any excluded one. "greedy" gives each row in turn its k best
+    remaining candidates, like successive searches excluding the previous results. "hungarian"
+    maximizes the total score of all rows, e.g. a row is not left with poor matches because an
+    earlier row took its best candidate, and falls back to greedy when candidates are too few.
+    """
+    assert method in ASSIGNMENT_METHODS, f"unknown assignment method {method}"
+    scores = np.asarray(scores)
+    available = np.setdiff1d(np.arange(scores.shape[1]), np.fromiter(exclude, int))
+
+    if method == "hungarian" and len(available) >= k * len(scores):
+        # each row is repeated k times, to be assigned k distinct columns
+        _, columns = linear_sum_assignment(
+            np.repeat(scores[:, available], k, axis=0), maximize=True
+        )
+        assigned = np.sort(available[columns].reshape(len(scores), k), axis=1)
+        # decreasing score, ties broken by increasing index like top_k
+        scores = np.take_along_axis(scores, assigned, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return list(np.take_along_axis(assigned, order, axis=1))
+
+    taken = set(range(scores.shape[1])).difference(available.tolist())
+    assigned = []
+    for row in scores:
+        best = top_k(row, k, exclude=taken)
+        taken.update(best.tolist())
+        assigned.append(best)
+    return assigned
+
+
+class VectorIndex:
+    def __init__(self, vectors: np.ndarray, cosine: bool = False):
+        # memory-mapped float32 libraries are kept as they are, i.e. not read into memory
+        vectors = np.asanyarray(vectors, dtype=np.float32)
+        if cosine:
+            vectors = normalize(vectors)
+        if not vectors.flags["C_CONTIGUOUS"]:
+            vectors = np.ascontiguousarray(vectors)
+        self.vectors = vectors
+        # scores are cosine similarities if set, dot products otherwise
+        self.cosine = cosine
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.vectors[index]
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """(len,) scores of a single query, or (n_queries, len) scores of a batch"""
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.cosine:
+            queries = normalize(queries)
+        return queries @ self.vectors.T
+
+    def search(
+        self, queries: np.ndarray, k: int = 1, exclude: Iterable[int] = ()
+    ) -> np.ndarray:
+        """indices of the k nearest library vectors of each query, see top_k"""
+        if len(self) == 0:
+            return np.zeros(np.shape(queries)[:-1] + (0,), dtype=np.int64)
+        return top_k(self.scores(queries), k, exclude)
@@ -15,17 +15,31 @@ a parameter name of an api module function has no duplicate entry in DB Layout,
 'shots', 'scenes', 'music', etc. should be unique names across all subcollections of a creation
 """
 
+from contextvars import copy_context
 from enum import Enum
+import json
+import queue
+import threading
+import traceback
 from functools import cache
 from inspect import signature, Parameter
-from typing import Optional, Tuple
+from typing import Iterator, Optional, Tuple
 from firebase_admin import auth
+from google.cloud.firestore_v1.document import DocumentReference
 from flask import Request
 from pydub import AudioSegment
-from prmx import api
+from prmx import api, assets, audio, music, speech
+from prmx.clip_engine import clip_engine
+from prmx.context import scoped_config
 from prmx.datastore import DataStore
 
 
+# subcollections of a creation document and of its scene documents: the layout is known in advance
+# to skip listing them when loading arguments, see ASSUMPTION 2 about unique names
+CREATION_COLLECTIONS = ["characters", "locations", "scenes"]
+SCENE_COLLECTIONS = ["shots"]
+
+
 class ASYNC_STATUS(Enum):
     READY = "READY"
     PENDING = "PENDING"
@@ -75,13 +89,10 @@ def required_parameters(fun: callable) -> list[str]:
 def update_shots_with_dialogs(
     uid: str, cid: str, shot: list[AudioSegment] | AudioSegment, hashes: list[str]
 ) -> list[str]:
-    shot_urls = []
     if isinstance(shot, AudioSegment):
-        shot_urls.append(ds().put_speech(uid, cid, shot, hashes))
-    else:
-        for line, hash in zip(shot, hashes):
-            shot_urls.append(ds().put_speech(uid, cid, line, hash))
-    return shot_urls
+        return [ds().put_speech(uid, cid, shot, hashes)]
+    # the lines of a shot are uploaded concurrently
+    return ds().put_speeches(uid, cid, list(zip(shot, hashes)))
 
 
 # callback function for image generation: it uploads images to GCS and returns their URLs
@@ -90,15 +101,29 @@ def upload_images(
     cid: str,
     response: list[dict],
 ) -> list[str]:
-    image_meta = []
-    for res in response:
-        image_meta.append(
-            {
-                "url": ds().put_image(uid, cid, res["image"], res["hash"]),
-                "bounding_boxes": res["bounding_boxes"],
-            }
-        )
-    return image_meta
+    # shots whose generation failed have no image to upload
+    generated = [res for res in response if res is not None]
+    # all images are uploaded concurrently
+    urls = iter(
+        ds().put_images(uid, cid, [(res["image"], res["hash"]) for res in generated])
+    )
+    return [
+        None
+        if res is None
+        else {"url": next(urls), "bounding_boxes": res["bounding_boxes"]}
+        for res in response
+    ]
+
+
+# bounding boxes are stored as an array in the shot document, not as a collection
+def save_shot_image(shot_ref: DocumentReference, image_meta: dict) -> None:
+    shot_ref.set(
+        {
+            "image_url": image_meta["url"],
+            "bounding_boxes": image_meta["bounding_boxes"],
+        },
+        merge=True,
+    )
 
 
 # callback function for dialog generation: it uploads speech snippets to GCS and returns their URLs
@@ -116,9 +141,17 @@ def upload_dialog(
         line_url = update_shots_with_dialogs(uid, cid, lines, hashes_list)
         return line_url[0]
     elif any(isinstance(i, list) for i in lines):
-        for shot, hashes in zip(lines, hashes_list):
-            shot_urls = update_shots_with_dialogs(uid, cid, shot, hashes)
-            urls.append(shot_urls)
+        # the lines of all shots are uploaded in a single concurrent batch
+        line_urls = iter(
+            update_shots_with_dialogs(
+                uid,
+                cid,
+                [line for shot in lines for line in shot],
+                [hash for hashes in hashes_list for hash in hashes],
+            )
+        )
+        for shot in lines:
+            urls.append([next(line_urls) for _ in shot])
     else:
         urls = update_shots_with_dialogs(uid, cid, lines, hashes_list)
     return urls
@@ -133,8 +166,12 @@ def load_missing_arguments(
     # determine which parameters are missing from the provided arguments
     missing_parameters = [p for p in parameters if p not in provided_args]
 
-    # load missing arguments from Firestore
-    missing_arguments = ds().load(uid, cid, missing_parameters)
+    # load missing arguments from Firestore, all in a single parallel fan-out
+    missing_arguments = {}
+    if missing_parameters:
+        missing_arguments = ds().load(
+            uid, cid, missing_parameters, collections=CREATION_COLLECTIONS
+        )
 
     # update the provided arguments with the missing ones
     kwargs.update(missing_arguments)
@@ -157,12 +194,63 @@ def response_wrapper(call_name: str, result: any) -> dict:
 
 # highest-level generative function dispatching requests to matching api functions:
 # it is called from main.py and the test suite
-def gen(uid: str, cid: str, call: str, **kwargs) -> dict:
+def gen(uid: str, cid: str, call: str, config: Optional[dict] = None, **kwargs) -> dict:
     # lookup the requested function in the api module
     fun = getattr(api, call)
 
-    # execute the function registered handler, defined as an attribute at the bottom of this file
-    return fun.handler(uid, cid, fun, **kwargs)
+    # execute the function registered handler, defined as an attribute at the bottom of this file:
+    # the optional profile and cid of the request only apply to this request, see scoped_config
+    with scoped_config(**(config or {})):
+        return fun.handler(uid, cid, fun, **kwargs)
+
+
+# format a server-sent event, see https://html.spec.whatwg.org/multipage/server-sent-events.html
+def sse_event(event: str, data: any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# whether an api call accepts an on_token callback, checked before streaming a response
+def supports_streaming(call: Optional[str]) -> bool:
+    return getattr(getattr(api, call or "", None), "streaming", False)
+
+
+# opt-in streaming variant of gen for api functions accepting an on_token callback:
+# yields "token" events with partial LLM outputs, then a final "result" or "error" event
+def gen_events(
+    uid: str, cid: str, call: str, config: Optional[dict] = None, **kwargs
+) -> Iterator[str]:
+    fun = getattr(api, call)
+
+    # the generation runs in a thread pushing tokens, then None once it is done
+    events = queue.Queue()
+    result = {}
+
+    def generate():
+        try:
+            with scoped_config(**(config or {})):
+                result["response"] = fun.handler(
+                    uid,
+                    cid,
+                    fun,
+                    on_token=lambda name, text: events.put(
+                        {"name": name, "text": text}
+                    ),
+                    **kwargs,
+                )
+        except Exception as e:
+            traceback.print_exc()
+            result["error"] = getattr(e, "message", str(e))
+        finally:
+            events.put(None)
+
+    threading.Thread(target=copy_context().run, args=(generate,), daemon=True).start()
+    while (token := events.get()) is not None:
+        yield sse_event("token", token)
+
+    if "error" in result:
+        yield sse_event("error", result["error"])
+    else:
+        yield sse_event("result", result["response"])
 
 
 # generate text through a given api callable
@@ -176,6 +264,36 @@ def gen_text(uid: str, cid: str, fun: callable, **kwargs) -> dict:
     return response_wrapper(fun.__name__, response)
 
 
+# generate a list of results through a generator api callable yielding (index, item) pairs:
+# the attached callback receives all items ready so far and the arguments of the call, e.g. to
+# persist partial progress
+def gen_stream(uid: str, cid: str, fun: callable, **kwargs) -> dict:
+    still_missing = load_missing_arguments(uid, cid, kwargs, required_parameters(fun))
+    assert len(still_missing) == 0, f"Missing arguments: {still_missing}"
+
+    items = {}
+    for index, item in fun(**kwargs):
+        items[index] = item
+        if hasattr(fun, "callback"):
+            fun.callback(uid, cid, items, **kwargs)
+
+    response = [items[index] for index in sorted(items)]
+    return response_wrapper(fun.__name__, response)
+
+
+# callback function for streamed script generation: it saves the scripts generated so far
+def save_script(
+    uid: str, cid: str, scripts: dict[int, str], scenes: list, **kwargs
+) -> None:
+    # merged into the stored list indexed by scene id: scenes still being generated keep their
+    # previous script, and scenes never generated are empty strings
+    stored = ds().load(uid, cid, "script").get("script") or []
+    script = (stored + [""] * len(scenes))[: len(scenes)]
+    for scene_id, scene_script in scripts.items():
+        script[scene_id] = scene_script
+    ds().save(uid, cid, "script", script)
+
+
 # generate images or sound through a given api callable
 def gen_media(uid: str, cid: str, fun: callable, **kwargs) -> dict:
     # keep track of unknown arguments after loading missing keys at a creation level in the database
@@ -198,7 +316,15 @@ def gen_media(uid: str, cid: str, fun: callable, **kwargs) -> dict:
             .collection("scenes")
             .document(str(scene_id))
         )
-        kwargs_to_update = ds().load(uid, cid, still_missing, path=subdoc_ref)
+        kwargs_to_update = {}
+        if still_missing:
+            kwargs_to_update = ds().load(
+                uid,
+                cid,
+                still_missing,
+                path=subdoc_ref,
+                collections=SCENE_COLLECTIONS,
+            )
         if shot_id != "*":
             shot = subdoc_ref.collection("shots").document(str(shot_id)).get().to_dict()
             kwargs_to_update.update({"shot": shot})
@@ -207,15 +333,46 @@ def gen_media(uid: str, cid: str, fun: callable, **kwargs) -> dict:
                 kwargs_to_update.update({"line": line})
         kwargs.update(kwargs_to_update)
 
-    response = fun(**kwargs)
+    if getattr(fun, "progressive", False):
+        # upload each item as soon as it is ready and save it in the document of its shot, for a
+        # stored scene: the clients listening to the shots of the scene render them progressively
+        uploads = {}
+
+        def upload(index: int, item: any) -> None:
+            uploads[index] = fun.callback(uid, cid, [item])[0]
+            if scene_id != "*" and uploads[index] is not None:
+                shot_ref = subdoc_ref.collection("shots").document(
+                    str(shot_id if shot_id != "*" else index)
+                )
+                save_shot_image(shot_ref, uploads[index])
+
+        response = fun(on_result=upload, **kwargs)
+        response = [uploads.get(index) for index in range(len(response))]
 
-    if hasattr(fun, "callback"):
-        # execute the attached callback to upload the generated media to GCS and return the URLs
-        response = fun.callback(uid, cid, response)
+    else:
+        response = fun(**kwargs)
+
+        if hasattr(fun, "callback"):
+            # execute the attached callback to upload the generated media to GCS and return the URLs
+            response = fun.callback(uid, cid, response)
 
     return response_wrapper(fun.__name__, response)
 
 
+# load the precomputed data shared by requests, e.g. when a server worker starts
+def preload() -> None:
+    speech.voice_catalogue()
+    speech.load_data(speech.EMOTION_EMBED_PATH)
+    music.get_precomputed_embeds_ids_attrib()
+    audio.load_audio_embeddings()
+    audio.load_acoustic_env_embeddings()
+    for emb_type in assets.CLIP_PATHS:
+        assets.load_embeddings(emb_type)
+        assets.load_index(emb_type)
+    # warm start: the first asset request must not wait for the CLIP model to load
+    clip_engine().load()
+
+
 # api functions handlers and callbacks attached as attributes and executed by the web module
 for fun in [
     api.get_title_plot,
@@ -242,9 +399,22 @@ for fun in [
 ]:
     fun.handler = gen_media
 
+api.get_scripts.handler = gen_stream
+
+# text generation streaming partial LLM outputs with gen_events
+api.get_title_plot.streaming = True
+api.get_script.streaming = True
+
+# streamed generation persists each item as soon as it is ready
+api.get_scripts.callback = save_script
+
 # media generation executes an upload callback upon completion
 api.get_shot_image.callback = upload_images
 api.get_shot_images.callback = upload_images
+
+# images are uploaded one by one as they are generated, through the upload callback
+api.get_shot_image.progressive = True
+api.get_shot_images.progressive = True
 api.get_line_speech.callback = upload_dialog
 api.get_shot_speech.callback = upload_dialog
 api.get_shot_speeches.callback = upload_dialog
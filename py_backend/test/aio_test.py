@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import unittest
+from prmx import aio
+
+
+class Test_TestAio(unittest.TestCase):
+    def test_run_from_threads(self):
+        async def loop_thread():
+            await asyncio.sleep(0)
+            return threading.current_thread()
+
+        threads = []
+        workers = [
+            threading.Thread(target=lambda: threads.append(aio.run(loop_thread())))
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # every caller thread shares the same event loop thread
+        self.assertEqual(set(threads), {aio.runtime().thread})
+
+    def test_endpoint_limit(self):
+        running = 0
+        max_running = 0
+
+        async def request():
+            nonlocal running, max_running
+            async with aio.limit("image"):
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        async def fan_out():
+            await asyncio.gather(*[request() for _ in range(20)])
+
+        aio.run(fan_out())
+        self.assertEqual(max_running, aio.CONCURRENCY["image"])
+
+    def test_run_errors(self):
+        async def fail():
+            raise ValueError("inference failed")
+
+        with self.assertRaises(ValueError):
+            aio.run(fail())
+
+
+if __name__ == "__main__":
+    unittest.main()
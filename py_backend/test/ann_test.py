@@ -0,0 +1,41 @@
+import tempfile
+import unittest
+import numpy as np
+from prmx.ann import IVFIndex, brute_force_search
+
+
+class Test_TestIVFIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.normal(size=(500, 16)).astype(np.float32)
+        self.queries = rng.normal(size=(20, 16)).astype(np.float32)
+        self.index = IVFIndex.build(self.vectors, nlist=16)
+
+    def test_full_probe(self):
+        # probing all clusters is an exact search
+        for query in self.queries:
+            np.testing.assert_array_equal(
+                self.index.search(query, 5, nprobe=16),
+                brute_force_search(self.vectors, query, 5),
+            )
+
+    def test_exclude(self):
+        query = self.queries[0]
+        best = brute_force_search(self.vectors, query, 3)
+        found = self.index.search(query, 3, nprobe=16, exclude=best[:2])
+        self.assertNotIn(best[0], found)
+        self.assertNotIn(best[1], found)
+        self.assertEqual(found[0], best[2])
+
+        # few candidates in the probed clusters: more clusters are probed
+        self.assertEqual(len(self.index.search(query, 100, nprobe=1)), 100)
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.index.save(folder)
+            index = IVFIndex.load(folder)
+            self.assertIsInstance(index.vectors, np.memmap)
+            np.testing.assert_array_equal(
+                index.search(self.queries[0], 5, nprobe=4),
+                self.index.search(self.queries[0], 5, nprobe=4),
+            )
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+import torch
+from transformers import CLIPTextConfig, CLIPTextModelWithProjection
+from prmx import assets
+from prmx.ann import IVFIndex
+from prmx.clip_engine import ClipTextEngine
+from prmx.embedding_cache import EmbeddingCache
+from prmx.vector_search import VectorIndex
+
+VOCAB_SIZE = 64
+
+
+class WordTokenizer:
+    """stands in for the CLIP tokenizer: one id per word, the end token has the highest id"""
+
+    def __call__(self, texts, padding=True, return_tensors="pt", truncation=True):
+        ids = [
+            [1 + sum(map(ord, w)) % (VOCAB_SIZE - 2) for w in t.split()[:14]]
+            for t in texts
+        ]
+        ids = [i + [VOCAB_SIZE - 1] for i in ids]
+        length = max(len(i) for i in ids)
+        return {
+            "input_ids": torch.tensor([i + [0] * (length - len(i)) for i in ids]),
+            "attention_mask": torch.tensor(
+                [[1] * len(i) + [0] * (length - len(i)) for i in ids]
+            ),
+        }
+
+
+class Test_TestClipEngine(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        config = CLIPTextConfig(
+            vocab_size=VOCAB_SIZE,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=16,
+            projection_dim=16,
+        )
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.paths = {
+            "local_model": os.path.join(cls.folder.name, "model.pt"),
+            "local_tokenizer": os.path.join(cls.folder.name, "tokenizer.pt"),
+        }
+        torch.save(CLIPTextModelWithProjection(config), cls.paths["local_model"])
+        torch.save(WordTokenizer(), cls.paths["local_tokenizer"])
+        cls.texts = [
+            "John. A tall detective",
+            "Mary",
+            "An old lighthouse keeper with a beard",
+            "John. A tall detective",
+        ]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.folder.cleanup()
+
+    def engine(self, variant: str = "fp32", batch_size: int = 32) -> ClipTextEngine:
+        return ClipTextEngine(variant, batch_size=batch_size, paths=self.paths)
+
+    def test_batch_matches_single_texts(self):
+        engine = self.engine()
+        batched = engine.encode(self.texts)
+        single = np.concatenate([engine.encode([text]) for text in self.texts])
+        self.assertEqual(batched.shape, (4, 16))
+        self.assertEqual(batched.dtype, np.float32)
+        np.testing.assert_allclose(batched, single, atol=1e-5)
+        # batches smaller than the input are concatenated in order
+        np.testing.assert_allclose(
+            self.engine(batch_size=3).encode(self.texts), batched, atol=1e-5
+        )
+
+    def test_int8_drift(self):
+        fp32 = self.engine().encode(self.texts)
+        int8 = self.engine("int8").encode(self.texts)
+        cosine = np.sum(fp32 * int8, axis=1) / (
+            np.linalg.norm(fp32, axis=1) * np.linalg.norm(int8, axis=1)
+        )
+        self.assertGreater(cosine.min(), 0.95)
+        # quantized embeddings are never mixed with the fp32 ones in the cache
+        self.assertNotEqual(self.engine("int8").name, self.engine().name)
+
+    def test_encode_clip_texts(self):
+        engine = self.engine()
+        with tempfile.TemporaryDirectory() as root, patch.object(
+            assets, "clip_engine", lambda: engine
+        ), patch.object(assets, "embedding_cache", lambda: cache):
+            cache = EmbeddingCache(root)
+            with patch.object(engine, "encode", wraps=engine.encode) as encode:
+                embeddings = assets.encode_clip_texts(self.texts)
+                # duplicate and cached texts are not encoded again
+                assets.encode_clip_texts(self.texts[:2])
+            encode.assert_called_once_with(self.texts[:3])
+
+        self.assertEqual([e.shape for e in embeddings], [(1, 16)] * 4)
+        np.testing.assert_array_equal(embeddings[0], embeddings[3])
+
+    @patch.dict("os.environ", {"PRECOMPUTE_ASSET_VER": "v1"})
+    def test_match_assets(self):
+        rng = np.random.default_rng(0)
+        library = VectorIndex(rng.normal(size=(20, 16)))
+        url_list = [f"{100 + i}.png" for i in range(20)]
+        queries = [rng.normal(size=(1, 16)) for _ in range(3)]
+        with patch.object(
+            assets, "load_embeddings", return_value=(library, url_list)
+        ), patch.object(assets, "encode_clip_texts", return_value=queries):
+            results = assets.match_assets("characters", ["a", "b", "c"], 2, [4])
+
+        indices = [i for _, found in results for i in found]
+        self.assertEqual(len(set(indices)), 6)
+        self.assertNotIn(4, indices)
+        # the first description gets its best matches
+        self.assertEqual(results[0][1], library.search(queries[0][0], 2, [4]).tolist())
+        self.assertEqual(
+            results[0][0]["images_urls"],
+            [f"v1/characters/{100 + i}.jpg" for i in results[0][1]],
+        )
+        self.assertEqual(results[0][0]["ids"], [100 + i for i in results[0][1]])
+
+        # candidates retrieved through the index get the same assignment
+        index = IVFIndex.build(library.vectors, 4)
+        with patch.object(
+            assets, "load_embeddings", return_value=(library, url_list)
+        ), patch.object(
+            assets, "encode_clip_texts", return_value=queries
+        ), patch.object(
+            assets, "load_index", return_value=index
+        ), patch.object(
+            index, "search", wraps=index.search
+        ) as search:
+            indexed = assets.match_assets("characters", ["a", "b", "c"], 2, [4])
+        self.assertEqual(search.call_count, 3)
+        self.assertEqual(indexed, results)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+"""offline tests of the Firestore data layout: references are never sent to the database"""
+
+from unittest import TestCase, main
+from unittest.mock import MagicMock, patch
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from prmx.datastore import (
+    DataStore,
+    MAX_BATCH_WRITES,
+    fetch_references,
+    plan_writes,
+)
+
+
+# write plans are built offline: references of an anonymous client are never sent
+class Test_TestWritePlan(TestCase):
+    def setUp(self) -> None:
+        client = firestore.Client(project="test", credentials=AnonymousCredentials())
+        self.path = client.document("creators/uid/creations/cid")
+
+    def test_plan_writes(self):
+        shots = [
+            {
+                "desc": f"shot {i}",
+                "dialog": [{"character_id": 0, "emotion": "Neutral", "line": "Hi"}],
+            }
+            for i in range(3)
+        ]
+        writes = plan_writes("scenes.0.shots", shots, self.path)
+
+        # one write per shot document, dialogs are stored as arrays in the shot documents
+        self.assertEqual(len(writes), 3)
+        ref, fields = writes["creators/uid/creations/cid/scenes/0/shots/2"]
+        self.assertEqual(fields, shots[2])
+
+    def test_plan_writes_merges_fields(self):
+        writes = plan_writes("", {"title": "Pabolo", "genre": 1}, self.path)
+        self.assertEqual(list(writes.values())[0][1], {"title": "Pabolo", "genre": 1})
+
+        writes = plan_writes("scenes.0.music_url", "music.mp3", self.path)
+        self.assertEqual(list(writes), ["creators/uid/creations/cid/scenes/0"])
+
+    def test_save_batches(self):
+        shots = [{"desc": f"shot {i}"} for i in range(MAX_BATCH_WRITES + 1)]
+        batch = MagicMock()
+        with patch("prmx.datastore.firestore.client") as client:
+            client.return_value.batch.return_value = batch
+            stats = DataStore().save("uid", "cid", "shots", shots, path=self.path)
+
+        self.assertEqual(stats, {"writes": MAX_BATCH_WRITES + 1, "batches": 2})
+        self.assertEqual(batch.set.call_count, MAX_BATCH_WRITES + 1)
+
+
+class Test_TestLoadReferences(TestCase):
+    def document(self, id: str, data: dict) -> MagicMock:
+        doc = MagicMock(id=id, exists=True)
+        doc.to_dict.return_value = data
+        return doc
+
+    def test_known_layout(self):
+        path = MagicMock()
+        path.get.return_value = self.document("cid", {"title": "Pabolo"})
+        shots = path.collection.return_value
+        shots.select.return_value.get.return_value = [
+            self.document(str(i), {"dialog": []}) for i in [10, 2, 1]
+        ]
+
+        fields, subcollections = fetch_references(
+            path, ["title", "shots"], ["shots"], {"shots": ["dialog"]}
+        )
+        self.assertEqual(fields, {"title": "Pabolo"})
+        self.assertEqual(subcollections, {"shots": [{"dialog": []}] * 3})
+        # documents are sorted by integer id, only masked fields are retrieved
+        shots.select.assert_called_once_with(["dialog"])
+        path.collections.assert_not_called()
+
+    def test_listed_layout(self):
+        path = MagicMock()
+        path.get.return_value = self.document("cid", {})
+        path.collections.return_value = [MagicMock(id="scenes")]
+        path.collection.return_value.get.return_value = [
+            self.document("1", {"desc": "b"}),
+            self.document("0", {"desc": "a"}),
+        ]
+
+        fields, subcollections = fetch_references(path, ["scenes", "title"], None, {})
+        self.assertEqual(fields, {})
+        self.assertEqual(subcollections, {"scenes": [{"desc": "a"}, {"desc": "b"}]})
+        path.collection.assert_called_once_with("scenes")
+
+    def test_outdated_layout(self):
+        path = MagicMock(path="creators/uid/creations/cid")
+        characters = [{"name": "John"}]
+        with patch(
+            "prmx.datastore.fetch_references",
+            side_effect=[({"title": "Pabolo"}, {}), ({}, {"characters": characters})],
+        ) as fetch:
+            data = DataStore().load(
+                "uid", "cid", ["title", "characters"], path=path, collections=[]
+            )
+
+        self.assertEqual(data, {"title": "Pabolo", "characters": characters})
+        # names missing from the given layout are looked up again after listing the collections
+        self.assertEqual(fetch.call_args.args[1:3], (["characters"], None))
+
+
+if __name__ == "__main__":
+    main()
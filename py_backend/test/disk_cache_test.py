@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from prmx.disk_cache import DiskTier
+from prmx.embedding_cache import EmbeddingCache
+from prmx.image_cache import ImageCache
+
+
+class Test_TestDiskTier(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmp_dir.name, name[:2], name)
+
+    # writes an entry last used at the given time, in seconds since the epoch
+    def write(self, tier: DiskTier, name: str, used: float) -> None:
+        tier.write(self.path(name), b"x" * 100)
+        os.utime(self.path(name), (used, used))
+
+    def test_lru_eviction(self):
+        tier = DiskTier(self.tmp_dir.name, max_bytes=400)
+        self.write(tier, "aa.png", used=1)
+        self.write(tier, "aa.json", used=1)
+        self.write(tier, "bb.png", used=2)
+        # a read makes "aa" the most recently used entry
+        tier.touch(self.path("aa.png"))
+        tier.write(self.path("cc.png"), b"x" * 120)
+
+        # "bb" is evicted, which is enough to get under the low watermark
+        self.assertFalse(os.path.exists(self.path("bb.png")))
+        self.assertTrue(os.path.exists(self.path("cc.png")))
+        # an entry is as recent as its most recently used file
+        self.assertTrue(os.path.exists(self.path("aa.png")))
+        self.assertTrue(os.path.exists(self.path("aa.json")))
+        self.assertEqual(
+            tier.stats(),
+            {"disk_size": 320, "disk_max_size": 400, "disk_evictions": 1},
+        )
+
+    def test_shared_folder(self):
+        # the files written by a previous process or another worker count toward the bound
+        self.write(DiskTier(self.tmp_dir.name, max_bytes=250), "aa.wav", used=1)
+        other = DiskTier(self.tmp_dir.name, max_bytes=250)
+        self.write(other, "bb.wav", used=2)
+        tier = DiskTier(self.tmp_dir.name, max_bytes=250)
+        self.write(tier, "cc.wav", used=3)
+
+        self.assertFalse(os.path.exists(self.path("aa.wav")))
+        self.assertEqual(tier.stats()["disk_size"], 200)
+
+    def test_evicted_entries_are_misses(self):
+        cache = EmbeddingCache(root=self.tmp_dir.name, max_entries=0)
+        cache.put("model", "John", [1.0, 2.0])
+        os.remove(cache.path("model", cache.key("model", "John")))
+        self.assertIsNone(cache.get("model", "John"))
+
+        images = ImageCache(root=self.tmp_dir.name)
+        images.put("abcd", b"png", [])
+        os.remove(images.path("abcd", "json"))
+        self.assertIsNone(images.get("abcd"))
+        self.assertEqual(images.stats()["misses"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import numpy as np
+from pydub import AudioSegment
+from prmx import dsp
+
+SAMPLE_RATE = 24000
+
+
+def tone(frequency: float, duration: float = 0.5) -> np.ndarray:
+    t = np.arange(int(duration * SAMPLE_RATE)) / SAMPLE_RATE
+    return (0.5 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)[:, None]
+
+
+def rms(samples: np.ndarray) -> float:
+    # skip the filter transient
+    return float(np.sqrt(np.mean(samples[1000:] ** 2)))
+
+
+class Test_TestDsp(unittest.TestCase):
+    def test_segment_roundtrip(self):
+        samples = tone(440)
+        segment = dsp.to_segment(samples.copy(), SAMPLE_RATE)
+        self.assertEqual((segment.sample_width, segment.channels), (2, 1))
+
+        view = dsp.segment_samples(segment)
+        self.assertFalse(view.flags["OWNDATA"])
+        np.testing.assert_allclose(dsp.to_float(view), samples, atol=1 / 32768)
+
+        # out of range samples are clipped instead of wrapping around
+        loud = dsp.to_segment(np.array([[1.5], [-1.5]]), SAMPLE_RATE)
+        self.assertEqual(dsp.segment_samples(loud).flatten().tolist(), [32767, -32768])
+
+    def test_lowpass(self):
+        dsp.lowpass_sos.cache_clear()
+        low = dsp.lowpass(tone(440), SAMPLE_RATE, 6000)
+        high = dsp.lowpass(tone(10000), SAMPLE_RATE, 6000)
+        self.assertAlmostEqual(rms(low), rms(tone(440)), delta=0.01)
+        self.assertLess(rms(high), 0.01)
+        # the filter is designed once for the same rate, cutoff and order
+        self.assertEqual(dsp.lowpass_sos.cache_info().misses, 1)
+
+    def test_normalize_peak(self):
+        samples = tone(440)
+        dsp.normalize_peak(samples, -6.0)
+        self.assertAlmostEqual(np.max(np.abs(samples)), 10 ** (-6 / 20), places=5)
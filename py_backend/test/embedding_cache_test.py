@@ -0,0 +1,52 @@
+import tempfile
+import unittest
+import numpy as np
+from prmx.embedding_cache import EmbeddingCache
+
+
+class Test_TestEmbeddingCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_roundtrip(self):
+        cache = EmbeddingCache(root=self.tmp_dir.name, max_entries=2)
+        self.assertIsNone(cache.get("model", "John"))
+
+        vector = cache.put("model", "John", [0.5, 1.5])
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertEqual(cache.get("model", "John").tolist(), [0.5, 1.5])
+        # the same text embedded by another model is a different entry
+        self.assertIsNone(cache.get("other/model", "John"))
+
+    def test_disk_tier(self):
+        EmbeddingCache(root=self.tmp_dir.name).put("model", "John", [1.0, 2.0])
+
+        # a new process starts with an empty memory tier but shares the disk tier
+        cache = EmbeddingCache(root=self.tmp_dir.name)
+        self.assertEqual(cache.get("model", "John").tolist(), [1.0, 2.0])
+        self.assertEqual(cache.stats()["disk_hits"], 1)
+        cache.get("model", "John")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_lru_eviction(self):
+        cache = EmbeddingCache(root=self.tmp_dir.name, max_entries=2)
+        cache.put("model", "a", [1.0])
+        cache.put("model", "b", [2.0])
+        # touch "a" so that "b" becomes the least recently used entry
+        cache.get("model", "a")
+        cache.put("model", "c", [3.0])
+
+        stats = cache.stats()
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["size"], 2)
+        self.assertIn(cache.key("model", "a"), cache.entries)
+        self.assertNotIn(cache.key("model", "b"), cache.entries)
+        # evicted entries are still served from disk
+        self.assertEqual(cache.get("model", "b").tolist(), [2.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
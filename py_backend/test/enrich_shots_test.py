@@ -0,0 +1,63 @@
+import unittest
+from unittest.mock import patch
+import numpy as np
+from prmx import api
+from prmx.vector_search import VectorIndex
+
+
+# texts are embedded as one-hot vectors of their first word, matching the libraries below
+WORDS = ["happy", "sad", "rain", "wind", "room", "street"]
+
+
+def fake_embeds(texts: list[str]) -> list[np.ndarray]:
+    return [
+        np.eye(len(WORDS))[WORDS.index(text.split()[0].strip(":"))] for text in texts
+    ]
+
+
+class Test_TestEnrichShots(unittest.TestCase):
+    @patch("prmx.audio.acoustic_environments", {"small_room": "", "outside": ""})
+    @patch("prmx.audio.load_acoustic_env_embeddings")
+    @patch("prmx.audio.load_audio_embeddings")
+    @patch("prmx.speech.load_data")
+    @patch("prmx.api.cached_embeds", side_effect=fake_embeds)
+    def test_batched_enrichment(
+        self, cached_embeds, load_data, load_audio, load_acoustic
+    ):
+        eye = np.eye(len(WORDS))
+        load_data.return_value = (
+            [
+                {"emotion": "joy", "emotion_index": 0},
+                {"emotion": "sadness", "emotion_index": 1},
+            ],
+            VectorIndex(eye[:2]),
+        )
+        load_audio.return_value = VectorIndex(eye[[3, 2, 2, 3]], cosine=True)
+        load_acoustic.return_value = VectorIndex(eye[[4, 5]], cosine=True)
+
+        locations = [
+            {"name": "room", "desc": "bedroom"},
+            {"name": "street", "desc": ""},
+        ]
+        shots = [
+            {
+                "dialog": [{"line": "sad day"}, {"line": "happy day"}],
+                "sound": "rain falling",
+                "location": 0,
+                "content": "",
+            },
+            {"dialog": [], "sound": "wind blowing", "location": 1, "content": ""},
+        ]
+        with patch.dict("os.environ", {"PRECOMPUTE_SOUND_VER": "v1"}):
+            api.enrich_shots(shots, locations)
+
+        # a single embedding call for the dialog lines, sounds and acoustic texts of all shots
+        cached_embeds.assert_called_once()
+        self.assertEqual(len(cached_embeds.call_args.args[0]), 6)
+        self.assertEqual([d["emotion"] for d in shots[0]["dialog"]], ["sadness", "joy"])
+        self.assertEqual(shots[0]["sound_urls"], ["v1/1.ogg", "v1/2.ogg", "v1/0.ogg"])
+        self.assertEqual(shots[1]["sound_urls"], ["v1/0.ogg", "v1/3.ogg", "v1/1.ogg"])
+        self.assertEqual(
+            [shot["acoustic_env"] for shot in shots], ["small_room", "outside"]
+        )
+        self.assertEqual(shots[1]["selected_sound_index"], 0)
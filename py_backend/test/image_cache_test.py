@@ -0,0 +1,116 @@
+import base64
+import io
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import numpy as np
+from PIL import Image
+from prmx import api, imagen
+from prmx.datastore import DataStore
+from media_uploader_test import FakeWriter
+from prmx.image_cache import ImageCache
+
+
+def png_data(seed: int = 0) -> bytes:
+    pixels = np.random.default_rng(seed).integers(0, 255, (8, 8, 3), dtype=np.uint8)
+    mem_file = io.BytesIO()
+    Image.fromarray(pixels).save(mem_file, format="PNG")
+    return mem_file.getvalue()
+
+
+class FakeResponse:
+    def __init__(self, prompt: str):
+        self.text = prompt
+        self.payload = {
+            "predictions": [
+                {
+                    "0": {
+                        "image_base64": base64.b64encode(png_data()).decode(),
+                        "bounding_boxes": [{"name": "John", "box": [0, 0, 4, 4]}],
+                    }
+                }
+            ]
+        }
+
+    def json(self) -> dict:
+        return self.payload
+
+
+class Test_TestImageCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ImageCache(root=self.tmp_dir.name)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_disk_tier(self):
+        key = self.cache.key({"prompt": "A castle at night"})
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, png_data(), [{"name": "John"}])
+
+        # another worker sharing the folder gets the same entry
+        self.assertEqual(
+            ImageCache(root=self.tmp_dir.name).get(key),
+            (png_data(), [{"name": "John"}]),
+        )
+        self.assertNotEqual(key, self.cache.key({"prompt": "A castle at dawn"}))
+        with patch("prmx.image_cache.IMAGE_MODEL_VERSION", "2"):
+            self.assertNotEqual(key, self.cache.key({"prompt": "A castle at night"}))
+
+    def test_dedup_and_cache_shot_images(self):
+        requests = []
+
+        async def post_json(endpoint, url, payload, headers):
+            requests.append(payload["dataframe_records"][0]["prompt"])
+            return FakeResponse(requests[-1])
+
+        prompts = [
+            {"prompt": p, "char_id_mapping": {"John": "c1"}} for p in ["a", "b", "a"]
+        ]
+        with patch.object(imagen, "image_cache", lambda: self.cache), patch.object(
+            imagen.aio, "post_json", post_json
+        ), patch.object(imagen, "inference_headers", lambda: {}), patch.object(
+            api, "get_prompt_for_shot_image", side_effect=prompts * 2
+        ):
+            results = api.get_shot_images([{}, {}, {}], [], [])
+            # a re-render is served by the cache
+            rerender = api.get_shot_images([{}, {}, {}], [], [])
+
+        self.assertEqual(sorted(requests), ["a", "b"])
+        self.assertEqual(results[0]["hash"], results[2]["hash"])
+        self.assertIsNot(results[0]["image"], results[2]["image"])
+        self.assertEqual(results[0]["image"].format, "PNG")
+        self.assertEqual(
+            results[0]["bounding_boxes"], [{"box": [0, 0, 4, 4], "character_id": "c1"}]
+        )
+        self.assertEqual([r["hash"] for r in rerender], [r["hash"] for r in results])
+        self.assertEqual(self.cache.stats()["disk_hits"], 2)
+
+    @patch("prmx.datastore.client")
+    def test_skip_unchanged_upload(self, client):
+        uploads = []
+        bucket = client.return_value
+        bucket.get_blob.return_value = None
+
+        def upload(blob):
+            uploads.append(blob.metadata)
+            bucket.get_blob.return_value = MagicMock(metadata=blob.metadata)
+
+        with patch("prmx.media_uploader.Blob") as Blob:
+            Blob.return_value.open.side_effect = lambda *args, **kwargs: FakeWriter(
+                lambda data: upload(Blob.return_value)
+            )
+            ds = DataStore()
+            image = Image.open(io.BytesIO(png_data()))
+            self.assertEqual(ds.put_image("uid", "cid", image, "ab"), "uid/cid/ab.png")
+            ds.put_image("uid", "cid", Image.open(io.BytesIO(png_data())), "ab")
+            self.assertEqual(len(uploads), 1)
+
+            # another image for the same prompt is uploaded again
+            ds.put_image("uid", "cid", Image.open(io.BytesIO(png_data(1))), "ab")
+            self.assertEqual(len(uploads), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,10 @@ from prmx import llm
 from prmx.util import inference_url, oidc_token, setup_env_secrets
 import text_generation
 import unittest
+from unittest.mock import patch
+from types import SimpleNamespace
+import httpx
+from openai import RateLimitError
 
 SCENE_VALID = "'Training Montage\nDescription: <Character 0> and <Character 1> train intensely for their next heist in <Location 4>. They practice lock picking, sneaking, and distracting security systems. As they finish their training, they share a tense moment, revealing the conflict of morals in their lives.\nPurpose: Establishes the skills of the main characters and their growing inner conflict as the story progresses.\nMusic: Heist Montage. Fast-paced, tense, instrumental.'"
 SCENE_INVALID_CHAR = "'Training Montage\nDescription: <Character 14> and <Character 1> train intensely for their next heist in <Location 4>. They practice lock picking, sneaking, and distracting security systems. As they finish their training, they share a tense moment, revealing the conflict of morals in their lives.\nPurpose: Establishes the skills of the main characters and their growing inner conflict as the story progresses.\nMusic: Heist Montage. Fast-paced, tense, instrumental.'"
@@ -215,6 +219,50 @@ class Test_TestLLM(unittest.TestCase):
         for example in examples:
             self.assertEqual(llm.remove_parenthesized_content(example[0]), example[1])
 
+    def test_read_stream(self):
+        def chunk(**choice):
+            return SimpleNamespace(choices=[SimpleNamespace(**choice)])
+
+        tokens = []
+        chat_stream = [
+            chunk(delta=SimpleNamespace(content=None)),
+            chunk(delta=SimpleNamespace(content="INT. ")),
+            SimpleNamespace(choices=[]),
+            chunk(delta=SimpleNamespace(content="HOUSE")),
+        ]
+        self.assertEqual(
+            llm.read_stream(chat_stream, True, tokens.append), "INT. HOUSE"
+        )
+        self.assertEqual(tokens, ["INT. ", "HOUSE"])
+
+        completion_stream = [chunk(text="Once "), chunk(text="upon")]
+        self.assertEqual(
+            llm.read_stream(completion_stream, False, tokens.append), "Once upon"
+        )
+
+    @patch("prmx.llm.time.sleep")
+    def test_retry_on_rate_limit(self, sleep):
+        request = httpx.Request("POST", "https://api.openai.com/v1/completions")
+        response = httpx.Response(429, headers={"retry-after": "3"}, request=request)
+        calls = []
+
+        def rate_limited(result, failures):
+            calls.append(result)
+            if len(calls) <= failures:
+                raise RateLimitError("rate limited", response=response, body=None)
+            return result
+
+        self.assertEqual(llm.retry_on_rate_limit(rate_limited, "script", 2), "script")
+        self.assertEqual(len(calls), 3)
+        # the retry-after header sets the minimum delay, plus up to a second of jitter
+        for call in sleep.call_args_list:
+            self.assertTrue(3 <= call.args[0] <= 4)
+
+        calls.clear()
+        with self.assertRaises(RateLimitError):
+            llm.retry_on_rate_limit(rate_limited, "script", 5, retries=1)
+        self.assertEqual(len(calls), 2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,90 @@
+import io
+import unittest
+from unittest.mock import MagicMock, patch
+from prmx.media_uploader import MediaUpload, MediaUploader
+
+
+class FakeBucket:
+    name = "media-test"
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_blob(self, key):
+        if key in self.objects:
+            return MagicMock(metadata=self.objects[key][1])
+        return None
+
+
+# the object only exists once the stream is closed, as with a resumable upload
+class FakeWriter(io.BytesIO):
+    def __init__(self, on_close):
+        super().__init__()
+        self.on_close = on_close
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.on_close(self.getvalue())
+        super().__exit__(exc_type, exc_val, exc_tb)
+
+
+class FakeBlob:
+    def __init__(self, key, bucket):
+        self.key = key
+        self.bucket = bucket
+        self.metadata = None
+
+    def open(self, mode, chunk_size, ignore_flush, content_type):
+        def on_close(data):
+            self.bucket.objects[self.key] = (data, self.metadata)
+
+        return FakeWriter(on_close)
+
+
+def media_upload(key: str, data: bytes) -> MediaUpload:
+    return MediaUpload(
+        key=key,
+        content_type="image/png",
+        fingerprint={"pixels_hash": str(hash(data))},
+        encode=lambda file: file.write(data),
+    )
+
+
+class Test_TestMediaUploader(unittest.TestCase):
+    def setUp(self) -> None:
+        self.bucket = FakeBucket()
+        self.uploader = MediaUploader(lambda: self.bucket, workers=4)
+
+    @patch("prmx.media_uploader.Blob", FakeBlob)
+    def test_upload_all(self):
+        uploads = [media_upload(f"uid/cid/{i}.png", bytes(100 * i)) for i in range(6)]
+        self.assertEqual(
+            self.uploader.upload_all(uploads), [upload.key for upload in uploads]
+        )
+        self.assertEqual(self.bucket.objects["uid/cid/3.png"][0], bytes(300))
+        self.assertEqual(
+            self.uploader.stats(), {"uploads": 6, "skipped": 0, "bytes": 1500}
+        )
+
+        # unchanged files are skipped, changed ones are uploaded again
+        uploads[2] = media_upload("uid/cid/2.png", bytes(50))
+        self.uploader.upload_all(uploads)
+        self.assertEqual(
+            self.uploader.stats(), {"uploads": 7, "skipped": 5, "bytes": 1550}
+        )
+
+    @patch("prmx.media_uploader.Blob", FakeBlob)
+    def test_failed_encoding(self):
+        def encode(file):
+            file.write(b"partial")
+            raise OSError("ffmpeg failed")
+
+        upload = MediaUpload("uid/cid/a.mp3", "audio/mpeg", {}, encode)
+        with self.assertRaises(OSError):
+            self.uploader.upload_all([upload])
+        # no partial object is left in the bucket
+        self.assertEqual(self.bucket.objects, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
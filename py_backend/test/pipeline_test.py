@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+from prmx.pipeline import Pipeline, fan_out
+
+
+class Test_TestPipeline(unittest.TestCase):
+    def test_dependencies(self):
+        pipeline = Pipeline(max_workers=4)
+        pipeline.add("scenes", lambda: ["a", "b", "c"])
+        for i, name in enumerate(fan_out("script", 3)):
+            pipeline.add(name, lambda scenes, i=i: scenes[i].upper(), deps=["scenes"])
+        pipeline.add("movie", lambda *scripts: "".join(scripts), fan_out("script", 3))
+
+        results = pipeline.run()
+        self.assertEqual(results["script.1"], "B")
+        self.assertEqual(results["movie"], "ABC")
+
+    def test_independent_stages_run_concurrently(self):
+        # both stages must be running at the same time to pass the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        pipeline = Pipeline(max_workers=2)
+        pipeline.add("characters", barrier.wait)
+        pipeline.add("locations", barrier.wait)
+        pipeline.run()
+
+    def test_streamed_results(self):
+        finished = []
+        pipeline = Pipeline(on_result=lambda name, result: finished.append(name))
+        pipeline.add("scenes", lambda: 1)
+        pipeline.add("music", lambda scenes: scenes + 1, deps=["scenes"])
+        pipeline.run()
+        self.assertEqual(finished, ["scenes", "music"])
+
+    def test_callbacks_do_not_block_dispatch(self):
+        # a slow callback of a stage does not delay independent stages
+        barrier = threading.Barrier(2, timeout=5)
+
+        def on_result(name, result):
+            if name == "characters":
+                barrier.wait()
+
+        pipeline = Pipeline(max_workers=3, on_result=on_result)
+        pipeline.add("characters", lambda: 1)
+        pipeline.add("scenes", lambda: time.sleep(0.1))
+        pipeline.add("locations", lambda scenes: barrier.wait(), deps=["scenes"])
+        pipeline.run()
+
+    def test_failure(self):
+        def fail():
+            raise ValueError("stage failed")
+
+        ran = []
+        pipeline = Pipeline()
+        pipeline.add("scenes", fail)
+        pipeline.add("music", lambda scenes: ran.append(scenes), deps=["scenes"])
+        with self.assertRaises(ValueError):
+            pipeline.run()
+        # dependent stages never run
+        self.assertEqual(ran, [])
+
+    def test_invalid_graphs(self):
+        pipeline = Pipeline()
+        pipeline.add("shots", lambda script: script, deps=["script"])
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+        pipeline = Pipeline()
+        pipeline.add("a", lambda b: b, deps=["b"])
+        pipeline.add("b", lambda a: a, deps=["a"])
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -61,6 +61,30 @@ class Test_TestPromptparser(unittest.TestCase):
             "A bird, and then a dog.\nName of the dog: call#1\nName of the bird:",
         )
 
+    def test_eval_prompt_streaming(self):
+        prompt_text = "Title: <<TITLE>>\nPlot: <<PLOT>>"
+        tokens = []
+
+        def llm_stream_test(prompt, parameters, on_token):
+            output = ["The ", "End"] if prompt == "Title:" else ["Happy ", "ending"]
+            for delta in output:
+                on_token(delta)
+            return "".join(output)
+
+        llm_results = promptparser.eval_prompt(
+            prompt_text, {}, llm_stream_test, on_token=lambda *t: tokens.append(t)
+        )
+        self.assertEqual(llm_results, {"TITLE": "The End", "PLOT": "Happy ending"})
+        self.assertEqual(
+            tokens,
+            [
+                ("TITLE", "The "),
+                ("TITLE", "End"),
+                ("PLOT", "Happy "),
+                ("PLOT", "ending"),
+            ],
+        )
+
     def test_parse_parameter_list(self):
         test_str = "a=123, b='bla', c=\"abc\", d=1.23, e=True, f=None"
         expected_dict = {
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from functools import partial
+from unittest.mock import patch
+from PIL import Image
+from prmx import aio, api
+from prmx.scheduler import JobScheduler
+
+
+class Test_TestScheduler(unittest.TestCase):
+    def test_priority_order(self):
+        started = []
+
+        async def job(i):
+            started.append(i)
+            await asyncio.sleep(0.01)
+            return i * i
+
+        scheduler = JobScheduler(concurrency=2)
+        results = aio.run(
+            scheduler.run([partial(job, i) for i in range(6)], [5, 4, 3, 0, 1, 2])
+        )
+        self.assertEqual(results, [0, 1, 4, 9, 16, 25])
+        self.assertEqual(started, [3, 4, 5, 2, 1, 0])
+
+    def test_retries_and_failures(self):
+        attempts = {"flaky": 0, "broken": 0}
+
+        async def flaky():
+            attempts["flaky"] += 1
+            if attempts["flaky"] < 3:
+                raise ConnectionError("host restarting")
+            return "image"
+
+        async def broken():
+            attempts["broken"] += 1
+            raise ValueError("bad prompt")
+
+        done = []
+
+        async def on_done(i, outcome):
+            done.append(i)
+
+        scheduler = JobScheduler(concurrency=4, retries=2, backoff=0.001)
+        flaky_result, broken_result = aio.run(
+            scheduler.run([flaky, broken], None, on_done)
+        )
+
+        self.assertEqual(flaky_result, "image")
+        # a failed job returns its exception, the other jobs are not affected
+        self.assertIsInstance(broken_result, ValueError)
+        self.assertEqual(attempts, {"flaky": 3, "broken": 3})
+        self.assertEqual(sorted(done), [0, 1])
+
+    def test_callbacks_do_not_hold_slots(self):
+        second_started = asyncio.Event()
+
+        async def first():
+            return "first"
+
+        async def second():
+            second_started.set()
+            return "second"
+
+        async def on_done(i, outcome):
+            # with a single slot, the second job only starts if this upload does not hold it
+            if i == 0:
+                await asyncio.wait_for(second_started.wait(), timeout=5)
+            else:
+                raise ConnectionError("upload failed")
+
+        scheduler = JobScheduler(concurrency=1, retries=0)
+        first_result, second_result = aio.run(
+            scheduler.run([first, second], None, on_done)
+        )
+
+        self.assertEqual(first_result, "first")
+        # a failing callback fails its own job only
+        self.assertIsInstance(second_result, ConnectionError)
+
+    def test_progressive_shot_images(self):
+        generated = []
+
+        async def gen_image_async(prompt_and_mappings):
+            generated.append(prompt_and_mappings["prompt"])
+            if prompt_and_mappings["prompt"] == "broken":
+                raise ValueError("bad prompt")
+            image = Image.new("RGB", (4, 4))
+            image.format = "PNG"
+            return image, prompt_and_mappings["prompt"], []
+
+        prompts = [{"prompt": p} for p in ["a", "b", "broken", "c", "d"]]
+        delivered = []
+
+        def on_result(id, result):
+            if id == 4:
+                raise ConnectionError("upload failed")
+            delivered.append(id)
+
+        with patch.object(api, "gen_image_async", gen_image_async), patch.object(
+            api, "get_prompt_for_shot_image", side_effect=prompts
+        ), patch.object(JobScheduler, "retry_delay", lambda self, retry: 0), patch.dict(
+            aio.CONCURRENCY, {"image": 1}
+        ):
+            results = api.get_shot_images(
+                [{}] * 5, [], [], priority_shots=[3], on_result=on_result
+            )
+
+        # the priority shot first, then the others in scene order
+        self.assertEqual(generated[:3], ["c", "a", "b"])
+        self.assertEqual(sorted(delivered), [0, 1, 3])
+        # failed generations and failed uploads are per shot failures
+        self.assertEqual(
+            [r and r["hash"] for r in results], ["a", "b", None, "c", None]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import io
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+import numpy as np
+from pydub import AudioSegment
+from prmx import speech
+from prmx.datastore import DataStore
+from media_uploader_test import FakeWriter
+from prmx.speech_cache import SpeechCache
+
+
+def speech_line(seed: int = 0) -> AudioSegment:
+    samples = np.random.default_rng(seed).integers(-3000, 3000, 2400, dtype=np.int16)
+    return AudioSegment(samples.tobytes(), frame_rate=24000, sample_width=2, channels=1)
+
+
+class Test_TestSpeechCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_disk_tier(self):
+        cache = SpeechCache(root=self.tmp_dir.name)
+        key = cache.key(quote="Hello", speaker="p1", emotion="Neutral", pitch_ratio=1)
+        self.assertIsNone(cache.get(key))
+        cache.put(key, speech_line())
+
+        # another worker sharing the folder gets the same samples
+        line = SpeechCache(root=self.tmp_dir.name).get(key)
+        self.assertEqual(line.raw_data, speech_line().raw_data)
+        self.assertEqual(line.frame_rate, 24000)
+        # any change of the voice is a different line
+        other_key = cache.key(
+            quote="Hello", speaker="p1", emotion="Neutral", pitch_ratio=1.1
+        )
+        self.assertIsNone(cache.get(other_key))
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_processing_key(self):
+        cache = SpeechCache(root=self.tmp_dir.name)
+        key = cache.key(quote="Hello", **speech.processing_inputs(1.1))
+        # lines processed by another version of the chain sound different
+        with patch.object(speech, "SPEECH_PROCESSING_VERSION", "2"):
+            other_key = cache.key(quote="Hello", **speech.processing_inputs(1.1))
+        self.assertNotEqual(key, other_key)
+
+    @patch("prmx.datastore.client")
+    def test_skip_unchanged_upload(self, client):
+        uploads = []
+        bucket = client.return_value
+        bucket.get_blob.return_value = None
+
+        def upload(blob):
+            uploads.append(blob.metadata)
+            bucket.get_blob.return_value = MagicMock(metadata=blob.metadata)
+
+        with patch("prmx.media_uploader.Blob") as Blob, patch(
+            "pydub.AudioSegment.export", lambda *args, **kwargs: io.BytesIO(b"mp3")
+        ):
+            Blob.return_value.open.side_effect = lambda *args, **kwargs: FakeWriter(
+                lambda data: upload(Blob.return_value)
+            )
+            ds = DataStore()
+            self.assertEqual(
+                ds.put_speech("uid", "cid", speech_line(), "abcd"), "uid/cid/abcd.mp3"
+            )
+            ds.put_speech("uid", "cid", speech_line(), "abcd")
+            self.assertEqual(len(uploads), 1)
+
+            # a new voice for the same line hash is uploaded again
+            ds.put_speech("uid", "cid", speech_line(seed=1), "abcd")
+            self.assertEqual(len(uploads), 2)
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+from prmx import speech
+from precompute.speech.gen_speech import convert_to_binary
+from prmx.vector_search import VectorIndex
+
+
+class Test_TestSpeechData(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "emotion_embeddings.json")
+        self.embeddings = np.random.default_rng(0).normal(size=(3, 8))
+        with open(self.path, "w") as file:
+            json.dump(
+                [
+                    {"emotion_index": i, "text_embed": json.dumps(embed.tolist())}
+                    for i, embed in enumerate(self.embeddings)
+                ],
+                file,
+            )
+        speech.load_data.cache_clear()
+
+    def tearDown(self):
+        speech.load_data.cache_clear()
+        self.folder.cleanup()
+
+    def test_legacy_json(self):
+        mapping, index = speech.load_data(self.path)
+        self.assertEqual(mapping, [{"emotion_index": i} for i in range(3)])
+        np.testing.assert_allclose(index.vectors, self.embeddings, rtol=1e-6)
+
+    def test_binary_store(self):
+        mapping, index = speech.load_data(self.path)
+        speech.save_data(self.path, mapping, index.vectors)
+        speech.load_data.cache_clear()
+
+        # the binary store takes precedence over the json file
+        os.remove(self.path)
+        binary_mapping, binary_index = speech.load_data(self.path)
+        self.assertEqual(binary_mapping, mapping)
+        self.assertIsInstance(binary_index.vectors, np.memmap)
+        np.testing.assert_array_equal(binary_index.vectors, index.vectors)
+        np.testing.assert_array_equal(binary_index.search(self.embeddings[1], 1), [1])
+
+    def test_converted_store(self):
+        with open(self.path, "w") as file:
+            json.dump(
+                [
+                    {
+                        "emotion_index": i + 1,
+                        "emotion": emotion,
+                        "text_embed": json.dumps(embed.tolist()),
+                    }
+                    for i, (emotion, embed) in enumerate(
+                        zip(["Calming", "Fearful", "Neutral"], self.embeddings)
+                    )
+                ],
+                file,
+            )
+        convert_to_binary(self.path)
+        os.remove(self.path)
+
+        # emotions are matched through the memory-mapped store only
+        with patch.object(speech, "EMOTION_EMBED_PATH", self.path):
+            data = speech.emotions_for_embeddings(self.embeddings[[2, 0]])
+        self.assertEqual(data["emotions"], ["Neutral", "Calming"])
+        self.assertEqual(data["emotion_indices"], [3, 1])
+        _, index = speech.load_data(self.path)
+        self.assertIsInstance(index.vectors, np.memmap)
+
+
+class Test_TestVoiceCatalogue(unittest.TestCase):
+    def setUp(self):
+        voices = [
+            {"speaker_index": 10 + i, "speaker": f"p{i}", "pitch_ratio": 1.0 + i / 10}
+            for i in range(4)
+        ]
+        self.catalogue = speech.VoiceCatalogue(voices, VectorIndex(np.eye(4)))
+
+    def test_lookup(self):
+        self.assertEqual(self.catalogue.voice(12)["speaker"], "p2")
+        self.assertEqual(self.catalogue.rows_of([13, 10, 99]), [3, 0])
+        with self.assertRaises(KeyError):
+            self.catalogue.voice(0)
+
+    def test_attribute_voices(self):
+        with patch("prmx.speech.voice_catalogue", return_value=self.catalogue), patch(
+            "prmx.speech.get_embed", return_value=[0.9, 0.8, 0.7, 0.0]
+        ):
+            data, speaker_indices = speech.attribute_voices(
+                "John", "a man", taken_indices={10}, num_voices_per_character=2
+            )
+        self.assertEqual(speaker_indices, [11, 12])
+        self.assertEqual(data["speakers"], ["p1", "p2"])
+        self.assertEqual(data["pitch_ratios"], [1.1, 1.2])
+
+    def test_attribute_voices_batch(self):
+        characters = [
+            {"name": "John", "desc": "a man", "voice_desc": ""},
+            {"name": "Mary", "desc": "a woman", "voice_desc": "soft voice"},
+        ]
+        embeddings = [np.array([0.9, 0.8, 0.7, 0.0]), np.array([0.9, 0.0, 0.7, 0.8])]
+        with patch("prmx.speech.voice_catalogue", return_value=self.catalogue), patch(
+            "prmx.speech.cached_embeds", return_value=embeddings
+        ) as cached_embeds:
+            results = speech.attribute_voices_batch(
+                characters, taken_indices={10}, num_voices_per_character=2
+            )
+        # one embedding request for all characters, the voice description is preferred
+        cached_embeds.assert_called_once_with(["John. a man", "soft voice"])
+        self.assertEqual(results[0][1], [11, 12])
+        # the remaining voice, then a random one of the catalogue when all voices are taken
+        self.assertEqual(results[1][1][0], 13)
+        self.assertEqual(len(results[1][1]), 2)
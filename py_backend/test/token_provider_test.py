@@ -0,0 +1,68 @@
+import datetime
+import threading
+import unittest
+from prmx.token_provider import TokenProvider
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+class FakeCredentials:
+    """ID token credentials issuing tokens valid for an hour"""
+
+    issued = 0
+    now = NOW.timestamp()
+
+    def __init__(self):
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        FakeCredentials.issued += 1
+        self.token = f"token-{FakeCredentials.issued}"
+        # naive UTC datetime, like google-auth
+        now = datetime.datetime.fromtimestamp(
+            FakeCredentials.now, datetime.timezone.utc
+        )
+        self.expiry = now.replace(tzinfo=None) + datetime.timedelta(hours=1)
+
+
+class Test_TestTokenProvider(unittest.TestCase):
+    def setUp(self):
+        FakeCredentials.issued = 0
+        FakeCredentials.now = NOW.timestamp()
+        self.provider = TokenProvider(
+            FakeCredentials, refresh_margin=300, clock=lambda: FakeCredentials.now
+        )
+
+    def test_cached_token(self):
+        tokens = [self.provider.token() for _ in range(10)]
+        self.assertEqual(set(tokens), {"token-1"})
+        self.assertEqual(self.provider.stats()["refreshes"], 1)
+        self.assertEqual(self.provider.stats()["hits"], 9)
+
+    def test_concurrent_first_calls(self):
+        threads = [threading.Thread(target=self.provider.token) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeCredentials.issued, 1)
+
+    def test_background_refresh(self):
+        self.provider.token()
+        # within the refresh margin, the current token is served while the next one is fetched
+        FakeCredentials.now += 3600 - 100
+        self.assertEqual(self.provider.token(), "token-1")
+        self.provider.refreshing.join()
+        self.assertEqual(self.provider.token(), "token-2")
+        self.assertEqual(self.provider.stats()["background_refreshes"], 1)
+
+    def test_expired_token(self):
+        self.provider.token()
+        FakeCredentials.now += 3600
+        self.assertEqual(self.provider.token(), "token-2")
+        self.assertEqual(self.provider.stats()["refreshes"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+from prmx import aio, speech
+
+SAMPLE_RATE = 16000
+
+
+class FakeResponse:
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.text = str(payload)
+
+    def json(self) -> dict:
+        return self.payload
+
+
+# one prediction row per record, each with a line as long as the prompt in milliseconds
+def prediction(record: dict) -> dict:
+    num_samples = len(record["prompt"]) * SAMPLE_RATE // 1000
+    return {"0": {"audio_generated": [0.1] * num_samples, "sampling_rate": SAMPLE_RATE}}
+
+
+class Test_TestTTSBatch(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.failing_prompts = set()
+        patches = [
+            patch.object(aio, "post_json", self.post_json),
+            patch.object(speech, "inference_headers", lambda: {}),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def post_json(self, endpoint, url, payload, headers):
+        records = payload["dataframe_records"]
+        self.requests.append([record["prompt"] for record in records])
+        return FakeResponse(
+            {
+                "predictions": [
+                    (
+                        {"error": "worker failed"}
+                        if len(records) > 1 and r["prompt"] in self.failing_prompts
+                        else prediction(r)
+                    )
+                    for r in records
+                ]
+            }
+        )
+
+    def records(self, count: int) -> list[tuple[str, str, str]]:
+        return [("x" * (100 + i), "p225", "neutral") for i in range(count)]
+
+    def test_chunk_records(self):
+        records = [("x" * n, "p225", "neutral") for n in [10, 10, 10, 50, 10]]
+        chunks = speech.chunk_records(records, max_records=2, max_chars=40)
+        self.assertEqual(
+            [[len(r[0]) for r in chunk] for chunk in chunks],
+            [[10, 10], [10], [50], [10]],
+        )
+
+    def test_batch_split(self):
+        records = self.records(10)
+        lines = aio.run(speech.infer_batch_async(records))
+
+        # chunked by the default batch size, predictions are returned in input order
+        self.assertEqual(
+            [len(r) for r in self.requests],
+            [speech.TTS_BATCH_SIZE, 10 - speech.TTS_BATCH_SIZE],
+        )
+        self.assertEqual([len(line) for line in lines], [100 + i for i in range(10)])
+
+    def test_partial_failure(self):
+        records = self.records(4)
+        self.failing_prompts = {records[2][0]}
+        lines = aio.run(speech.infer_batch_async(records))
+
+        # the failed line is synthesized again alone
+        self.assertEqual(self.requests[1:], [[records[2][0]]])
+        self.assertEqual([len(line) for line in lines], [100, 101, 102, 103])
+
+    def test_batcher_merges_concurrent_lines(self):
+        batcher = speech.TTSBatcher(max_batch_size=4, max_wait=0.05)
+        records = self.records(6)
+
+        async def synthesize():
+            return await asyncio.gather(*[batcher.infer(*r) for r in records])
+
+        lines = aio.run(synthesize())
+        self.assertEqual([len(r) for r in self.requests], [4, 2])
+        self.assertEqual([len(line) for line in lines], [100 + i for i in range(6)])
+        self.assertEqual(batcher.stats, {"lines": 6, "batches": 2})
+        self.assertEqual(batcher.tasks, set())
+
+    def test_batcher_unexpected_failure(self):
+        batcher = speech.TTSBatcher(max_batch_size=2, max_wait=0.05)
+
+        async def send(batch):
+            raise RuntimeError("batch lost")
+
+        async def synthesize():
+            return await asyncio.gather(
+                *[batcher.infer(*r) for r in self.records(2)], return_exceptions=True
+            )
+
+        # the lines of the batch fail instead of waiting forever
+        with patch.object(batcher, "send", send):
+            errors = aio.run(synthesize())
+        self.assertEqual([str(e) for e in errors], ["batch lost"] * 2)
+        self.assertEqual(batcher.tasks, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -97,6 +97,59 @@ class Test_TestUtil(unittest.TestCase):
             actual_output == expected_output
         ), f"Expected {expected_output}, but got {actual_output}"
 
+    def test_embedding_batcher(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+
+        def fake_embed(texts):
+            calls.append(texts)
+            return [[float(len(text))] for text in texts]
+
+        batcher = util_te.EmbeddingBatcher(fake_embed, max_batch_size=8, max_wait=0.5)
+        texts = ["a", "bb", "a", "ccc", "bb", "a"]
+        with ThreadPoolExecutor(len(texts)) as executor:
+            embeddings = list(executor.map(batcher.embed, texts))
+
+        # each request gets the embedding of its own text
+        self.assertEqual(embeddings, [[1.0], [2.0], [1.0], [3.0], [2.0], [1.0]])
+        # concurrent requests are merged and duplicates are only sent once
+        self.assertEqual(sum(len(call) for call in calls), batcher.stats["texts_sent"])
+        self.assertLess(len(calls), len(texts))
+        self.assertEqual(batcher.stats["requests"], len(texts))
+        for call in calls:
+            self.assertEqual(len(call), len(set(call)))
+
+    def test_embedding_batcher_error(self):
+        def failing_embed(texts):
+            raise ValueError("api error")
+
+        batcher = util_te.EmbeddingBatcher(failing_embed, max_wait=0.0)
+        with self.assertRaises(ValueError):
+            batcher.embed("a")
+
+    def test_locked_cache(self):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        calls = []
+        barrier = threading.Barrier(4)
+
+        @util.locked_cache
+        def load(path):
+            calls.append(path)
+            return [path]
+
+        # concurrent first calls, as in request threads of a cold server
+        def request(_):
+            barrier.wait(timeout=5)
+            return load("voices.json")
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(request, range(4)))
+        self.assertEqual(calls, ["voices.json"])
+        self.assertTrue(all(result is results[0] for result in results))
+
     def test_get_scenes_from_plot(self):
         self.assertEqual(util.split_paragraphs("\n\nabc\n\n123 "), ["abc", "123"])
 
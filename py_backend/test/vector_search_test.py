@@ -0,0 +1,67 @@
+import unittest
+import numpy as np
+from prmx.vector_search import VectorIndex, assign, top_k
+
+
+class Test_TestVectorSearch(unittest.TestCase):
+    def test_top_k(self):
+        scores = np.array([0.5, 0.9, 0.5, 0.1, 0.9])
+        # ties are ordered by index
+        np.testing.assert_array_equal(top_k(scores, 4), [1, 4, 0, 2])
+        np.testing.assert_array_equal(top_k(scores, 2, exclude=[1, 0]), [4, 2])
+        # ties at the k-th score keep the lowest indices
+        np.testing.assert_array_equal(top_k(np.zeros(100), 3), [0, 1, 2])
+        # k is clipped to the remaining candidates
+        np.testing.assert_array_equal(top_k(scores, 10, exclude=[0, 1, 2]), [4, 3])
+
+    def test_assign_greedy(self):
+        rng = np.random.default_rng(0)
+        scores = rng.normal(size=(5, 40))
+        assigned = assign(scores, 3, exclude=[2])
+
+        # same results as successive searches excluding the previous ones
+        taken = [2]
+        for row, found in zip(scores, assigned):
+            np.testing.assert_array_equal(top_k(row, 3, exclude=taken), found)
+            taken.extend(found)
+        self.assertEqual(len(set(np.concatenate(assigned))), 15)
+
+    def test_assign_hungarian(self):
+        # the first row takes the only good candidate of the second row when assigned greedily
+        scores = np.array([[0.9, 0.8, 0.0], [0.85, 0.0, 0.1]])
+        greedy = assign(scores, 1)
+        hungarian = assign(scores, 1, method="hungarian")
+        self.assertEqual([list(a) for a in greedy], [[0], [2]])
+        self.assertEqual([list(a) for a in hungarian], [[1], [0]])
+
+        rng = np.random.default_rng(0)
+        scores = rng.normal(size=(4, 30))
+        assigned = np.stack(assign(scores, 3, exclude=[5], method="hungarian"))
+        self.assertEqual(len(set(assigned.flatten())), 12)
+        self.assertNotIn(5, assigned)
+        # best first within each row
+        row_scores = np.take_along_axis(scores, assigned, axis=1)
+        self.assertTrue(np.all(np.diff(row_scores, axis=1) <= 0))
+        self.assertGreaterEqual(
+            row_scores.sum(),
+            np.take_along_axis(scores, np.stack(assign(scores, 3, [5])), 1).sum(),
+        )
+
+    def test_batched_queries(self):
+        rng = np.random.default_rng(0)
+        index = VectorIndex(rng.normal(size=(50, 8)), cosine=True)
+        queries = rng.normal(size=(6, 8))
+
+        batched = index.search(queries, 3, exclude=[7])
+        self.assertEqual(batched.shape, (6, 3))
+        for query, found in zip(queries, batched):
+            np.testing.assert_array_equal(index.search(query, 3, exclude=[7]), found)
+            self.assertNotIn(7, found)
+
+    def test_cosine(self):
+        # the library is normalized once: a long vector does not win on its norm
+        index = VectorIndex([[10, 10], [1, 0]], cosine=True)
+        self.assertEqual(index.search([1, 0.1], 1)[0], 1)
+        self.assertEqual(VectorIndex([[10, 10], [1, 0]]).search([1, 0.1], 1)[0], 0)
+        self.assertEqual(index.vectors.dtype, np.float32)
+        self.assertTrue(index.vectors.flags["C_CONTIGUOUS"])
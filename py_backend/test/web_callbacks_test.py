@@ -0,0 +1,66 @@
+"""offline tests of the web handlers and callbacks, with the data store mocked"""
+
+import unittest
+from unittest.mock import MagicMock, patch
+from prmx import web
+
+
+class Test_TestProgressiveMedia(unittest.TestCase):
+    def test_shots_saved_as_generated(self):
+        ds = MagicMock()
+        scene_ref = ds.return_value.runtime_path.return_value.collection.return_value
+        shots_ref = scene_ref.document.return_value.collection.return_value
+        saved_during_generation = []
+
+        def get_shot_images(shots: list[str], on_result=None) -> list:
+            for index, shot in enumerate(shots):
+                on_result(index, None if shot == "broken" else {"hash": shot})
+                saved_during_generation.append(list(shots_ref.document.call_args_list))
+            return shots
+
+        get_shot_images.progressive = True
+        get_shot_images.callback = lambda uid, cid, items: [
+            item and {"url": f"{item['hash']}.png", "bounding_boxes": []}
+            for item in items
+        ]
+
+        with patch.object(web, "ds", ds):
+            response = web.gen_media(
+                "uid", "cid", get_shot_images, shots=["a", "broken", "c"], scene=3
+            )
+
+        self.assertEqual(
+            response["shot_images"],
+            [
+                {"url": "a.png", "bounding_boxes": []},
+                None,
+                {"url": "c.png", "bounding_boxes": []},
+            ],
+        )
+        scene_ref.document.assert_called_with("3")
+        # the first shot is in its document before the next one is generated
+        self.assertEqual([call.args for call in saved_during_generation[0]], [("0",)])
+        # shots without image are not saved
+        self.assertEqual(
+            [call.args for call in saved_during_generation[-1]], [("0",), ("2",)]
+        )
+        shots_ref.document.return_value.set.assert_called_with(
+            {"image_url": "c.png", "bounding_boxes": []}, merge=True
+        )
+
+
+class Test_TestSaveScript(unittest.TestCase):
+    def test_merge_stored_scripts(self):
+        ds = MagicMock()
+        ds.return_value.load.return_value = {"script": ["old 0", "old 1", "old 2"]}
+        with patch.object(web, "ds", ds):
+            web.save_script("uid", "cid", {1: "new 1"}, scenes=[{}] * 4)
+
+        # scripts of scenes still being generated are kept
+        ds.return_value.save.assert_called_once_with(
+            "uid", "cid", "script", ["old 0", "new 1", "old 2", ""]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,8 +4,9 @@ it is modifying profile configuration via environment variables.
 """
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase, main, mock
-from prmx import context as ctx
+from prmx import context as ctx, web
 
 
 def clean():
@@ -48,6 +49,34 @@ class Test_TestConfig(TestCase):
         ctx.Config(profile="mock", force=True)
         self.assertEqual(os.environ["PRMX_PROFILE"], "mock")
 
+    @mock.patch.dict("os.environ", {"PRMX_PROFILE": "test", "PRMX_CID": "default"})
+    def test_scoped_config(self):
+        with ctx.scoped_config(profile="mock", cid="scoped"):
+            config = ctx.Config()
+            self.assertEqual((config.name, config.cid), ("mock", "scoped"))
+            # the scope is not shared with other threads through the environment
+            self.assertEqual(os.environ["PRMX_PROFILE"], "test")
+            other_thread = ThreadPoolExecutor(1).submit(ctx.Config).result()
+            self.assertEqual(other_thread.name, "test")
+        self.assertEqual(ctx.Config().cid, "default")
+
+    @mock.patch.dict("os.environ", {"PRMX_PROFILE": "test"})
+    def test_scoped_arguments(self):
+        with ctx.scoped_config(profile="mock"):
+            self.assertEqual(ctx.Config(profile="default", force=True).name, "default")
+        # a configuration created within a scope never writes to the environment
+        self.assertEqual(os.environ["PRMX_PROFILE"], "test")
+
+    @mock.patch.dict("os.environ", {"PRMX_PROFILE": "test"})
+    def test_request_config(self):
+        fun = mock.MagicMock()
+        fun.handler.side_effect = lambda uid, cid, fun: ctx.Config().name
+        with mock.patch.object(web.api, "fake_call", fun, create=True):
+            name = web.gen("uid", "cid", "fake_call", config={"profile": "mock"})
+            self.assertEqual(name, "mock")
+            self.assertEqual(web.gen("uid", "cid", "fake_call"), "test")
+        self.assertEqual(os.environ["PRMX_PROFILE"], "test")
+
     # does not check nested keys for flexibility
     def test_matching_schemas(self):
         profiles = ctx.Config().profiles